@@ -9,6 +9,7 @@ from django.shortcuts import get_object_or_404, redirect, render
 
 from authentication.forms import EmailAuthenticationForm, GeneralUserRegistrationForm
 from model.models import User
+from shop.carts import merge_guest_cart
 
 from .utils import send_verification_email
 
@@ -174,9 +175,8 @@ def signin(request):
                 login(request, user)
                 messages.success(request, f"ようこそ、{user.get_display_name()}さん!")
                 next_url = request.GET.get("next") or request.POST.get("next")
-                if next_url:
-                    return redirect(next_url)
-                return redirect("/")
+                # 未ログインのときにカートに入れた商品をユーザーのカートに移す
+                return merge_guest_cart(request, redirect(next_url or "/"))
             else:
                 messages.error(
                     request, "メールアドレスまたはパスワードが正しくありません。"
@@ -15,6 +15,7 @@ from pathlib import Path
 import dj_database_url
 from dotenv import load_dotenv
 from django.contrib.messages import constants as messages
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -114,6 +115,54 @@ if not DEBUG:
     )
 
 
+# キャッシュ設定
+# テンプレートの断片キャッシュとカートのキャッシュはバックエンドを環境変数で切り替える
+# locmem: プロセス内 / file: 同じホストのプロセス間で共有 / redis: 複数ホストで共有
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+}
+FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND', 'locmem')
+FRAGMENT_CACHE_LOCATION = os.environ.get('FRAGMENT_CACHE_LOCATION', 'fragments')
+# 断片キャッシュの保持期間（秒）。キーにバージョンを含むので古い断片は期限切れで消える
+FRAGMENT_CACHE_TIMEOUT = int(os.environ.get('FRAGMENT_CACHE_TIMEOUT', 60 * 60 * 24))
+
+# カートの保存先
+# database: カートのテーブルに直接書き込む
+# cache: 操作中のカートを 'carts' キャッシュに置き、まとめてテーブルに書き出す
+CART_REPOSITORY = os.environ.get('CART_REPOSITORY', 'database')
+CART_CACHE_BACKEND = os.environ.get('CART_CACHE_BACKEND', 'locmem')
+CART_CACHE_LOCATION = os.environ.get('CART_CACHE_LOCATION', 'carts')
+CART_CACHE_TIMEOUT = int(os.environ.get('CART_CACHE_TIMEOUT', 60 * 60 * 24 * 7))
+# 変更されたカートをテーブルに書き出す間隔（秒）
+CART_FLUSH_INTERVAL = int(os.environ.get('CART_FLUSH_INTERVAL', 30))
+if CART_REPOSITORY == 'cache' and CART_CACHE_BACKEND == 'locmem' and not DEBUG:
+    # locmem はプロセスごとに別のカートを持ち、落ちると書き出す前の変更が失われる
+    raise ImproperlyConfigured(
+        'CART_REPOSITORY=cache には、プロセス間で共有するキャッシュ'
+        '（CART_CACHE_BACKEND=file か redis）を指定してください'
+    )
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fragments': {
+        'BACKEND': CACHE_BACKENDS[FRAGMENT_CACHE_BACKEND],
+        'LOCATION': FRAGMENT_CACHE_LOCATION,
+        'TIMEOUT': FRAGMENT_CACHE_TIMEOUT,
+    },
+    'carts': {
+        'BACKEND': CACHE_BACKENDS[CART_CACHE_BACKEND],
+        'LOCATION': CART_CACHE_LOCATION,
+        'TIMEOUT': CART_CACHE_TIMEOUT,
+    },
+}
+if CART_CACHE_BACKEND != 'redis':
+    # 書き出し前のカートが追い出されないよう、保持件数の上限を上げる
+    CACHES['carts']['OPTIONS'] = {'MAX_ENTRIES': 100000}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -227,3 +276,19 @@ else:
 STRIPE_PUBLIC_KEY = os.environ.get('STRIPE_PUBLIC_KEY', 'your_stripe_public_key')
 STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY', 'your_stripe_secret_key')
 STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', 'your_stripe_webhook_secret')
+
+# Stripe APIの呼び出し（shop/stripe_gateway.py）
+# ローカルで負荷試験をするときは fake_stripe_server コマンドのURLに向ける
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE', 'https://api.stripe.com')
+# 1回の呼び出しのタイムアウト（秒）と、失敗したときの再試行回数
+STRIPE_TIMEOUT = float(os.environ.get('STRIPE_TIMEOUT', 10))
+STRIPE_MAX_RETRIES = int(os.environ.get('STRIPE_MAX_RETRIES', 2))
+# Stripeを呼び出すスレッドの上限（プロセスごと）
+STRIPE_POOL_SIZE = int(os.environ.get('STRIPE_POOL_SIZE', 8))
+# この回数続けて接続に失敗したら、STRIPE_CIRCUIT_RESET_TIMEOUT 秒のあいだ呼び出しを止める
+STRIPE_CIRCUIT_THRESHOLD = int(os.environ.get('STRIPE_CIRCUIT_THRESHOLD', 5))
+STRIPE_CIRCUIT_RESET_TIMEOUT = float(os.environ.get('STRIPE_CIRCUIT_RESET_TIMEOUT', 30))
+
+# 決済ページを作ってから在庫を取り置いておく時間（秒）
+# Stripe Checkoutの有効期限にも使うので、30分より長く24時間以下にすること
+STOCK_RESERVATION_TTL = int(os.environ.get('STOCK_RESERVATION_TTL', 60 * 60))
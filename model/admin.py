@@ -1,13 +1,19 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.db.models import Prefetch
 
 from model.models import (
     Cart,
     CartItem,
+    DailyProductSales,
+    DailySales,
     FavoriteTea,
     Order,
     OrderItem,
     ShippingFee,
+    StockReservation,
+    StripeEvent,
+    StripePrice,
     TaxRate,
     Tea,
     TeaProduct,
@@ -114,7 +120,19 @@ class TeaProductAdmin(admin.ModelAdmin):
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 0
-    readonly_fields = ["product", "quantity", "price", "subtotal"]
+    # 商品を辿らず、注文明細に保存した購入時の値だけを表示する
+    fields = ["tea_name", "weight", "quantity", "price", "price_with_tax", "subtotal"]
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class StockReservationInline(admin.TabularInline):
+    model = StockReservation
+    extra = 0
+    can_delete = False
+    readonly_fields = ["product", "quantity", "status", "expires_at", "updated_at"]
 
 
 @admin.register(Order)
@@ -140,8 +158,9 @@ class OrderAdmin(admin.ModelAdmin):
         "tax_rate",
         "stripe_checkout_session_id",
         "stripe_payment_intent_id",
+        "paid_at",
     ]
-    inlines = [OrderItemInline]
+    inlines = [OrderItemInline, StockReservationInline]
 
     fieldsets = (
         ("注文情報", {"fields": ("order_number", "user", "status")}),
@@ -154,6 +173,7 @@ class OrderAdmin(admin.ModelAdmin):
                     "tax_amount",
                     "shipping_fee",
                     "total_amount",
+                    "paid_at",
                 )
             },
         ),
@@ -175,6 +195,78 @@ class OrderAdmin(admin.ModelAdmin):
     )
 
 
+@admin.register(StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = [
+        "event_id",
+        "event_type",
+        "checkout_session_id",
+        "status",
+        "attempts",
+        "next_attempt_at",
+        "received_at",
+        "processed_at",
+    ]
+    list_filter = ["status", "event_type"]
+    search_fields = ["event_id", "checkout_session_id"]
+    readonly_fields = ["event_id", "event_type", "checkout_session_id", "payload"]
+
+
+@admin.register(StripePrice)
+class StripePriceAdmin(admin.ModelAdmin):
+    list_display = ["lookup_key", "unit_amount", "stripe_price_id", "created_at"]
+    search_fields = ["lookup_key", "stripe_price_id"]
+    readonly_fields = [
+        "lookup_key",
+        "product",
+        "unit_amount",
+        "stripe_product_id",
+        "stripe_price_id",
+    ]
+
+
+@admin.register(DailySales)
+class DailySalesAdmin(admin.ModelAdmin):
+    list_display = [
+        "day",
+        "order_count",
+        "units",
+        "subtotal",
+        "tax_amount",
+        "shipping_fee",
+        "total_amount",
+    ]
+    date_hierarchy = "day"
+
+    # 集計は注文から作るので、管理画面では編集しない
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(DailyProductSales)
+class DailyProductSalesAdmin(admin.ModelAdmin):
+    list_display = [
+        "day",
+        "product_name",
+        "product_id",
+        "steam_type",
+        "units",
+        "subtotal",
+    ]
+    list_filter = ["steam_type"]
+    search_fields = ["product_name"]
+    date_hierarchy = "day"
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 class CartItemInline(admin.TabularInline):
     model = CartItem
     extra = 0
@@ -185,3 +277,14 @@ class CartAdmin(admin.ModelAdmin):
     list_display = ["user", "item_count", "subtotal", "total_amount", "updated_at"]
     search_fields = ["user__email"]
     inlines = [CartItemInline]
+
+    def get_queryset(self, request):
+        # 一覧の金額計算で明細と商品を行ごとに取得しないようにまとめて読み込む
+        return (
+            super()
+            .get_queryset(request)
+            .select_related("user")
+            .prefetch_related(
+                Prefetch("items", queryset=CartItem.objects.select_related("product"))
+            )
+        )
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ModelConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'model'
+
+    def ready(self):
+        from model import signals  # noqa: F401
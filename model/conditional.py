@@ -0,0 +1,40 @@
+"""条件付きGET（ETag / Last-Modified）用のヘルパー
+
+ページを描画する前に、更新日時やバージョン番号だけからETagを計算する。
+ブラウザが送ってきたETagと一致すれば、ビューを実行せずに304を返す。
+"""
+
+import hashlib
+
+from django.contrib.messages import get_messages
+
+
+def has_pending_messages(request):
+    """表示待ちのメッセージがあるか（メッセージは既読にしない）"""
+    return len(get_messages(request)) > 0
+
+
+def make_etag(request, *parts):
+    """ページの内容を決める値からETagを作る
+
+    ナビゲーションに出るユーザー情報と、フォームに埋め込むCSRFトークンの
+    元になる値も含める。表示待ちのメッセージがある場合はETagを付けない。
+    """
+    if has_pending_messages(request):
+        return None
+
+    user = request.user
+    values = [
+        user.pk,
+        getattr(user, "nickname", ""),
+        request.META.get("CSRF_COOKIE", ""),
+        *parts,
+    ]
+    return hashlib.sha256(repr(values).encode()).hexdigest()[:32]
+
+
+def last_modified(request, timestamp):
+    """Last-Modified用の日時（表示待ちのメッセージがある場合は付けない）"""
+    if has_pending_messages(request):
+        return None
+    return timestamp
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from model.models import OrderItem
+
+
+class Command(BaseCommand):
+    help = (
+        "購入時の商品情報（お茶名・重量・税込単価）がまだ入っていない注文明細に、"
+        "商品と注文の税率から値を入れる（一定件数ずつ処理する）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=1000, help="1回に更新する注文明細の数"
+        )
+
+    def handle(self, *args, **options):
+        items = (
+            OrderItem.objects.filter(tea_name="", product__isnull=False)
+            .select_related("product__tea", "order")
+            .only(
+                "price",
+                "product__weight",
+                "product__tea__name",
+                "order__tax_rate",
+            )
+            .order_by("pk")
+        )
+        total = 0
+        last_pk = 0
+        while True:
+            batch = list(items.filter(pk__gt=last_pk)[: options["batch_size"]])
+            if not batch:
+                break
+            for item in batch:
+                item.tea_name = item.product.tea.name
+                item.weight = item.product.weight
+                # 商品の今の価格ではなく、注文時の税抜単価と税率から計算する
+                item.price_with_tax = int(item.price * (1 + item.order.tax_rate / 100))
+            with transaction.atomic():
+                OrderItem.objects.bulk_update(
+                    batch, ["tea_name", "weight", "price_with_tax"]
+                )
+            total += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write(f"{total}件更新しました")
+
+        self.stdout.write(
+            self.style.SUCCESS(f"{total}件の注文明細に購入時の商品情報を入れました")
+        )
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from model.models import CatalogEntry, Tea
+from model.signals import catalog_entry_changed
+
+
+class Command(BaseCommand):
+    help = "お茶一覧用の読み取りモデルを全件作り直す"
+
+    def handle(self, *args, **options):
+        listed = 0
+        # お気に入り数も数え直すため、一度すべて削除してから作り直す
+        with transaction.atomic():
+            CatalogEntry.objects.all().delete()
+            tea_ids = Tea.objects.order_by("pk").values_list("pk", flat=True)
+            for tea_id in tea_ids.iterator():
+                if CatalogEntry.refresh(tea_id) is not None:
+                    listed += 1
+            catalog_entry_changed.send(sender=CatalogEntry, tea_id=None)
+
+        self.stdout.write(self.style.SUCCESS(f"{listed}件のお茶を一覧に反映しました"))
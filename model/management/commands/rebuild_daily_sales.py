@@ -0,0 +1,31 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from model.models import DailySales
+
+
+class Command(BaseCommand):
+    help = (
+        "日別売上と日別商品売上を注文から作り直す"
+        "（期間を省略するとすべての期間。支払い日で集計する）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--date-from", type=date.fromisoformat, help="支払い日（から） YYYY-MM-DD"
+        )
+        parser.add_argument(
+            "--date-to", type=date.fromisoformat, help="支払い日（まで） YYYY-MM-DD"
+        )
+
+    def handle(self, *args, **options):
+        if (
+            options["date_from"]
+            and options["date_to"]
+            and options["date_from"] > options["date_to"]
+        ):
+            raise CommandError("支払い日の範囲が正しくありません")
+
+        days = DailySales.rebuild(options["date_from"], options["date_to"])
+        self.stdout.write(self.style.SUCCESS(f"{days}日分の売上を作り直しました"))
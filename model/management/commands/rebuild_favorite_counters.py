@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from model.models import CatalogEntry, FavoriteTea, TeaFavoriteCounter
+
+
+class Command(BaseCommand):
+    help = (
+        "お気に入り数カウンターをお気に入りテーブルから作り直す（--verifyで検証のみ）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="作り直さずに、カウンターとお気に入りテーブルの差異を表示する",
+        )
+
+    def handle(self, *args, **options):
+        if options["verify"]:
+            self.verify()
+        else:
+            self.rebuild()
+
+    def source_counts(self):
+        rows = FavoriteTea.objects.values("tea_id").annotate(total=Count("pk"))
+        return {row["tea_id"]: row["total"] for row in rows}
+
+    def rebuild(self):
+        counts = self.source_counts()
+        with transaction.atomic():
+            TeaFavoriteCounter.objects.all().delete()
+            TeaFavoriteCounter.objects.bulk_create(
+                [
+                    TeaFavoriteCounter(tea_id=tea_id, shard=0, count=total)
+                    for tea_id, total in counts.items()
+                ],
+                batch_size=1000,
+            )
+            CatalogEntry.refresh_favorites_counts()
+        self.stdout.write(
+            self.style.SUCCESS(f"{len(counts)}件のお茶のカウンターを作り直しました")
+        )
+
+    def verify(self):
+        expected = self.source_counts()
+        rows = TeaFavoriteCounter.objects.values("tea_id").annotate(total=Sum("count"))
+        actual = {row["tea_id"]: row["total"] for row in rows}
+
+        mismatches = []
+        for tea_id in sorted(expected.keys() | actual.keys()):
+            if expected.get(tea_id, 0) != actual.get(tea_id, 0):
+                mismatches.append(tea_id)
+                self.stdout.write(
+                    f"tea_id={tea_id}: カウンター {actual.get(tea_id, 0)}件 / "
+                    f"お気に入り {expected.get(tea_id, 0)}件"
+                )
+
+        if mismatches:
+            raise CommandError(f"{len(mismatches)}件のお茶でお気に入り数が一致しません")
+        self.stdout.write(self.style.SUCCESS("お気に入り数はすべて一致しています"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from model.models import TeaRatingSummary, TeaReview
+
+
+class Command(BaseCommand):
+    help = "お茶ごとのレビュー集計をレビューテーブルから作り直す"
+
+    def handle(self, *args, **options):
+        tea_ids = set(TeaReview.objects.values_list("tea_id", flat=True).distinct())
+        TeaRatingSummary.objects.exclude(tea_id__in=tea_ids).delete()
+        for tea_id in sorted(tea_ids):
+            TeaRatingSummary.rebuild(tea_id)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"{len(tea_ids)}件のお茶のレビュー集計を作り直しました")
+        )
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from model.models import StockReservation
+
+
+class Command(BaseCommand):
+    help = "期限切れの在庫の取り置きを解放し、支払い待ちのままの注文をキャンセルにする"
+
+    def handle(self, *args, **options):
+        released, cancelled = StockReservation.release_expired()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{released}件の取り置きを在庫に戻し、{cancelled}件の注文をキャンセルしました"
+            )
+        )
@@ -0,0 +1,65 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_catalog_entries(apps, schema_editor):
+    Tea = apps.get_model('model', 'Tea')
+    TeaProduct = apps.get_model('model', 'TeaProduct')
+    FavoriteTea = apps.get_model('model', 'FavoriteTea')
+    CatalogEntry = apps.get_model('model', 'CatalogEntry')
+
+    for tea in Tea.objects.filter(published_at__isnull=False).iterator():
+        products = list(
+            TeaProduct.objects.filter(tea=tea, is_available=True)
+            .order_by('weight')
+            .values('id', 'weight', 'price')
+        )
+        if not products:
+            continue
+        CatalogEntry.objects.create(
+            tea=tea,
+            name=tea.name,
+            image=tea.image.name,
+            steam_type=tea.steam_type,
+            origin=tea.origin,
+            description=tea.description,
+            caffeine_free=tea.caffeine_free,
+            published_at=tea.published_at,
+            products=products,
+            favorites_count=FavoriteTea.objects.filter(tea=tea).count(),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0003_alter_favoritetea_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogEntry',
+            fields=[
+                ('tea', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='catalog_entry', serialize=False, to='model.tea', verbose_name='お茶')),
+                ('name', models.CharField(max_length=100, verbose_name='お茶名')),
+                ('image', models.ImageField(blank=True, null=True, upload_to='photos/')),
+                ('steam_type', models.CharField(choices=[('light', '浅蒸し'), ('middle', '中蒸し'), ('deep', '深蒸し')], max_length=20, verbose_name='蒸し度')),
+                ('origin', models.CharField(blank=True, max_length=100, verbose_name='産地')),
+                ('description', models.TextField(blank=True, verbose_name='説明')),
+                ('caffeine_free', models.BooleanField(default=False, verbose_name='カフェインレス')),
+                ('published_at', models.DateTimeField(verbose_name='公開日時')),
+                ('products', models.JSONField(default=list, help_text='販売中の商品の重量と価格（税抜）の一覧', verbose_name='販売中の商品')),
+                ('favorites_count', models.IntegerField(default=0, verbose_name='お気に入り数')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+            options={
+                'verbose_name': 'お茶一覧',
+                'verbose_name_plural': 'お茶一覧',
+                'db_table': 'catalog_entries',
+                'indexes': [models.Index(fields=['published_at', 'tea'], name='catalog_published_idx')],
+            },
+        ),
+        migrations.RunPython(populate_catalog_entries, migrations.RunPython.noop),
+    ]
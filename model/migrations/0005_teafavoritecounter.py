@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_favorite_counters(apps, schema_editor):
+    FavoriteTea = apps.get_model('model', 'FavoriteTea')
+    TeaFavoriteCounter = apps.get_model('model', 'TeaFavoriteCounter')
+
+    rows = FavoriteTea.objects.values('tea_id').annotate(total=models.Count('pk'))
+    TeaFavoriteCounter.objects.bulk_create(
+        [
+            TeaFavoriteCounter(tea_id=row['tea_id'], shard=0, count=row['total'])
+            for row in rows
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0004_catalogentry'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='catalogentry',
+            name='favorites_count',
+        ),
+        migrations.CreateModel(
+            name='TeaFavoriteCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField(verbose_name='シャード番号')),
+                ('count', models.IntegerField(default=0, verbose_name='お気に入り数')),
+                ('tea', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='favorite_counters', to='model.tea')),
+            ],
+            options={
+                'verbose_name': 'お気に入り数カウンター',
+                'verbose_name_plural': 'お気に入り数カウンター',
+                'db_table': 'tea_favorite_counters',
+                'unique_together': {('tea', 'shard')},
+            },
+        ),
+        migrations.RunPython(populate_favorite_counters, migrations.RunPython.noop),
+    ]
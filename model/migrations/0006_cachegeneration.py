@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0005_teafavoritecounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheGeneration',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False, verbose_name='名前')),
+                ('value', models.BigIntegerField(default=0, verbose_name='世代番号')),
+            ],
+            options={
+                'verbose_name': 'キャッシュ世代',
+                'verbose_name_plural': 'キャッシュ世代',
+                'db_table': 'cache_generations',
+            },
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_rating_summaries(apps, schema_editor):
+    TeaReview = apps.get_model('model', 'TeaReview')
+    TeaRatingSummary = apps.get_model('model', 'TeaRatingSummary')
+
+    rows = TeaReview.objects.values('tea_id').annotate(
+        review_count=models.Count('pk'),
+        rating_total=models.Sum('rating'),
+        **{
+            f'rating_{rating}': models.Count('pk', filter=models.Q(rating=rating))
+            for rating in range(1, 6)
+        },
+    )
+    TeaRatingSummary.objects.bulk_create(
+        [TeaRatingSummary(**row) for row in rows],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0006_cachegeneration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeaRatingSummary',
+            fields=[
+                ('tea', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rating_summary', serialize=False, to='model.tea', verbose_name='お茶')),
+                ('review_count', models.IntegerField(default=0, verbose_name='レビュー件数')),
+                ('rating_total', models.IntegerField(default=0, verbose_name='評価の合計')),
+                ('rating_1', models.IntegerField(default=0, verbose_name='★1の件数')),
+                ('rating_2', models.IntegerField(default=0, verbose_name='★2の件数')),
+                ('rating_3', models.IntegerField(default=0, verbose_name='★3の件数')),
+                ('rating_4', models.IntegerField(default=0, verbose_name='★4の件数')),
+                ('rating_5', models.IntegerField(default=0, verbose_name='★5の件数')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+            options={
+                'verbose_name': 'レビュー集計',
+                'verbose_name_plural': 'レビュー集計',
+                'db_table': 'tea_rating_summaries',
+            },
+        ),
+        migrations.RunPython(populate_rating_summaries, migrations.RunPython.noop),
+    ]
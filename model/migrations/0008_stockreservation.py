@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0007_tearatingsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(verbose_name='数量')),
+                ('status', models.CharField(choices=[('held', '取り置き中'), ('confirmed', '確定'), ('released', '解放済み')], default='held', max_length=20, verbose_name='ステータス')),
+                ('expires_at', models.DateTimeField(verbose_name='取り置き期限')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='model.order', verbose_name='注文')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='model.teaproduct', verbose_name='商品')),
+            ],
+            options={
+                'verbose_name': '在庫の取り置き',
+                'verbose_name_plural': '在庫の取り置き',
+                'db_table': 'stock_reservations',
+                'indexes': [models.Index(fields=['status', 'expires_at'], name='stock_reser_status_da6fe9_idx')],
+            },
+        ),
+    ]
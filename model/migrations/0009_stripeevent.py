@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0008_stockreservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True, verbose_name='イベントID')),
+                ('event_type', models.CharField(max_length=100, verbose_name='種類')),
+                ('checkout_session_id', models.CharField(blank=True, max_length=200, verbose_name='Checkout Session ID')),
+                ('payload', models.JSONField(verbose_name='イベントの内容')),
+                ('status', models.CharField(choices=[('pending', '未処理'), ('processed', '処理済み'), ('failed', '失敗')], default='pending', max_length=20, verbose_name='ステータス')),
+                ('attempts', models.IntegerField(default=0, verbose_name='失敗回数')),
+                ('last_error', models.TextField(blank=True, verbose_name='最後のエラー')),
+                ('received_at', models.DateTimeField(auto_now_add=True, verbose_name='受信日時')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='処理日時')),
+            ],
+            options={
+                'verbose_name': 'Stripeイベント',
+                'verbose_name_plural': 'Stripeイベント',
+                'db_table': 'stripe_events',
+                'indexes': [models.Index(fields=['status', 'received_at'], name='stripe_even_status_59d023_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('checkout_session_id', ''), _negated=True), fields=('checkout_session_id', 'event_type'), name='stripe_event_session_type_unique')],
+            },
+        ),
+    ]
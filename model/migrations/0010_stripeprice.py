@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0009_stripeevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripePrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lookup_key', models.CharField(max_length=100, unique=True, verbose_name='キー')),
+                ('unit_amount', models.IntegerField(verbose_name='単価(税込)')),
+                ('stripe_product_id', models.CharField(max_length=200, verbose_name='Stripe Product ID')),
+                ('stripe_price_id', models.CharField(max_length=200, verbose_name='Stripe Price ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stripe_prices', to='model.teaproduct', verbose_name='商品')),
+            ],
+            options={
+                'verbose_name': 'Stripe価格',
+                'verbose_name_plural': 'Stripe価格',
+                'db_table': 'stripe_prices',
+            },
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:33
+
+from django.db import migrations, models
+
+# 一度に要約を作る注文の数
+BATCH_SIZE = 1000
+
+
+def summarize_order_items(lines, max_length):
+    """明細 [(お茶の名前, 内容量, 数量), ...] から商品点数と注文内容の要約を作る
+
+    マイグレーションの実行時点の処理を固定するため、model.models の同名の関数を写したもの。
+    """
+    labels = [f'{name} ({weight}g) ×{quantity}' for name, weight, quantity in lines]
+    summary = ''
+    shown = 0
+    for label in labels:
+        candidate = f'{summary}、{label}' if summary else label
+        rest = len(labels) - shown - 1
+        suffix = f' ほか{rest}種類' if rest else ''
+        if len(candidate) + len(suffix) > max_length:
+            break
+        summary = candidate
+        shown += 1
+    if labels and not shown:
+        shown = 1
+        rest = len(labels) - shown
+        suffix = f' ほか{rest}種類' if rest else ''
+        summary = labels[0][: max_length - len(suffix)]
+    rest = len(labels) - shown
+    if rest:
+        summary += f' ほか{rest}種類'
+    return sum(quantity for _, _, quantity in lines), summary
+
+
+def populate_item_summaries(apps, schema_editor):
+    """注文をID順に一定件数ずつ読み、その注文の明細から要約を作る"""
+    Order = apps.get_model('model', 'Order')
+    OrderItem = apps.get_model('model', 'OrderItem')
+    max_length = Order._meta.get_field('item_summary').max_length
+
+    last_pk = 0
+    while True:
+        order_ids = list(
+            Order.objects.filter(pk__gt=last_pk)
+            .order_by('pk')
+            .values_list('pk', flat=True)[:BATCH_SIZE]
+        )
+        if not order_ids:
+            break
+        lines = {}
+        rows = (
+            OrderItem.objects.filter(order_id__in=order_ids)
+            .order_by('order_id', 'pk')
+            .values_list('order_id', 'product__tea__name', 'product__weight', 'quantity')
+        )
+        for order_id, name, weight, quantity in rows:
+            lines.setdefault(order_id, []).append((name, weight, quantity))
+
+        orders = []
+        for order_id, order_lines in lines.items():
+            item_count, item_summary = summarize_order_items(order_lines, max_length)
+            orders.append(
+                Order(pk=order_id, item_count=item_count, item_summary=item_summary)
+            )
+        Order.objects.bulk_update(orders, ['item_count', 'item_summary'])
+        last_pk = order_ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0011_jobcheckpoint_order_status_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.IntegerField(default=0, verbose_name='商品点数'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='item_summary',
+            field=models.CharField(blank=True, max_length=200, verbose_name='注文内容の要約'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at'], name='orders_user_id_51663a_idx'),
+        ),
+        migrations.RunPython(populate_item_summaries, migrations.RunPython.noop),
+    ]
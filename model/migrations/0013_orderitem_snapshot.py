@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# 一度に更新する注文明細の数
+BATCH_SIZE = 1000
+
+
+def snapshot_order_items(apps, schema_editor):
+    """既存の注文明細に、商品と注文の税率から購入時の商品情報を入れる
+
+    商品を削除しても明細が残るように外部キーを変更する前に、すべての明細に値を入れておく。
+    """
+    OrderItem = apps.get_model('model', 'OrderItem')
+    items = (
+        OrderItem.objects.filter(tea_name='')
+        .select_related('product__tea', 'order')
+        .only('price', 'product__weight', 'product__tea__name', 'order__tax_rate')
+        .order_by('pk')
+    )
+    last_pk = 0
+    while True:
+        batch = list(items.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            break
+        for item in batch:
+            item.tea_name = item.product.tea.name
+            item.weight = item.product.weight
+            # 商品の今の価格ではなく、注文時の税抜単価と税率から計算する
+            item.price_with_tax = int(item.price * (1 + item.order.tax_rate / 100))
+        OrderItem.objects.bulk_update(batch, ['tea_name', 'weight', 'price_with_tax'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0012_order_item_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='price_with_tax',
+            field=models.IntegerField(default=0, verbose_name='単価(税込)'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='tea_name',
+            field=models.CharField(blank=True, max_length=100, verbose_name='お茶名'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='weight',
+            field=models.IntegerField(default=0, verbose_name='重量(g)'),
+        ),
+        migrations.RunPython(snapshot_order_items, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='model.teaproduct', verbose_name='商品'),
+        ),
+        migrations.AlterField(
+            model_name='stockreservation',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='model.teaproduct', verbose_name='商品'),
+        ),
+    ]
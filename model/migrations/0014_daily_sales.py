@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:38
+
+from django.db import migrations, models
+
+
+def populate_paid_at(apps, schema_editor):
+    # 支払い日時は記録していなかったので、支払い済みの注文は注文日時で代用する
+    Order = apps.get_model('model', 'Order')
+    Order.objects.filter(
+        status__in=['paid', 'processing', 'shipped', 'delivered'], paid_at__isnull=True
+    ).update(paid_at=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0013_orderitem_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyProductSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='日付')),
+                ('product_name', models.CharField(max_length=120, verbose_name='商品')),
+                ('steam_type', models.CharField(blank=True, choices=[('light', '浅蒸し'), ('middle', '中蒸し'), ('deep', '深蒸し')], max_length=20, verbose_name='蒸し度')),
+                ('units', models.IntegerField(default=0, verbose_name='販売点数')),
+                ('subtotal', models.IntegerField(default=0, verbose_name='小計(税抜)')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+            options={
+                'verbose_name': '日別商品売上',
+                'verbose_name_plural': '日別商品売上',
+                'db_table': 'daily_product_sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True, verbose_name='日付')),
+                ('order_count', models.IntegerField(default=0, verbose_name='注文数')),
+                ('units', models.IntegerField(default=0, verbose_name='販売点数')),
+                ('subtotal', models.IntegerField(default=0, verbose_name='小計(税抜)')),
+                ('tax_amount', models.IntegerField(default=0, verbose_name='消費税額')),
+                ('shipping_fee', models.IntegerField(default=0, verbose_name='送料')),
+                ('total_amount', models.IntegerField(default=0, verbose_name='売上(税込)')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+            options={
+                'verbose_name': '日別売上',
+                'verbose_name_plural': '日別売上',
+                'db_table': 'daily_sales',
+            },
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='paid_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='支払い日時'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['paid_at'], name='orders_paid_at_882cb3_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyproductsales',
+            constraint=models.UniqueConstraint(fields=('day', 'product_name'), name='daily_product_sales_unique'),
+        ),
+        migrations.RunPython(populate_paid_at, migrations.RunPython.noop),
+    ]
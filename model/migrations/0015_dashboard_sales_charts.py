@@ -0,0 +1,95 @@
+from django.db import migrations
+
+# ダッシュボードのグラフ（日別売上の集計表を読む）
+CHARTS = [
+    {
+        'graph_key': 'daily_revenue',
+        'graph_title': '売上',
+        'model_name': 'DailySales',
+        'operation_field_name': 'total_amount,subtotal,tax_amount,shipping_fee',
+        'default_chart_type': 'lineChart',
+    },
+    {
+        'graph_key': 'daily_units',
+        'graph_title': '注文数・販売点数',
+        'model_name': 'DailySales',
+        'operation_field_name': 'order_count,units',
+        'default_chart_type': 'discreteBarChart',
+    },
+    {
+        'graph_key': 'product_sales',
+        'graph_title': '商品別の販売点数',
+        'model_name': 'DailyProductSales',
+        'operation_field_name': 'units,subtotal',
+        'default_chart_type': 'stackedAreaChart',
+        'criteria': ('product_name', 10),
+    },
+    {
+        'graph_key': 'steam_type_sales',
+        'graph_title': '蒸し度別の販売点数',
+        'model_name': 'DailyProductSales',
+        'operation_field_name': 'units,subtotal',
+        'default_chart_type': 'stackedAreaChart',
+        'criteria': ('steam_type', None),
+    },
+]
+
+
+def create_charts(apps, schema_editor):
+    DashboardStats = apps.get_model('admin_tools_stats', 'DashboardStats')
+    DashboardStatsCriteria = apps.get_model('admin_tools_stats', 'DashboardStatsCriteria')
+    CriteriaToStatsM2M = apps.get_model('admin_tools_stats', 'CriteriaToStatsM2M')
+
+    for chart in CHARTS:
+        stats = DashboardStats.objects.create(
+            graph_key=chart['graph_key'],
+            graph_title=chart['graph_title'],
+            model_app_name='model',
+            model_name=chart['model_name'],
+            date_field_name='day',
+            operation_field_name=chart['operation_field_name'],
+            type_operation_field_name='Sum',
+            allowed_type_operation_field_name=['Sum', 'Avg', 'Max'],
+            default_chart_type=chart['default_chart_type'],
+            default_time_period=90,
+            default_time_scale='days',
+            allowed_time_scales=['days', 'weeks', 'months', 'quarters', 'years'],
+        )
+        if 'criteria' not in chart:
+            continue
+        field_name, count_limit = chart['criteria']
+        criteria = DashboardStatsCriteria.objects.create(
+            criteria_name=f"{chart['graph_key']}_{field_name}",
+            dynamic_criteria_field_name=field_name,
+        )
+        CriteriaToStatsM2M.objects.create(
+            criteria=criteria,
+            stats=stats,
+            use_as='multiple_series',
+            # 集計表から期間内の値を選ぶ（注文を読まない）
+            choices_based_on_time_range=True,
+            count_limit=count_limit,
+        )
+
+
+def delete_charts(apps, schema_editor):
+    DashboardStats = apps.get_model('admin_tools_stats', 'DashboardStats')
+    DashboardStatsCriteria = apps.get_model('admin_tools_stats', 'DashboardStatsCriteria')
+
+    graph_keys = [chart['graph_key'] for chart in CHARTS]
+    DashboardStatsCriteria.objects.filter(
+        criteriatostatsm2m__stats__graph_key__in=graph_keys
+    ).delete()
+    DashboardStats.objects.filter(graph_key__in=graph_keys).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0014_daily_sales'),
+        ('admin_tools_stats', '0024_alter_cachedvalue_operation_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_charts, delete_charts),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0015_dashboard_sales_charts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogChange',
+            fields=[
+                ('generation', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='世代番号')),
+                ('tea_id', models.IntegerField(blank=True, null=True, verbose_name='お茶ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='登録日時')),
+            ],
+            options={
+                'verbose_name': 'お茶一覧の変更履歴',
+                'verbose_name_plural': 'お茶一覧の変更履歴',
+                'db_table': 'catalog_changes',
+            },
+        ),
+    ]
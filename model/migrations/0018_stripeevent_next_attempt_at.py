@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:51
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0017_dirtycart'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='stripeevent',
+            name='stripe_event_session_type_unique',
+        ),
+        migrations.AddField(
+            model_name='stripeevent',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='次に反映する日時'),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:54
+
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+# 売上に数える注文のステータス（マイグレーションの実行時点の Order.SALES_STATUSES）
+SALES_STATUSES = ['paid', 'processing', 'shipped', 'delivered']
+
+
+def rebuild_product_sales(apps, schema_editor):
+    """商品別の売上を注文から作り直し、既存の行にも商品IDを入れる
+
+    集計はデータベースで行い、商品ID・お茶名・重量・蒸し度ごとの行だけを読み込む。
+    """
+    OrderItem = apps.get_model('model', 'OrderItem')
+    DailyProductSales = apps.get_model('model', 'DailyProductSales')
+
+    rows = (
+        OrderItem.objects.filter(
+            order__paid_at__isnull=False, order__status__in=SALES_STATUSES
+        )
+        .annotate(day=TruncDate('order__paid_at'))
+        .values('day', 'product_id', 'tea_name', 'weight', 'product__tea__steam_type')
+        .annotate(
+            units=models.Sum('quantity'),
+            subtotal=models.Sum(models.F('price') * models.F('quantity')),
+        )
+        .order_by()
+    )
+    lines = {}
+    for row in rows.iterator():
+        key = (
+            row['day'],
+            row['product_id'] or 0,
+            f"{row['tea_name']} ({row['weight']}g)",
+            row['product__tea__steam_type'] or '',
+        )
+        line = lines.setdefault(key, {'units': 0, 'subtotal': 0})
+        line['units'] += row['units']
+        line['subtotal'] += row['subtotal']
+
+    DailyProductSales.objects.all().delete()
+    DailyProductSales.objects.bulk_create(
+        [
+            DailyProductSales(
+                day=day,
+                product_id=product_id,
+                product_name=product_name,
+                steam_type=steam_type,
+                **line,
+            )
+            for (day, product_id, product_name, steam_type), line in lines.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0018_stripeevent_next_attempt_at'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='dailyproductsales',
+            name='daily_product_sales_unique',
+        ),
+        migrations.AddField(
+            model_name='dailyproductsales',
+            name='product_id',
+            field=models.IntegerField(default=0, verbose_name='商品ID'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyproductsales',
+            constraint=models.UniqueConstraint(fields=('day', 'product_id', 'product_name', 'steam_type'), name='daily_product_sales_unique'),
+        ),
+        migrations.RunPython(rebuild_product_sales, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:02
+
+from django.db import migrations, models
+from django.db.models.functions import Cast, Concat
+
+# 0015_dashboard_sales_charts で作った商品別のグラフの絞り込み条件
+CRITERIA_NAME = 'product_sales_product_name'
+
+
+def fill_product_labels(apps, schema_editor):
+    """既存の行にグラフの表示名（商品名 #商品ID）を入れる"""
+    DailyProductSales = apps.get_model('model', 'DailyProductSales')
+    DailyProductSales.objects.filter(product_id=0).update(
+        product_label=models.F('product_name')
+    )
+    DailyProductSales.objects.exclude(product_id=0).update(
+        product_label=Concat(
+            'product_name',
+            models.Value(' #'),
+            Cast('product_id', models.CharField()),
+            output_field=models.CharField(),
+        )
+    )
+
+
+def set_criteria_field(field_name):
+    def set_field(apps, schema_editor):
+        DashboardStatsCriteria = apps.get_model(
+            'admin_tools_stats', 'DashboardStatsCriteria'
+        )
+        CachedValue = apps.get_model('admin_tools_stats', 'CachedValue')
+        DashboardStatsCriteria.objects.filter(criteria_name=CRITERIA_NAME).update(
+            dynamic_criteria_field_name=field_name
+        )
+        # 古い系列で集計した値を使わない
+        CachedValue.objects.filter(stats__graph_key='product_sales').delete()
+
+    return set_field
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0019_dailyproductsales_product_id'),
+        ('admin_tools_stats', '0024_alter_cachedvalue_operation_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailyproductsales',
+            name='product_label',
+            field=models.CharField(blank=True, max_length=140, verbose_name='グラフの表示名'),
+        ),
+        migrations.RunPython(fill_product_labels, migrations.RunPython.noop),
+        # 商品別のグラフを、同じ名前のお茶も別の系列になる表示名でまとめる
+        migrations.RunPython(
+            set_criteria_field('product_label'), set_criteria_field('product_name')
+        ),
+    ]
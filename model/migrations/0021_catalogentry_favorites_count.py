@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:07
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def fill_favorites_counts(apps, schema_editor):
+    """既存の行にお気に入り数カウンターの合計を入れる"""
+    CatalogEntry = apps.get_model('model', 'CatalogEntry')
+    TeaFavoriteCounter = apps.get_model('model', 'TeaFavoriteCounter')
+    totals = (
+        TeaFavoriteCounter.objects.filter(tea_id=models.OuterRef('tea_id'))
+        .values('tea_id')
+        .annotate(total=models.Sum('count'))
+        .values('total')
+    )
+    CatalogEntry.objects.update(favorites_count=Coalesce(models.Subquery(totals), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0020_dailyproductsales_product_label'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='catalogentry',
+            name='favorites_count',
+            field=models.IntegerField(default=0, help_text='お気に入り数カウンターの全シャードの合計', verbose_name='お気に入り数'),
+        ),
+        migrations.RunPython(fill_favorites_counts, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,17 @@
+import bisect
+import random
+import threading
+import time
 import uuid
+from array import array
 from datetime import timedelta
 
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.db import models
+from django.core.cache import cache
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models.functions import Coalesce, TruncDate
 from django.utils import timezone
+from django.utils.functional import cached_property
 
 from config import settings
 
@@ -134,6 +142,140 @@ class User(AbstractUser):
         return timezone.now() < expiry_time
 
 
+class CacheGeneration(models.Model):
+    """キャッシュの世代番号（プロセスをまたいでキャッシュを無効化するために使う）"""
+
+    name = models.CharField(max_length=50, primary_key=True, verbose_name="名前")
+    value = models.BigIntegerField(default=0, verbose_name="世代番号")
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+    @classmethod
+    def get_value(cls, name):
+        """現在の世代番号を取得"""
+        value = cls.objects.filter(name=name).values_list("value", flat=True).first()
+        return value or 0
+
+    @classmethod
+    def bump(cls, name):
+        """世代番号を1つ進め、進めた後の値を返す"""
+        generations = cls.objects.filter(name=name)
+        if not generations.update(value=models.F("value") + 1):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(name=name, value=1)
+            except IntegrityError:
+                generations.update(value=models.F("value") + 1)
+        return cls.get_value(name)
+
+    class Meta:
+        db_table = "cache_generations"
+        verbose_name = "キャッシュ世代"
+        verbose_name_plural = "キャッシュ世代"
+
+
+class JobCheckpoint(models.Model):
+    """繰り返し実行するバッチ処理の進み具合"""
+
+    name = models.CharField(max_length=50, primary_key=True, verbose_name="名前")
+    position = models.JSONField(default=dict, verbose_name="位置")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
+
+    def __str__(self):
+        return f"{self.name}: {self.position}"
+
+    @classmethod
+    def get_position(cls, name):
+        """前回の続きの位置を取得（はじめてなら空の辞書）"""
+        position = cls.objects.filter(name=name).values_list("position", flat=True)
+        return position.first() or {}
+
+    @classmethod
+    def set_position(cls, name, position):
+        cls.objects.update_or_create(name=name, defaults={"position": position})
+
+    class Meta:
+        db_table = "job_checkpoints"
+        verbose_name = "バッチ処理の進み具合"
+        verbose_name_plural = "バッチ処理の進み具合"
+
+
+class GenerationCache:
+    """世代番号で無効化するプロセス内キャッシュ
+
+    読み込んだ値を持っておき、数秒おきに世代番号を確認して変わっていれば読み込み直す。
+    元のデータを変更したら invalidate() で世代番号を進め、全プロセスのキャッシュを無効化する。
+    """
+
+    # 世代番号を確認する間隔（秒）
+    CHECK_INTERVAL = 5
+
+    def __init__(self, generation_name, load):
+        self.generation_name = generation_name
+        # キャッシュする値を読み込む関数
+        self.load = load
+        self._lock = threading.Lock()
+        # (世代番号, 値, 世代番号を確認した時刻)
+        self._state = None
+
+    def get_value(self):
+        """キャッシュした値を取得"""
+        state = self._state
+        if state is not None and time.monotonic() - state[2] < self.CHECK_INTERVAL:
+            return state[1]
+
+        with self._lock:
+            state = self._state
+            if state is None or time.monotonic() - state[2] >= self.CHECK_INTERVAL:
+                generation = CacheGeneration.get_value(self.generation_name)
+                if state is None or state[0] != generation:
+                    state = (generation, self.load(), time.monotonic())
+                else:
+                    state = (*state[:2], time.monotonic())
+                self._state = state
+            return state[1]
+
+    def invalidate(self):
+        """世代番号を進めて全プロセスのキャッシュを無効化"""
+        CacheGeneration.bump(self.generation_name)
+        transaction.on_commit(self.clear)
+
+    def clear(self):
+        """このプロセスのキャッシュを捨てる"""
+        with self._lock:
+            self._state = None
+
+
+class EffectiveDatedCache(GenerationCache):
+    """適用開始日ごとの設定（税率・送料）のプロセス内キャッシュ
+
+    有効な設定を適用開始日の昇順ですべて読み込んでおき、日付から bisect で引く。
+    未来の適用開始日の設定も持っておくので、日付が変わると再起動なしで切り替わる。
+    """
+
+    def __init__(self, generation_name, load):
+        # load は [(適用開始日, 値), ...] を適用開始日の昇順で返す関数
+        super().__init__(generation_name, lambda: self.split_periods(load()))
+
+    @staticmethod
+    def split_periods(periods):
+        """(適用開始日のリスト, 値のリスト) に分ける"""
+        return (
+            [start_date for start_date, _ in periods],
+            [value for _, value in periods],
+        )
+
+    def get(self, day=None, default=None):
+        """日付（省略時は今日）に適用される値を取得"""
+        day = day or timezone.localdate()
+        start_dates, values = self.get_value()
+        position = bisect.bisect_right(start_dates, day)
+        if position == 0:
+            return default
+        return values[position - 1]
+
+
 class Tea(models.Model):
     """お茶マスタ"""
 
@@ -163,6 +305,70 @@ class Tea(models.Model):
         db_table = "teas"
 
 
+class TeaFavoriteCounter(models.Model):
+    """お茶ごとのお気に入り数カウンター
+
+    人気のお茶で更新が1行に集中しないよう、SHARD_COUNT個の行に分けて加算する。
+    お気に入り数は全シャードの合計。
+    """
+
+    SHARD_COUNT = 8
+
+    tea = models.ForeignKey(
+        Tea, on_delete=models.CASCADE, related_name="favorite_counters"
+    )
+    shard = models.PositiveSmallIntegerField(verbose_name="シャード番号")
+    count = models.IntegerField(default=0, verbose_name="お気に入り数")
+
+    def __str__(self):
+        return f"{self.tea_id} [{self.shard}]: {self.count}"
+
+    @classmethod
+    def increment(cls, tea_id, delta=1):
+        """ランダムなシャードのお気に入り数を増減する"""
+        shard = random.randrange(cls.SHARD_COUNT)
+        counters = cls.objects.filter(tea_id=tea_id, shard=shard)
+        if counters.update(count=models.F("count") + delta):
+            return
+
+        if delta < 0:
+            # 減算は既存のいずれかのシャードに対して行う（合計が合えばよい）
+            existing = cls.objects.filter(tea_id=tea_id).values("pk")[:1]
+            cls.objects.filter(pk__in=existing).update(count=models.F("count") + delta)
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(tea_id=tea_id, shard=shard, count=delta)
+        except IntegrityError:
+            # 同時に同じシャードが作成された場合は加算し直す
+            counters.update(count=models.F("count") + delta)
+
+    @classmethod
+    def get_count(cls, tea_id):
+        """お茶のお気に入り数を取得"""
+        total = cls.objects.filter(tea_id=tea_id).aggregate(total=models.Sum("count"))[
+            "total"
+        ]
+        return total or 0
+
+    @classmethod
+    def get_counts(cls, tea_ids):
+        """複数のお茶のお気に入り数を {tea_id: 件数} で取得"""
+        rows = (
+            cls.objects.filter(tea_id__in=tea_ids)
+            .values("tea_id")
+            .annotate(total=models.Sum("count"))
+        )
+        return {row["tea_id"]: row["total"] for row in rows}
+
+    class Meta:
+        db_table = "tea_favorite_counters"
+        verbose_name = "お気に入り数カウンター"
+        verbose_name_plural = "お気に入り数カウンター"
+        unique_together = ["tea", "shard"]
+
+
 class FavoriteTea(models.Model):
     """お気に入りテーブル（ユーザーとお茶の中間テーブル）"""
 
@@ -181,6 +387,53 @@ class FavoriteTea(models.Model):
     def __str__(self):
         return f"{self.user} → {self.tea}"
 
+    # ユーザーごとのお気に入りID一覧のキャッシュ保持期間（秒）
+    TEA_IDS_CACHE_TIMEOUT = 60 * 60 * 24
+
+    @staticmethod
+    def _tea_ids_cache_key(user_id):
+        return f"favorite_tea_ids:{user_id}"
+
+    @classmethod
+    def get_tea_ids(cls, user_id):
+        """ユーザーのお気に入りのお茶IDを集合で取得（キャッシュ済み）
+
+        キャッシュにはソート済みの整数配列をバイト列で保持し、
+        お気に入りが変更されるたびにバージョンを切り替えて無効化する。
+        """
+        key = cls._tea_ids_cache_key(user_id)
+        version = cls.get_tea_ids_version(user_id)
+
+        data = cache.get(key, version=version)
+        if data is None:
+            tea_ids = array(
+                "q",
+                cls.objects.filter(user_id=user_id)
+                .order_by("tea_id")
+                .values_list("tea_id", flat=True),
+            )
+            cache.set(
+                key, tea_ids.tobytes(), cls.TEA_IDS_CACHE_TIMEOUT, version=version
+            )
+        else:
+            tea_ids = array("q")
+            tea_ids.frombytes(data)
+        return frozenset(tea_ids)
+
+    @classmethod
+    def get_tea_ids_version(cls, user_id):
+        """お気に入りID一覧のバージョン（お気に入りを変更するたびに変わる）
+
+        キャッシュはプロセスごとなので、バージョンは全プロセスで共有する
+        CacheGeneration に持つ。
+        """
+        return CacheGeneration.get_value(cls._tea_ids_cache_key(user_id))
+
+    @classmethod
+    def invalidate_tea_ids(cls, user_id):
+        """お気に入りID一覧のキャッシュを無効化（変更と同じトランザクションで進める）"""
+        CacheGeneration.bump(cls._tea_ids_cache_key(user_id))
+
 
 class TeaReview(models.Model):
     """お茶に対するレビュー"""
@@ -212,6 +465,99 @@ class TeaReview(models.Model):
         return "★" * self.rating + "☆" * (5 - self.rating)
 
 
+class TeaRatingSummary(models.Model):
+    """お茶ごとのレビュー集計（件数・合計・評価別の件数）"""
+
+    tea = models.OneToOneField(
+        Tea,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="rating_summary",
+        verbose_name="お茶",
+    )
+    review_count = models.IntegerField(default=0, verbose_name="レビュー件数")
+    rating_total = models.IntegerField(default=0, verbose_name="評価の合計")
+    rating_1 = models.IntegerField(default=0, verbose_name="★1の件数")
+    rating_2 = models.IntegerField(default=0, verbose_name="★2の件数")
+    rating_3 = models.IntegerField(default=0, verbose_name="★3の件数")
+    rating_4 = models.IntegerField(default=0, verbose_name="★4の件数")
+    rating_5 = models.IntegerField(default=0, verbose_name="★5の件数")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
+
+    def __str__(self):
+        return f"{self.tea_id}: {self.average_rating} ({self.review_count}件)"
+
+    @property
+    def average_rating(self):
+        """平均評価（小数第1位まで）"""
+        if not self.review_count:
+            return None
+        return round(self.rating_total / self.review_count, 1)
+
+    @property
+    def histogram(self):
+        """評価別の件数と割合（★5から順に）"""
+        rows = []
+        for rating in range(5, 0, -1):
+            count = getattr(self, f"rating_{rating}")
+            percent = round(count * 100 / self.review_count) if self.review_count else 0
+            rows.append({"rating": rating, "count": count, "percent": percent})
+        return rows
+
+    @classmethod
+    def get_for_tea(cls, tea_id):
+        """お茶の集計を取得（レビューがなければ空の集計）"""
+        return cls.objects.filter(tea_id=tea_id).first() or cls(tea_id=tea_id)
+
+    @classmethod
+    def add_rating(cls, tea_id, rating, delta=1):
+        """レビュー1件分の評価を集計に加算（delta=-1で減算）"""
+        rating = int(rating)
+        changes = {
+            "review_count": models.F("review_count") + delta,
+            "rating_total": models.F("rating_total") + rating * delta,
+            f"rating_{rating}": models.F(f"rating_{rating}") + delta,
+            "updated_at": timezone.now(),
+        }
+        summaries = cls.objects.filter(tea_id=tea_id)
+        if summaries.update(**changes) or delta < 0:
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    tea_id=tea_id,
+                    review_count=delta,
+                    rating_total=rating * delta,
+                    **{f"rating_{rating}": delta},
+                )
+        except IntegrityError:
+            # 同時に作成された場合は加算し直す
+            summaries.update(**changes)
+
+    @classmethod
+    def rebuild(cls, tea_id):
+        """レビューテーブルから集計を作り直す"""
+        aggregates = TeaReview.objects.filter(tea_id=tea_id).aggregate(
+            review_count=models.Count("pk"),
+            rating_total=models.Sum("rating", default=0),
+            **{
+                f"rating_{rating}": models.Count("pk", filter=models.Q(rating=rating))
+                for rating in range(1, 6)
+            },
+        )
+        if not aggregates["review_count"]:
+            cls.objects.filter(tea_id=tea_id).delete()
+            return None
+        summary, _ = cls.objects.update_or_create(tea_id=tea_id, defaults=aggregates)
+        return summary
+
+    class Meta:
+        db_table = "tea_rating_summaries"
+        verbose_name = "レビュー集計"
+        verbose_name_plural = "レビュー集計"
+
+
 class TaxRate(models.Model):
     """消費税率マスタ"""
 
@@ -231,20 +577,22 @@ class TaxRate(models.Model):
     @classmethod
     def get_current_rate(cls):
         """現在有効な税率を取得"""
-        from django.utils import timezone
+        return _tax_rates.get(default=10.00)  # デフォルト10%
 
-        today = timezone.now().date()
+    @classmethod
+    def invalidate_cache(cls):
+        """税率のキャッシュを全プロセスで無効化"""
+        _tax_rates.invalidate()
 
-        tax_rate = (
-            cls.objects.filter(is_active=True, start_date__lte=today)
-            .order_by("-start_date")
-            .first()
+    @classmethod
+    def get_active_periods(cls):
+        """有効な税率を (適用開始日, 税率) で適用開始日の昇順に取得"""
+        return list(
+            cls.objects.filter(is_active=True)
+            .order_by("start_date", "created_at")
+            .values_list("start_date", "rate")
         )
 
-        if tax_rate:
-            return tax_rate.rate
-        return 10.00  # デフォルト10%
-
     class Meta:
         db_table = "tax_rates"
         verbose_name = "消費税率"
@@ -274,21 +622,28 @@ class ShippingFee(models.Model):
     @classmethod
     def get_current_fee(cls):
         """現在有効な送料設定を取得"""
-        from django.utils import timezone
-
-        today = timezone.now().date()
-
-        shipping = (
-            cls.objects.filter(is_active=True, start_date__lte=today)
-            .order_by("-start_date")
-            .first()
-        )
+        shipping = _shipping_fees.get()
 
         if shipping:
             return shipping
         # デフォルト設定
         return cls(fee=800, free_shipping_threshold=None)
 
+    @classmethod
+    def invalidate_cache(cls):
+        """送料設定のキャッシュを全プロセスで無効化"""
+        _shipping_fees.invalidate()
+
+    @classmethod
+    def get_active_periods(cls):
+        """有効な送料設定を (適用開始日, 送料設定) で適用開始日の昇順に取得"""
+        return [
+            (shipping.start_date, shipping)
+            for shipping in cls.objects.filter(is_active=True).order_by(
+                "start_date", "created_at"
+            )
+        ]
+
     @classmethod
     def calculate_shipping_fee(cls, subtotal):
         """小計に基づいて送料を計算"""
@@ -308,6 +663,10 @@ class ShippingFee(models.Model):
         ordering = ["-start_date"]
 
 
+_tax_rates = EffectiveDatedCache("tax_rates", TaxRate.get_active_periods)
+_shipping_fees = EffectiveDatedCache("shipping_fees", ShippingFee.get_active_periods)
+
+
 class TeaProduct(models.Model):
     """お茶商品（重量別価格）"""
 
@@ -328,9 +687,10 @@ class TeaProduct(models.Model):
     def __str__(self):
         return f"{self.tea.name} - {self.weight}g"
 
-    def get_price_with_tax(self):
-        """税込価格を取得"""
-        tax_rate = TaxRate.get_current_rate()
+    def get_price_with_tax(self, tax_rate=None):
+        """税込価格を取得（税率を省略すると現在の税率）"""
+        if tax_rate is None:
+            tax_rate = TaxRate.get_current_rate()
         return int(self.price * (1 + tax_rate / 100))
 
     class Meta:
@@ -341,6 +701,203 @@ class TeaProduct(models.Model):
         ordering = ["tea", "weight"]
 
 
+class CatalogEntry(models.Model):
+    """お茶一覧用の読み取りモデル（公開中のお茶1件につき1行）"""
+
+    tea = models.OneToOneField(
+        Tea,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="catalog_entry",
+        verbose_name="お茶",
+    )
+    name = models.CharField(max_length=100, verbose_name="お茶名")
+    image = models.ImageField(null=True, blank=True, upload_to="photos/")
+    steam_type = models.CharField(
+        max_length=20, choices=Tea.STEAM_TYPE_CHOICES, verbose_name="蒸し度"
+    )
+    origin = models.CharField(max_length=100, blank=True, verbose_name="産地")
+    description = models.TextField(blank=True, verbose_name="説明")
+    caffeine_free = models.BooleanField(default=False, verbose_name="カフェインレス")
+    published_at = models.DateTimeField(verbose_name="公開日時")
+    products = models.JSONField(
+        default=list,
+        verbose_name="販売中の商品",
+        help_text="販売中の商品の重量と価格（税抜）の一覧",
+    )
+    favorites_count = models.IntegerField(
+        default=0,
+        verbose_name="お気に入り数",
+        help_text="お気に入り数カウンターの全シャードの合計",
+    )
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def refresh(cls, tea_id):
+        """お茶・商品の現在の状態から一覧用の行を作り直す"""
+        tea = Tea.objects.filter(pk=tea_id).first()
+        products = list(
+            TeaProduct.objects.filter(tea_id=tea_id, is_available=True)
+            .order_by("weight")
+            .values("id", "weight", "price")
+        )
+
+        # 未公開、または販売中の商品がないお茶は一覧に載せない
+        if tea is None or tea.published_at is None or not products:
+            cls.objects.filter(tea_id=tea_id).delete()
+            return None
+
+        fields = {
+            "name": tea.name,
+            "image": tea.image.name,
+            "steam_type": tea.steam_type,
+            "origin": tea.origin,
+            "description": tea.description,
+            "caffeine_free": tea.caffeine_free,
+            "published_at": tea.published_at,
+            "products": products,
+            "favorites_count": TeaFavoriteCounter.get_count(tea_id),
+        }
+        entry, created = cls.objects.update_or_create(tea_id=tea_id, defaults=fields)
+        return entry
+
+    @classmethod
+    def refresh_favorites_counts(cls, tea_ids=None):
+        """お気に入り数をカウンターの合計から更新（tea_ids=Noneは全件）
+
+        カウンターの行はロックせず、一覧用の行を1文で更新するだけなので、
+        お気に入りの追加が集中しても長くは待たない。
+        """
+        totals = (
+            TeaFavoriteCounter.objects.filter(tea_id=models.OuterRef("tea_id"))
+            .values("tea_id")
+            .annotate(total=models.Sum("count"))
+            .values("total")
+        )
+        entries = cls.objects.all()
+        if tea_ids is not None:
+            entries = entries.filter(tea_id__in=tea_ids)
+        return entries.update(favorites_count=Coalesce(models.Subquery(totals), 0))
+
+    class Meta:
+        db_table = "catalog_entries"
+        verbose_name = "お茶一覧"
+        verbose_name_plural = "お茶一覧"
+        indexes = [
+            models.Index(fields=["published_at", "tea"], name="catalog_published_idx"),
+        ]
+
+
+class CatalogChange(models.Model):
+    """一覧用の行の変更履歴（ファセットインデックスの差分更新用）
+
+    変更ごとに世代番号を1つ進めてその番号で記録する。各プロセスは自分の
+    インデックスの世代より後の変更だけを読み、変わったお茶の分だけ反映する。
+    """
+
+    generation = models.BigIntegerField(primary_key=True, verbose_name="世代番号")
+    # None は全件の作り直し
+    tea_id = models.IntegerField(null=True, blank=True, verbose_name="お茶ID")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="登録日時")
+
+    def __str__(self):
+        return f"{self.generation}: {self.tea_id}"
+
+    class Meta:
+        db_table = "catalog_changes"
+        verbose_name = "お茶一覧の変更履歴"
+        verbose_name_plural = "お茶一覧の変更履歴"
+
+
+class StripePrice(models.Model):
+    """Stripeに登録した価格（Price）
+
+    商品の税込価格や送料の金額ごとに1つ作り、lookup_key で引く。
+    価格や税率が変わると lookup_key も変わるので、新しいPriceを作る。
+    """
+
+    lookup_key = models.CharField(max_length=100, unique=True, verbose_name="キー")
+    product = models.ForeignKey(
+        TeaProduct,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="stripe_prices",
+        verbose_name="商品",
+    )
+    unit_amount = models.IntegerField(verbose_name="単価(税込)")
+    stripe_product_id = models.CharField(
+        max_length=200, verbose_name="Stripe Product ID"
+    )
+    stripe_price_id = models.CharField(max_length=200, verbose_name="Stripe Price ID")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="作成日時")
+
+    def __str__(self):
+        return f"{self.lookup_key} ({self.stripe_price_id})"
+
+    @staticmethod
+    def product_key(product_id, unit_amount):
+        return f"tea_product:{product_id}:{unit_amount}"
+
+    @staticmethod
+    def shipping_key(fee):
+        return f"shipping:{fee}"
+
+    @classmethod
+    def get_price_ids(cls):
+        """{キー: Stripe Price ID} を取得（プロセス内にキャッシュ）"""
+        return _stripe_prices.get_value()
+
+    @classmethod
+    def load_price_ids(cls):
+        return dict(cls.objects.values_list("lookup_key", "stripe_price_id"))
+
+    @classmethod
+    def invalidate_cache(cls):
+        """Price IDのキャッシュを全プロセスで無効化"""
+        _stripe_prices.invalidate()
+
+    class Meta:
+        db_table = "stripe_prices"
+        verbose_name = "Stripe価格"
+        verbose_name_plural = "Stripe価格"
+
+
+_stripe_prices = GenerationCache("stripe_prices", StripePrice.load_price_ids)
+
+
+def summarize_order_items(lines, max_length):
+    """明細 [(お茶の名前, 内容量, 数量), ...] から商品点数と注文内容の要約を作る
+
+    要約が max_length 文字に収まらない場合、残りの明細は「ほかN種類」にまとめる。
+    """
+    labels = [f"{name} ({weight}g) ×{quantity}" for name, weight, quantity in lines]
+    summary = ""
+    shown = 0
+    for label in labels:
+        candidate = f"{summary}、{label}" if summary else label
+        rest = len(labels) - shown - 1
+        # 残りの明細の「ほかN種類」が入る余地を残す
+        suffix = f" ほか{rest}種類" if rest else ""
+        if len(candidate) + len(suffix) > max_length:
+            break
+        summary = candidate
+        shown += 1
+    if labels and not shown:
+        # 最初の明細だけでも収まらない場合は名前を切り詰める
+        shown = 1
+        rest = len(labels) - shown
+        suffix = f" ほか{rest}種類" if rest else ""
+        summary = labels[0][: max_length - len(suffix)]
+    rest = len(labels) - shown
+    if rest:
+        summary += f" ほか{rest}種類"
+    return sum(quantity for _, _, quantity in lines), summary
+
+
 class Order(models.Model):
     """注文"""
 
@@ -353,6 +910,9 @@ class Order(models.Model):
         ("cancelled", "キャンセル"),
     ]
 
+    # 売上に数えるステータス（このステータスへの出入りは save() で日別売上に反映する）
+    SALES_STATUSES = ["paid", "processing", "shipped", "delivered"]
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -373,6 +933,12 @@ class Order(models.Model):
     shipping_fee = models.IntegerField(verbose_name="送料")
     total_amount = models.IntegerField(verbose_name="合計金額(税込)")
 
+    # 明細の要約（注文履歴の一覧で明細を読まずに表示するため、注文時に保存）
+    item_count = models.IntegerField(default=0, verbose_name="商品点数")
+    item_summary = models.CharField(
+        max_length=200, blank=True, verbose_name="注文内容の要約"
+    )
+
     # 税率（注文時の税率を保存）
     tax_rate = models.DecimalField(
         max_digits=5, decimal_places=2, verbose_name="適用税率(%)"
@@ -392,12 +958,131 @@ class Order(models.Model):
     shipping_address = models.CharField(max_length=200, verbose_name="住所")
     shipping_phone = models.CharField(max_length=20, verbose_name="電話番号")
 
+    paid_at = models.DateTimeField(null=True, blank=True, verbose_name="支払い日時")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="注文日時")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
 
     def __str__(self):
         return f"注文 {self.order_number}"
 
+    def is_counted_in_sales(self):
+        """日別売上に数える注文か"""
+        return self.status in self.SALES_STATUSES and self.paid_at is not None
+
+    def save(self, *args, **kwargs):
+        """保存し、売上に数えるかどうかが変わったら日別売上に加算・減算する
+
+        管理画面でのステータス変更なども含めて、どこから変更しても集計が合うようにする。
+        保存前の状態は行ロックを取って読み直すので、同時に変更されても二重に数えない。
+        """
+        update_fields = kwargs.get("update_fields")
+        if self.status in self.SALES_STATUSES and self.paid_at is None:
+            self.paid_at = timezone.now()
+            if update_fields is not None:
+                kwargs["update_fields"] = [*update_fields, "paid_at"]
+
+        with transaction.atomic():
+            saved = None
+            if self.pk is not None:
+                saved = (
+                    type(self)
+                    .objects.select_for_update()
+                    .filter(pk=self.pk)
+                    .only("status", "paid_at")
+                    .first()
+                )
+            was_counted = saved is not None and saved.is_counted_in_sales()
+            super().save(*args, **kwargs)
+            if self.is_counted_in_sales() and not was_counted:
+                DailySales.add_order(self)
+            elif was_counted and not self.is_counted_in_sales():
+                # 加算したときの支払い日から減算する
+                DailySales.add_order(
+                    self, sign=-1, day=timezone.localdate(saved.paid_at)
+                )
+
+    @classmethod
+    def create_from_cart(cls, user, totals, shipping):
+        """計算済みのカートの金額から注文と注文明細を作成する
+
+        金額は CartTotals の値をそのまま使い、明細は bulk_create でまとめて作成する。
+        """
+        item_count, item_summary = summarize_order_items(
+            [
+                (item.product.tea.name, item.product.weight, item.quantity)
+                for item in totals.items
+            ],
+            cls._meta.get_field("item_summary").max_length,
+        )
+        with transaction.atomic():
+            order = cls.objects.create(
+                user=user,
+                order_number=f"ORD-{uuid.uuid4().hex[:12].upper()}",
+                shipping_name=shipping["shipping_name"],
+                shipping_postal_code=shipping["shipping_postal_code"],
+                shipping_address=shipping["shipping_address"],
+                shipping_phone=shipping["shipping_phone"],
+                subtotal=totals.subtotal,
+                tax_amount=totals.tax_amount,
+                shipping_fee=totals.shipping_fee,
+                total_amount=totals.total_amount,
+                tax_rate=totals.tax_rate,
+                item_count=item_count,
+                item_summary=item_summary,
+            )
+            OrderItem.objects.bulk_create(
+                [
+                    OrderItem(
+                        order=order,
+                        product=item.product,
+                        quantity=item.quantity,
+                        price=item.product.price,  # 税抜価格を保存
+                        tea_name=item.product.tea.name,
+                        weight=item.product.weight,
+                        price_with_tax=item.product.get_price_with_tax(totals.tax_rate),
+                    )
+                    for item in totals.items
+                ]
+            )
+        return order
+
+    @classmethod
+    def mark_paid(cls, order_id, payment_intent_id):
+        """注文を支払い済みにして在庫の取り置きを確定する（日別売上には save() で加算）
+
+        注文の行をロックしてから状態を確かめるので、同じ支払いが何度届いても
+        反映は1回だけになる。反映した場合は在庫を取り直せなかった商品IDのリスト、
+        反映済み（または注文がない）場合は None を返す。
+        """
+        with transaction.atomic():
+            order = cls.objects.select_for_update().filter(pk=order_id).first()
+            if order is None or order.status not in ("pending", "cancelled"):
+                return None
+            order.status = "paid"
+            order.stripe_payment_intent_id = payment_intent_id or ""
+            order.paid_at = timezone.now()
+            order.save(
+                update_fields=[
+                    "status",
+                    "stripe_payment_intent_id",
+                    "paid_at",
+                    "updated_at",
+                ]
+            )
+            return StockReservation.confirm_order(order)
+
+    @classmethod
+    def cancel_unpaid(cls, order_id):
+        """支払い待ちの注文をキャンセルし、取り置いていた在庫を戻す"""
+        with transaction.atomic():
+            order = cls.objects.select_for_update().filter(pk=order_id).first()
+            if order is None or order.status != "pending":
+                return False
+            StockReservation.release_order(order)
+            order.status = "cancelled"
+            order.save(update_fields=["status", "updated_at"])
+            return True
+
     def calculate_amounts(self):
         """金額を計算"""
         # 小計（税抜）
@@ -420,6 +1105,13 @@ class Order(models.Model):
         verbose_name = "注文"
         verbose_name_plural = "注文"
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["status", "created_at"]),
+            # 注文履歴のカーソルページネーション用
+            models.Index(fields=["user", "created_at"]),
+            # 日別売上の集計し直し用
+            models.Index(fields=["paid_at"]),
+        ]
 
 
 class OrderItem(models.Model):
@@ -428,14 +1120,24 @@ class OrderItem(models.Model):
     order = models.ForeignKey(
         Order, on_delete=models.CASCADE, related_name="items", verbose_name="注文"
     )
+    # 商品を削除しても注文の記録は残す（表示には下の購入時の値を使う）
     product = models.ForeignKey(
-        TeaProduct, on_delete=models.PROTECT, verbose_name="商品"
+        TeaProduct,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name="商品",
     )
     quantity = models.IntegerField(default=1, verbose_name="数量")
     price = models.IntegerField(verbose_name="単価(税抜)")
 
+    # 購入時の商品情報（あとから商品や税率が変わっても変えない）
+    tea_name = models.CharField(max_length=100, blank=True, verbose_name="お茶名")
+    weight = models.IntegerField(default=0, verbose_name="重量(g)")
+    price_with_tax = models.IntegerField(default=0, verbose_name="単価(税込)")
+
     def __str__(self):
-        return f"{self.order.order_number} - {self.product}"
+        return f"{self.tea_name} - {self.weight}g"
 
     @property
     def subtotal(self):
@@ -453,6 +1155,433 @@ class OrderItem(models.Model):
         verbose_name_plural = "注文明細"
 
 
+class OutOfStockError(Exception):
+    """取り置こうとした商品の在庫が足りない"""
+
+    def __init__(self, product_id):
+        super().__init__(f"商品(id={product_id})の在庫が不足しています")
+        self.product_id = product_id
+
+
+class StockReservation(models.Model):
+    """在庫の取り置き
+
+    Stripeの決済ページを作るときに在庫を減らして取り置き、支払い完了で確定する。
+    キャンセルされたり期限が切れたりした取り置きは在庫に戻す。
+    """
+
+    STATUS_CHOICES = [
+        ("held", "取り置き中"),
+        ("confirmed", "確定"),
+        ("released", "解放済み"),
+    ]
+
+    order = models.ForeignKey(
+        Order,
+        on_delete=models.CASCADE,
+        related_name="reservations",
+        verbose_name="注文",
+    )
+    product = models.ForeignKey(
+        TeaProduct, on_delete=models.CASCADE, verbose_name="商品"
+    )
+    quantity = models.IntegerField(verbose_name="数量")
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default="held",
+        verbose_name="ステータス",
+    )
+    expires_at = models.DateTimeField(verbose_name="取り置き期限")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="作成日時")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
+
+    def __str__(self):
+        return f"{self.order.order_number} - {self.product} ({self.quantity}個)"
+
+    @staticmethod
+    def take_stock(product_id, quantity):
+        """在庫が足りるときだけ在庫を減らす（減らせたらTrue）
+
+        確認と減算を1つの条件付きUPDATEで行うので、同時に実行しても
+        在庫がマイナスになったり、減算が失われたりしない。
+        """
+        return (
+            TeaProduct.objects.filter(pk=product_id, stock__gte=quantity).update(
+                stock=models.F("stock") - quantity
+            )
+            == 1
+        )
+
+    @classmethod
+    def reserve(cls, order, quantities):
+        """注文の商品 {商品ID: 数量} の在庫を取り置き、取り置き期限を返す
+
+        1つでも在庫が足りなければ何も取り置かずに OutOfStockError を送出する。
+        """
+        expires_at = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+        with transaction.atomic():
+            # 行ロックの順番をそろえるため、商品IDの順に減らす
+            for product_id, quantity in sorted(quantities.items()):
+                if not cls.take_stock(product_id, quantity):
+                    raise OutOfStockError(product_id)
+            cls.objects.bulk_create(
+                [
+                    cls(
+                        order=order,
+                        product_id=product_id,
+                        quantity=quantity,
+                        expires_at=expires_at,
+                    )
+                    for product_id, quantity in sorted(quantities.items())
+                ]
+            )
+        return expires_at
+
+    @classmethod
+    def confirm_order(cls, order):
+        """支払い済みの注文の取り置きを確定する
+
+        期限切れで在庫に戻していた分は在庫を取り直す。
+        取り直せなかった商品のIDのリストを返す。
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            if not cls.objects.filter(order=order).exists():
+                # 取り置きを始める前の注文は、解放済みとして在庫を取り直す
+                cls.objects.bulk_create(
+                    [
+                        cls(
+                            order=order,
+                            product_id=item.product_id,
+                            quantity=item.quantity,
+                            status="released",
+                            expires_at=now,
+                        )
+                        # 削除済みの商品は取り直さない
+                        for item in order.items.filter(product__isnull=False)
+                    ]
+                )
+
+            cls.objects.filter(order=order, status="held").update(
+                status="confirmed", updated_at=now
+            )
+
+            shortages = []
+            released = cls.objects.filter(order=order, status="released")
+            for reservation in released.order_by("product_id"):
+                # 同じ取り置きを二重に取り直さないよう、状態を変えられたときだけ減らす
+                if not cls.objects.filter(pk=reservation.pk, status="released").update(
+                    status="confirmed", updated_at=now
+                ):
+                    continue
+                if not cls.take_stock(reservation.product_id, reservation.quantity):
+                    shortages.append(reservation.product_id)
+        return shortages
+
+    @classmethod
+    def release(cls, reservations):
+        """取り置きを解放して在庫に戻し、解放した件数を返す"""
+        released = 0
+        for reservation in reservations:
+            with transaction.atomic():
+                # 取り置き中のものだけを解放し、二重に在庫へ戻さないようにする
+                if not cls.objects.filter(pk=reservation.pk, status="held").update(
+                    status="released", updated_at=timezone.now()
+                ):
+                    continue
+                TeaProduct.objects.filter(pk=reservation.product_id).update(
+                    stock=models.F("stock") + reservation.quantity
+                )
+            released += 1
+        return released
+
+    @classmethod
+    def release_order(cls, order):
+        """注文の取り置きをすべて解放する"""
+        return cls.release(cls.objects.filter(order=order, status="held"))
+
+    @classmethod
+    def release_expired(cls, now=None):
+        """期限切れの取り置きを解放し、支払い待ちのままの注文をキャンセルにする
+
+        (解放した取り置きの件数, キャンセルした注文の件数) を返す。
+        Order.mark_paid と同じく注文の行ロックを取ってから変更し、
+        支払いの反映中（ロック中）の注文の取り置きは次回に回す。
+        """
+        now = now or timezone.now()
+        expired = cls.objects.filter(status="held", expires_at__lte=now)
+        order_ids = set(expired.values_list("order_id", flat=True))
+        if not order_ids:
+            return 0, 0
+        with transaction.atomic():
+            locked_ids = list(
+                Order.objects.select_for_update(skip_locked=True)
+                .filter(pk__in=order_ids)
+                .values_list("pk", flat=True)
+            )
+            released = cls.release(
+                expired.filter(order_id__in=locked_ids).order_by("pk")
+            )
+            cancelled = Order.objects.filter(
+                pk__in=locked_ids, status="pending"
+            ).update(status="cancelled", updated_at=now)
+        return released, cancelled
+
+    class Meta:
+        db_table = "stock_reservations"
+        verbose_name = "在庫の取り置き"
+        verbose_name_plural = "在庫の取り置き"
+        indexes = [models.Index(fields=["status", "expires_at"])]
+
+
+class StripeEvent(models.Model):
+    """Stripeから受け取ったイベントの台帳
+
+    webhookで受け取ったイベントをそのまま保存し、あとからまとめて注文に反映する。
+    イベントIDの一意制約で、再送されたイベントを1件にまとめる。
+    決済完了画面とwebhookの両方から届いた同じ支払いは、注文の行ロックで1回だけ反映する。
+    """
+
+    STATUS_CHOICES = [
+        ("pending", "未処理"),
+        ("processed", "処理済み"),
+        ("failed", "失敗"),
+    ]
+
+    event_id = models.CharField(max_length=255, unique=True, verbose_name="イベントID")
+    event_type = models.CharField(max_length=100, verbose_name="種類")
+    checkout_session_id = models.CharField(
+        max_length=200, blank=True, verbose_name="Checkout Session ID"
+    )
+    payload = models.JSONField(verbose_name="イベントの内容")
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default="pending",
+        verbose_name="ステータス",
+    )
+    attempts = models.IntegerField(default=0, verbose_name="失敗回数")
+    next_attempt_at = models.DateTimeField(
+        default=timezone.now, verbose_name="次に反映する日時"
+    )
+    last_error = models.TextField(blank=True, verbose_name="最後のエラー")
+    received_at = models.DateTimeField(auto_now_add=True, verbose_name="受信日時")
+    processed_at = models.DateTimeField(null=True, blank=True, verbose_name="処理日時")
+
+    def __str__(self):
+        return f"{self.event_type} ({self.event_id})"
+
+    class Meta:
+        db_table = "stripe_events"
+        verbose_name = "Stripeイベント"
+        verbose_name_plural = "Stripeイベント"
+        indexes = [models.Index(fields=["status", "received_at"])]
+
+
+class DailySales(models.Model):
+    """日ごとの売上（支払い日で集計）
+
+    注文が支払い済みになったときに加算し、ダッシュボードのグラフは注文ではなくこの表を読む。
+    集計し直す場合は rebuild_daily_sales コマンドを使う。
+    """
+
+    day = models.DateField(unique=True, verbose_name="日付")
+    order_count = models.IntegerField(default=0, verbose_name="注文数")
+    units = models.IntegerField(default=0, verbose_name="販売点数")
+    subtotal = models.IntegerField(default=0, verbose_name="小計(税抜)")
+    tax_amount = models.IntegerField(default=0, verbose_name="消費税額")
+    shipping_fee = models.IntegerField(default=0, verbose_name="送料")
+    total_amount = models.IntegerField(default=0, verbose_name="売上(税込)")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
+
+    def __str__(self):
+        return f"{self.day}: ¥{self.total_amount:,}"
+
+    @classmethod
+    def add_order(cls, order, sign=1, day=None):
+        """注文1件分を、日ごとの売上と商品ごとの売上に加算する（sign=-1 で減算）
+
+        day を省略すると注文の支払い日に加算する。
+        """
+        day = day or timezone.localdate(order.paid_at)
+        items = order.items.annotate(
+            day=models.Value(day, output_field=models.DateField())
+        )
+        lines = DailyProductSales.get_lines_by_day(items).get(day, {})
+        values = {
+            "order_count": sign,
+            "units": sign * sum(line["units"] for line in lines.values()),
+            "subtotal": sign * order.subtotal,
+            "tax_amount": sign * order.tax_amount,
+            "shipping_fee": sign * order.shipping_fee,
+            "total_amount": sign * order.total_amount,
+        }
+        add_to_rollup(cls.objects.filter(day=day), values, day=day)
+        for (product_id, product_name, steam_type), line in lines.items():
+            line = {name: sign * value for name, value in line.items()}
+            keys = {
+                "day": day,
+                "product_id": product_id,
+                "product_name": product_name,
+                "steam_type": steam_type,
+            }
+            add_to_rollup(
+                DailyProductSales.objects.filter(**keys),
+                line,
+                product_label=DailyProductSales.make_label(product_id, product_name),
+                **keys,
+            )
+
+    @classmethod
+    def rebuild(cls, date_from=None, date_to=None):
+        """注文から指定した期間（支払い日、両端を含む）の集計を作り直し、日数を返す"""
+        orders = Order.objects.filter(
+            paid_at__isnull=False, status__in=Order.SALES_STATUSES
+        )
+        days = {}
+        if date_from:
+            orders = orders.filter(paid_at__date__gte=date_from)
+            days["day__gte"] = date_from
+        if date_to:
+            orders = orders.filter(paid_at__date__lte=date_to)
+            days["day__lte"] = date_to
+
+        rows = list(
+            orders.annotate(day=TruncDate("paid_at"))
+            .values("day")
+            .annotate(
+                order_count=models.Count("pk"),
+                subtotal=models.Sum("subtotal"),
+                tax_amount=models.Sum("tax_amount"),
+                shipping_fee=models.Sum("shipping_fee"),
+                total_amount=models.Sum("total_amount"),
+            )
+            .order_by("day")
+        )
+        items = OrderItem.objects.filter(order__in=orders).annotate(
+            day=TruncDate("order__paid_at")
+        )
+        product_rows = []
+        units = {}
+        for day, item_lines in DailyProductSales.get_lines_by_day(items).items():
+            for (product_id, product_name, steam_type), line in item_lines.items():
+                product_rows.append(
+                    DailyProductSales(
+                        day=day,
+                        product_id=product_id,
+                        product_name=product_name,
+                        product_label=DailyProductSales.make_label(
+                            product_id, product_name
+                        ),
+                        steam_type=steam_type,
+                        **line,
+                    )
+                )
+                units[day] = units.get(day, 0) + line["units"]
+
+        with transaction.atomic():
+            cls.objects.filter(**days).delete()
+            DailyProductSales.objects.filter(**days).delete()
+            cls.objects.bulk_create(
+                [cls(units=units.get(row["day"], 0), **row) for row in rows],
+                batch_size=1000,
+            )
+            DailyProductSales.objects.bulk_create(product_rows, batch_size=1000)
+        return len(rows)
+
+    class Meta:
+        db_table = "daily_sales"
+        verbose_name = "日別売上"
+        verbose_name_plural = "日別売上"
+
+
+class DailyProductSales(models.Model):
+    """日ごとの商品別の売上（支払い日で集計）
+
+    商品は商品IDと購入時のお茶名・重量・蒸し度で分ける（同じ名前のお茶も別の行にする）。
+    商品別のグラフは product_label、蒸し度ごとのグラフは steam_type でまとめる。
+    """
+
+    day = models.DateField(verbose_name="日付")
+    # 商品が削除された明細は0
+    product_id = models.IntegerField(default=0, verbose_name="商品ID")
+    product_name = models.CharField(max_length=120, verbose_name="商品")
+    # 同じ名前のお茶をグラフで別の系列にするため、商品IDを付けた名前
+    product_label = models.CharField(
+        max_length=140, blank=True, verbose_name="グラフの表示名"
+    )
+    steam_type = models.CharField(
+        max_length=20,
+        choices=Tea.STEAM_TYPE_CHOICES,
+        blank=True,
+        verbose_name="蒸し度",
+    )
+    units = models.IntegerField(default=0, verbose_name="販売点数")
+    subtotal = models.IntegerField(default=0, verbose_name="小計(税抜)")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
+
+    def __str__(self):
+        return f"{self.day} {self.product_name}: {self.units}点"
+
+    @staticmethod
+    def make_label(product_id, product_name):
+        """グラフの表示名（商品が削除された行は商品名のみ）"""
+        return f"{product_name} #{product_id}" if product_id else product_name
+
+    @classmethod
+    def get_lines_by_day(cls, items):
+        """day で注釈した注文明細を、日ごとに商品別の点数と小計にまとめる
+
+        {日付: {(商品ID, 商品名, 蒸し度): {"units": 点数, "subtotal": 小計}}} を返す。
+        """
+        rows = items.values(
+            "day", "product_id", "tea_name", "weight", "product__tea__steam_type"
+        ).annotate(
+            units=models.Sum("quantity"),
+            subtotal=models.Sum(models.F("price") * models.F("quantity")),
+        )
+        by_day = {}
+        for row in rows.iterator():
+            key = (
+                row["product_id"] or 0,
+                f"{row['tea_name']} ({row['weight']}g)",
+                # 商品が削除されている場合は蒸し度がわからない
+                row["product__tea__steam_type"] or "",
+            )
+            line = by_day.setdefault(row["day"], {}).setdefault(
+                key, {"units": 0, "subtotal": 0}
+            )
+            line["units"] += row["units"]
+            line["subtotal"] += row["subtotal"]
+        return by_day
+
+    class Meta:
+        db_table = "daily_product_sales"
+        verbose_name = "日別商品売上"
+        verbose_name_plural = "日別商品売上"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["day", "product_id", "product_name", "steam_type"],
+                name="daily_product_sales_unique",
+            )
+        ]
+
+
+def add_to_rollup(rows, values, **keys):
+    """集計の行に値を加算する（行がなければ作成する）"""
+    changes = {name: models.F(name) + value for name, value in values.items()}
+    changes["updated_at"] = timezone.now()
+    if rows.update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            rows.model.objects.create(**keys, **values)
+    except IntegrityError:
+        # 同時に作成された場合は加算し直す
+        rows.update(**changes)
+
+
 class Cart(models.Model):
     """カート"""
 
@@ -468,31 +1597,44 @@ class Cart(models.Model):
     def __str__(self):
         return f"{self.user.email}のカート"
 
+    @cached_property
+    def totals(self):
+        """カートの金額（リクエスト中は計算結果を使い回す）"""
+        return CartTotals.calculate(self)
+
+    def clear_totals(self):
+        """カートの中身を変更した後に金額を計算し直すようにする"""
+        self.__dict__.pop("totals", None)
+
     @property
     def subtotal(self):
         """小計（税抜）"""
-        return sum(item.subtotal for item in self.items.all())
+        return self.totals.subtotal
+
+    @property
+    def tax_rate(self):
+        """適用税率(%)"""
+        return self.totals.tax_rate
 
     @property
     def tax_amount(self):
         """消費税額"""
-        tax_rate = TaxRate.get_current_rate()
-        return int(self.subtotal * tax_rate / 100)
+        return self.totals.tax_amount
 
     @property
     def shipping_fee(self):
         """送料"""
-        return ShippingFee.calculate_shipping_fee(self.subtotal)
+        return self.totals.shipping_fee
 
     @property
     def total_amount(self):
         """合計金額（税込）"""
-        return self.subtotal + self.tax_amount + self.shipping_fee
+        return self.totals.total_amount
 
     @property
     def item_count(self):
         """商品点数"""
-        return sum(item.quantity for item in self.items.all())
+        return self.totals.item_count
 
     class Meta:
         db_table = "carts"
@@ -500,6 +1642,43 @@ class Cart(models.Model):
         verbose_name_plural = "カート"
 
 
+class CartTotals:
+    """カートの金額計算
+
+    明細と商品を1回で読み込み、小計・消費税・送料・合計・商品点数を
+    まとめて計算する。税率と送料設定の取得も1回だけにする。
+    """
+
+    def __init__(self, items, tax_rate, shipping):
+        self.items = items
+        self.tax_rate = tax_rate
+        self.item_count = sum(item.quantity for item in items)
+        self.subtotal = sum(item.subtotal for item in items)
+        self.tax_amount = int(self.subtotal * tax_rate / 100)
+        if (
+            shipping.free_shipping_threshold
+            and self.subtotal >= shipping.free_shipping_threshold
+        ):
+            self.shipping_fee = 0
+        else:
+            self.shipping_fee = shipping.fee
+        self.total_amount = self.subtotal + self.tax_amount + self.shipping_fee
+
+    @classmethod
+    def calculate(cls, cart):
+        if "items" in getattr(cart, "_prefetched_objects_cache", {}):
+            # prefetch_related済みならその結果を使う
+            items = list(cart.items.all())
+        else:
+            items = list(cart.items.select_related("product__tea").order_by("pk"))
+        return cls.from_items(items)
+
+    @classmethod
+    def from_items(cls, items):
+        """商品を読み込み済みの明細から計算"""
+        return cls(items, TaxRate.get_current_rate(), ShippingFee.get_current_fee())
+
+
 class CartItem(models.Model):
     """カート明細"""
 
@@ -515,6 +1694,125 @@ class CartItem(models.Model):
     def __str__(self):
         return f"{self.cart.user.email} - {self.product}"
 
+    @classmethod
+    def add_quantity(cls, user_id, product_id, quantity):
+        """ユーザーのカートに商品を追加する
+
+        追加後の (明細の数量, カート内の商品点数) を返す。
+        販売中でない、または在庫が足りない場合は None を返す。
+        """
+        with transaction.atomic():
+            if connection.vendor in ("postgresql", "sqlite") and (
+                connection.features.can_return_columns_from_insert
+            ):
+                item_quantity = cls._upsert_quantity(user_id, product_id, quantity)
+                if item_quantity is None:
+                    # カートがまだなければ作成してやり直す
+                    _, created = Cart.objects.get_or_create(user_id=user_id)
+                    if created:
+                        item_quantity = cls._upsert_quantity(
+                            user_id, product_id, quantity
+                        )
+            else:
+                item_quantity = cls._add_quantity_locked(user_id, product_id, quantity)
+
+            if item_quantity is None:
+                return None
+            cart_count = cls.objects.filter(cart__user_id=user_id).aggregate(
+                total=models.Sum("quantity", default=0)
+            )["total"]
+        return item_quantity, cart_count
+
+    @classmethod
+    def _upsert_quantity(cls, user_id, product_id, quantity):
+        """INSERT ... ON CONFLICT DO UPDATE の1文で在庫を確認しながら数量を加算
+
+        同時に追加されても数量が失われず、在庫を超える数量にもならない。
+        カートがない・販売中でない・在庫が足りない場合は None を返す。
+        """
+        quote_name = connection.ops.quote_name
+        items = quote_name(cls._meta.db_table)
+        carts = quote_name(Cart._meta.db_table)
+        products = quote_name(TeaProduct._meta.db_table)
+        sql = f"""
+            INSERT INTO {items} (cart_id, product_id, quantity, created_at)
+            SELECT c.id, p.id, %s, %s
+            FROM {carts} c, {products} p
+            WHERE c.user_id = %s AND p.id = %s AND p.is_available AND p.stock >= %s
+            ON CONFLICT (cart_id, product_id) DO UPDATE
+            SET quantity = {items}.quantity + excluded.quantity
+            WHERE {items}.quantity + excluded.quantity <= (
+                SELECT stock FROM {products} WHERE id = excluded.product_id
+            )
+            RETURNING quantity
+        """
+        created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [quantity, created_at, user_id, product_id, quantity])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    def _add_quantity_locked(cls, user_id, product_id, quantity):
+        """ON CONFLICT が使えないデータベース用（行ロックで数量を加算）"""
+        cart, _ = Cart.objects.get_or_create(user_id=user_id)
+        product = (
+            TeaProduct.objects.select_for_update()
+            .filter(pk=product_id, is_available=True)
+            .first()
+        )
+        item = cls.objects.select_for_update().filter(cart=cart, product_id=product_id)
+        item = item.first()
+        new_quantity = (item.quantity if item else 0) + quantity
+        if product is None or product.stock < new_quantity:
+            return None
+        if item:
+            item.quantity = new_quantity
+            item.save(update_fields=["quantity"])
+        else:
+            cls.objects.create(cart=cart, product=product, quantity=new_quantity)
+        return new_quantity
+
+    @classmethod
+    def merge_quantities(cls, cart_id, lines):
+        """{商品ID: 数量} をカートに加える（在庫を超える分は切り捨てる）
+
+        現在の数量と在庫を読み込み、加算後の数量を1回の upsert で書き込む。
+        """
+        stocks = dict(
+            TeaProduct.objects.filter(pk__in=list(lines), is_available=True)
+            .select_for_update()
+            .values_list("pk", "stock")
+        )
+        current = dict(
+            cls.objects.filter(cart_id=cart_id, product_id__in=list(stocks))
+            .select_for_update()
+            .values_list("product_id", "quantity")
+        )
+        items = [
+            cls(
+                cart_id=cart_id,
+                product_id=product_id,
+                quantity=min(current.get(product_id, 0) + quantity, stocks[product_id]),
+            )
+            for product_id, quantity in lines.items()
+            if stocks.get(product_id, 0) > 0
+        ]
+        cls.objects.bulk_create(
+            items,
+            update_conflicts=True,
+            unique_fields=["cart", "product"],
+            update_fields=["quantity"],
+        )
+
+    @classmethod
+    def set_quantity(cls, user_id, product_id, quantity):
+        """明細の数量を変更する（在庫を超える場合は変更せず False を返す）"""
+        updated = cls.objects.filter(
+            cart__user_id=user_id, product_id=product_id, product__stock__gte=quantity
+        ).update(quantity=quantity)
+        return bool(updated)
+
     @property
     def subtotal(self):
         """小計（税抜）"""
@@ -531,3 +1829,28 @@ class CartItem(models.Model):
         verbose_name = "カート明細"
         verbose_name_plural = "カート明細"
         unique_together = ["cart", "product"]
+
+
+class DirtyCart(models.Model):
+    """キャッシュで変更され、まだテーブルに書き出していないカート
+
+    カートの保存先がキャッシュの場合に使う。書き出す前にプロセスが落ちても、
+    ほかのプロセスがこの行を見てキャッシュのカートを書き出せるようにする。
+    """
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="+",
+        verbose_name="ユーザー",
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="登録日時")
+
+    def __str__(self):
+        return str(self.user_id)
+
+    class Meta:
+        db_table = "dirty_carts"
+        verbose_name = "書き出し待ちのカート"
+        verbose_name_plural = "書き出し待ちのカート"
@@ -0,0 +1,61 @@
+from django.core import signing
+from django.db.models import Q
+
+CURSOR_SALT = "model.pagination.cursor"
+
+
+def encode_cursor(*values):
+    """キーの値をURLに載せられるカーソル文字列にする"""
+    return signing.dumps(
+        [
+            value.isoformat() if hasattr(value, "isoformat") else value
+            for value in values
+        ],
+        salt=CURSOR_SALT,
+        compress=True,
+    )
+
+
+def decode_cursor(cursor):
+    """カーソル文字列をキーの値に戻す（不正な場合はNone）"""
+    if not cursor:
+        return None
+    try:
+        return signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        return None
+
+
+def keyset_queryset(queryset, field, cursor=None):
+    """(field, pk) の降順に並べ、カーソルより後ろの行に絞り込む"""
+    queryset = queryset.order_by(f"-{field}", "-pk")
+    values = decode_cursor(cursor)
+    if values:
+        value, pk = values
+        queryset = queryset.filter(
+            Q(**{f"{field}__lt": value}) | Q(**{field: value, "pk__lt": pk})
+        )
+    return queryset
+
+
+def keyset_page(queryset, field, cursor=None, page_size=20):
+    """カーソルページネーションで1ページ分の行と次ページのカーソルを取得"""
+    items = list(keyset_queryset(queryset, field, cursor)[: page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, field), last.pk)
+    return items, next_cursor
+
+
+def keyset_next_cursor(queryset, field, cursor=None, page_size=20):
+    """ページの行を読み込まずに次ページのカーソルだけを取得"""
+    keys = list(
+        keyset_queryset(queryset, field, cursor).values_list(field, "pk")[
+            page_size - 1 : page_size + 1
+        ]
+    )
+    if len(keys) < 2:
+        return None
+    return encode_cursor(*keys[0])
@@ -0,0 +1,105 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from model.models import (
+    CatalogEntry,
+    FavoriteTea,
+    ShippingFee,
+    TaxRate,
+    Tea,
+    TeaFavoriteCounter,
+    TeaProduct,
+    TeaRatingSummary,
+    TeaReview,
+)
+
+# 一覧用の行が更新・削除されたときに送られる（tea_id=Noneは全件の作り直し）
+catalog_entry_changed = Signal()
+
+
+def refresh_catalog(tea_id):
+    """一覧用の行を作り直し、変更を通知"""
+    CatalogEntry.refresh(tea_id)
+    catalog_entry_changed.send(sender=CatalogEntry, tea_id=tea_id)
+
+
+@receiver(post_save, sender=Tea)
+def refresh_catalog_on_tea_save(sender, instance, raw=False, **kwargs):
+    """お茶の更新を一覧用の行に反映"""
+    if raw:
+        return
+    refresh_catalog(instance.pk)
+
+
+@receiver(post_delete, sender=Tea)
+def notify_catalog_on_tea_delete(sender, instance, **kwargs):
+    """お茶の削除（一覧用の行も連動して削除される）を通知"""
+    catalog_entry_changed.send(sender=CatalogEntry, tea_id=instance.pk)
+
+
+@receiver(post_save, sender=TeaProduct)
+@receiver(post_delete, sender=TeaProduct)
+def refresh_catalog_on_product_change(sender, instance, raw=False, **kwargs):
+    """商品の追加・変更・削除を一覧用の行に反映"""
+    if raw:
+        return
+    refresh_catalog(instance.tea_id)
+
+
+def refresh_catalog_favorites_count(tea_id):
+    """コミット後に一覧用の行のお気に入り数をカウンターの合計に合わせる
+
+    一覧用の行のロックを呼び出し元のトランザクションの間持ち続けないよう、
+    コミット後に1文で更新する。
+    """
+    transaction.on_commit(lambda: CatalogEntry.refresh_favorites_counts([tea_id]))
+
+
+@receiver(post_save, sender=FavoriteTea)
+def increment_favorite_counter(sender, instance, created, raw=False, **kwargs):
+    """お気に入り追加時にお気に入り数を増やす"""
+    if raw or not created:
+        return
+    TeaFavoriteCounter.increment(instance.tea_id, 1)
+    refresh_catalog_favorites_count(instance.tea_id)
+    FavoriteTea.invalidate_tea_ids(instance.user_id)
+
+
+@receiver(post_delete, sender=FavoriteTea)
+def decrement_favorite_counter(sender, instance, **kwargs):
+    """お気に入り解除時にお気に入り数を減らす"""
+    TeaFavoriteCounter.increment(instance.tea_id, -1)
+    refresh_catalog_favorites_count(instance.tea_id)
+    FavoriteTea.invalidate_tea_ids(instance.user_id)
+
+
+@receiver(post_save, sender=TeaReview)
+def update_rating_summary_on_save(sender, instance, created, raw=False, **kwargs):
+    """レビュー投稿時に評価を集計に加算（編集時は集計し直す）"""
+    if raw:
+        return
+    if created:
+        TeaRatingSummary.add_rating(instance.tea_id, instance.rating)
+    else:
+        TeaRatingSummary.rebuild(instance.tea_id)
+
+
+@receiver(post_delete, sender=TeaReview)
+def update_rating_summary_on_delete(sender, instance, **kwargs):
+    """レビュー削除時に評価を集計から減算"""
+    TeaRatingSummary.add_rating(instance.tea_id, instance.rating, delta=-1)
+
+
+@receiver(post_save, sender=TaxRate)
+@receiver(post_delete, sender=TaxRate)
+def invalidate_tax_rates(sender, **kwargs):
+    """税率の変更を全プロセスのキャッシュに反映"""
+    TaxRate.invalidate_cache()
+
+
+@receiver(post_save, sender=ShippingFee)
+@receiver(post_delete, sender=ShippingFee)
+def invalidate_shipping_fees(sender, **kwargs):
+    """送料設定の変更を全プロセスのキャッシュに反映"""
+    ShippingFee.invalidate_cache()
@@ -0,0 +1,344 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import OperationalError, connection, models
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from model.models import (
+    Cart,
+    CartItem,
+    CartTotals,
+    CatalogEntry,
+    DailyProductSales,
+    DailySales,
+    FavoriteTea,
+    Order,
+    OutOfStockError,
+    StockReservation,
+    Tea,
+    TeaProduct,
+    User,
+)
+
+SHIPPING = {
+    "shipping_name": "山田",
+    "shipping_postal_code": "100-0001",
+    "shipping_address": "東京都",
+    "shipping_phone": "0312345678",
+}
+
+
+class DailySalesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="user@example.com", password="password", is_active=True
+        )
+        # 同じ名前・重量で、蒸し度の違うお茶と蒸し度も同じお茶
+        cls.products = [
+            TeaProduct.objects.create(
+                tea=Tea.objects.create(name="煎茶", steam_type=steam_type),
+                weight=100,
+                price=1000,
+                stock=10,
+            )
+            for steam_type in ["deep", "light", "deep"]
+        ]
+
+    def create_order(self, quantities):
+        totals = CartTotals.from_items(
+            [
+                CartItem(product=product, quantity=quantity)
+                for product, quantity in zip(self.products, quantities)
+            ]
+        )
+        return Order.create_from_cart(self.user, totals, SHIPPING)
+
+    def pay(self, quantities):
+        order = self.create_order(quantities)
+        Order.mark_paid(order.pk, "pi_test")
+
+    def get_product_rows(self):
+        return sorted(
+            DailyProductSales.objects.values_list(
+                "product_id", "product_name", "steam_type", "units", "subtotal"
+            )
+        )
+
+    def test_same_name_teas_are_rolled_up_separately(self):
+        self.pay([1, 2, 3])
+        self.pay([1, 1, 1])
+
+        expected = [
+            (self.products[0].pk, "煎茶 (100g)", "deep", 2, 2000),
+            (self.products[1].pk, "煎茶 (100g)", "light", 3, 3000),
+            (self.products[2].pk, "煎茶 (100g)", "deep", 4, 4000),
+        ]
+        self.assertEqual(self.get_product_rows(), expected)
+        self.assertEqual(DailySales.objects.get(day=timezone.localdate()).units, 9)
+        # グラフでも別の系列になる
+        self.assertEqual(
+            sorted(DailyProductSales.objects.values_list("product_label", flat=True)),
+            [f"煎茶 (100g) #{product.pk}" for product in self.products],
+        )
+
+        # 注文から作り直しても同じ行になる
+        DailySales.rebuild()
+        self.assertEqual(self.get_product_rows(), expected)
+        self.assertEqual(DailySales.objects.get(day=timezone.localdate()).units, 9)
+
+    def get_daily_sales(self):
+        return (
+            DailySales.objects.filter(day=timezone.localdate())
+            .values_list("order_count", "units")
+            .first()
+        )
+
+    def test_status_changes_outside_mark_paid_update_rollups(self):
+        order = self.create_order([1, 2, 0])
+        self.assertIsNone(self.get_daily_sales())
+
+        # 管理画面などでステータスを変更した場合も集計に加算・減算する
+        order.status = "paid"
+        order.save()
+        self.assertEqual(self.get_daily_sales(), (1, 3))
+
+        order.status = "shipped"
+        order.save()
+        self.assertEqual(self.get_daily_sales(), (1, 3))
+
+        order.status = "cancelled"
+        order.save()
+        self.assertEqual(self.get_daily_sales(), (0, 0))
+        self.assertEqual(
+            set(DailyProductSales.objects.values_list("units", flat=True)), {0}
+        )
+
+    def test_mark_paid_counts_once(self):
+        order = self.create_order([1, 0, 0])
+        Order.mark_paid(order.pk, "pi_test")
+        Order.mark_paid(order.pk, "pi_test")
+        self.assertEqual(self.get_daily_sales(), (1, 1))
+
+
+class CartAddQuantityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="user@example.com", password="password", is_active=True
+        )
+        tea = Tea.objects.create(name="煎茶", steam_type="deep")
+        cls.product = TeaProduct.objects.create(
+            tea=tea, weight=100, price=1000, stock=5
+        )
+
+    def get_lines(self):
+        return list(
+            CartItem.objects.filter(cart__user=self.user).values_list(
+                "product_id", "quantity"
+            )
+        )
+
+    def test_creates_cart_for_user_without_cart(self):
+        self.assertFalse(Cart.objects.filter(user=self.user).exists())
+        self.assertEqual(
+            CartItem.add_quantity(self.user.pk, self.product.pk, 2), (2, 2)
+        )
+        self.assertEqual(self.get_lines(), [(self.product.pk, 2)])
+
+        # 既存の明細には数量を加算する
+        self.assertEqual(
+            CartItem.add_quantity(self.user.pk, self.product.pk, 3), (5, 5)
+        )
+        self.assertEqual(Cart.objects.filter(user=self.user).count(), 1)
+
+    def test_out_of_stock_changes_nothing(self):
+        self.assertIsNone(CartItem.add_quantity(self.user.pk, self.product.pk, 6))
+        self.assertEqual(self.get_lines(), [])
+
+        CartItem.add_quantity(self.user.pk, self.product.pk, 4)
+        self.assertIsNone(CartItem.add_quantity(self.user.pk, self.product.pk, 2))
+        self.assertEqual(self.get_lines(), [(self.product.pk, 4)])
+
+    def test_unavailable_product_is_not_added(self):
+        TeaProduct.objects.filter(pk=self.product.pk).update(is_available=False)
+        self.assertIsNone(CartItem.add_quantity(self.user.pk, self.product.pk, 1))
+        self.assertEqual(self.get_lines(), [])
+
+
+class CartAddQuantityConcurrencyTests(TransactionTestCase):
+    """同じ明細に多数のスレッドから同時に追加し、数量が失われず在庫を超えないことを確かめる"""
+
+    THREADS = 8
+    ATTEMPTS = 40
+    STOCK = 30
+    RETRIES = 200
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="user@example.com", password="password", is_active=True
+        )
+        tea = Tea.objects.create(name="煎茶", steam_type="deep")
+        self.product = TeaProduct.objects.create(
+            tea=tea, weight=100, price=1000, stock=self.STOCK
+        )
+
+    def add(self):
+        # SQLiteはロックが取れないと失敗するので、何度かやり直す（数量は変わっていない）
+        for _ in range(self.RETRIES):
+            try:
+                if CartItem.add_quantity(self.user.pk, self.product.pk, 1) is None:
+                    return "out_of_stock"
+                return "added"
+            except OperationalError:
+                time.sleep(0.005)
+        return "errors"
+
+    def test_concurrent_adds_to_same_line(self):
+        results = {"added": 0, "out_of_stock": 0, "errors": 0}
+        lock = threading.Lock()
+        start = threading.Barrier(self.THREADS)
+
+        def work(attempts):
+            try:
+                start.wait()
+                for _ in range(attempts):
+                    outcome = self.add()
+                    with lock:
+                        results[outcome] += 1
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.THREADS) as executor:
+            list(executor.map(work, [self.ATTEMPTS // self.THREADS] * self.THREADS))
+
+        # カートは1つ、明細は1行で、追加できた分だけ数量が増えている
+        self.assertEqual(sum(results.values()), self.ATTEMPTS)
+        self.assertEqual(Cart.objects.filter(user=self.user).count(), 1)
+        item = CartItem.objects.get(cart__user=self.user)
+        self.assertEqual(item.quantity, results["added"])
+        self.assertLessEqual(item.quantity, self.STOCK)
+        if not results["errors"]:
+            self.assertEqual(results["added"], self.STOCK)
+
+
+class CatalogFavoritesCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(
+                email=f"user{i}@example.com", password="password", is_active=True
+            )
+            for i in range(3)
+        ]
+        cls.tea = Tea.objects.create(
+            name="煎茶", steam_type="deep", published_at=timezone.now()
+        )
+        TeaProduct.objects.create(tea=cls.tea, weight=100, price=1000, stock=10)
+
+    def get_favorites_count(self):
+        return CatalogEntry.objects.get(pk=self.tea.pk).favorites_count
+
+    def test_follows_sharded_counter(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            favorites = [
+                FavoriteTea.objects.create(user=user, tea=self.tea)
+                for user in self.users
+            ]
+        self.assertEqual(self.get_favorites_count(), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            favorites[0].delete()
+        self.assertEqual(self.get_favorites_count(), 2)
+
+        # お茶の更新で一覧用の行を作り直しても数は保たれる
+        self.tea.save()
+        self.assertEqual(self.get_favorites_count(), 2)
+
+
+class StockReservationConcurrencyTests(TransactionTestCase):
+    """1つの商品に多数のスレッドから同時に取り置き、売り越しがないことを確かめる"""
+
+    THREADS = 8
+    ATTEMPTS = 80
+    STOCK = 30
+    RETRIES = 200
+
+    def setUp(self):
+        user = User.objects.create_user(
+            email="user@example.com", password="password", is_active=True
+        )
+        tea = Tea.objects.create(name="煎茶", steam_type="middle")
+        self.product = TeaProduct.objects.create(
+            tea=tea, weight=100, price=1000, stock=self.STOCK
+        )
+        self.orders = [
+            Order.objects.create(
+                user=user,
+                order_number=f"TEST-{i:04d}",
+                subtotal=0,
+                tax_amount=0,
+                shipping_fee=0,
+                total_amount=0,
+                tax_rate=0,
+                **SHIPPING,
+            )
+            for i in range(self.ATTEMPTS)
+        ]
+
+    def run_reservations(self, quantity):
+        """注文ごとに1回ずつ、スレッドから同時に取り置く"""
+        results = {"reserved": 0, "out_of_stock": 0, "errors": 0}
+        lock = threading.Lock()
+        start = threading.Barrier(self.THREADS)
+
+        def work(orders):
+            try:
+                start.wait()
+                for order in orders:
+                    outcome = self.reserve(order, quantity)
+                    with lock:
+                        results[outcome] += 1
+            finally:
+                connection.close()
+
+        chunks = [self.orders[i :: self.THREADS] for i in range(self.THREADS)]
+        with ThreadPoolExecutor(max_workers=self.THREADS) as executor:
+            list(executor.map(work, chunks))
+        return results
+
+    def reserve(self, order, quantity):
+        # SQLiteはロックが取れないと失敗するので、何度かやり直す（在庫は変わっていない）
+        for _ in range(self.RETRIES):
+            try:
+                StockReservation.reserve(order, {self.product.pk: quantity})
+                return "reserved"
+            except OutOfStockError:
+                return "out_of_stock"
+            except OperationalError:
+                time.sleep(0.005)
+        return "errors"
+
+    def assert_no_oversell(self, quantity, results):
+        self.product.refresh_from_db()
+        held = StockReservation.objects.filter(product=self.product).aggregate(
+            total=models.Sum("quantity", default=0)
+        )["total"]
+        self.assertEqual(sum(results.values()), self.ATTEMPTS)
+        self.assertGreaterEqual(self.product.stock, 0)
+        self.assertEqual(self.product.stock + held, self.STOCK)
+        self.assertEqual(held, results["reserved"] * quantity)
+        if not results["errors"]:
+            self.assertEqual(
+                results["reserved"], min(self.STOCK // quantity, self.ATTEMPTS)
+            )
+
+    def test_single_unit(self):
+        results = self.run_reservations(1)
+        self.assert_no_oversell(1, results)
+
+    def test_multiple_units(self):
+        results = self.run_reservations(4)
+        self.assert_no_oversell(4, results)
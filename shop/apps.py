@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shop'
+
+    def ready(self):
+        from shop import signals  # noqa: F401
+        from shop import stripe_gateway
+
+        stripe_gateway.configure()
@@ -0,0 +1,610 @@
+"""カートの保存先（リポジトリ）
+
+ビューは get_cart_repository() で取得したリポジトリ経由でカートを読み書きする。
+保存先は settings.CART_REPOSITORY で切り替える。
+
+- database: carts / cart_items テーブルに直接読み書きする
+- cache: 操作中のカートを 'carts' キャッシュに {商品ID: 数量} で置き、
+  変更されたカートを一定間隔でまとめてテーブルに書き出す（チェックアウト時は即時）。
+  書き出していないカートは dirty_carts テーブルに記録するので、
+  プロセスが落ちてもほかのプロセスが書き出す
+"""
+
+import atexit
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.db import connections, transaction
+
+from model.models import Cart, CartItem, CartTotals, DirtyCart, TeaProduct
+
+logger = logging.getLogger(__name__)
+
+
+class CartLockTimeoutError(Exception):
+    """カートのロックを期限までに取れなかった"""
+
+
+def validate_changes(changes, quantities, stocks):
+    """数量の変更 {商品ID: 数量（0は削除）} を検証し、{商品ID: エラー} を返す
+
+    quantities はカート内の数量、stocks は商品の在庫。
+    """
+    errors = {}
+    for product_id, quantity in changes.items():
+        if product_id not in quantities:
+            errors[product_id] = "カートにない商品です"
+        elif quantity > 0 and quantity > stocks.get(product_id, 0):
+            errors[product_id] = (
+                f"在庫が不足しています（在庫: {stocks.get(product_id, 0)}個）"
+            )
+    return errors
+
+
+def apply_changes(lines, changes):
+    """{商品ID: 数量} に数量の変更を反映する"""
+    for product_id, quantity in changes.items():
+        if quantity:
+            lines[product_id] = quantity
+        else:
+            lines.pop(product_id, None)
+
+
+class DatabaseCartRepository:
+    """カートをテーブルに直接読み書きする"""
+
+    def get_totals(self, user_id):
+        """カートの明細と金額"""
+        cart = Cart.objects.filter(user_id=user_id).first()
+        if cart is None:
+            return CartTotals.from_items([])
+        return cart.totals
+
+    def get_quantity(self, user_id, product_id):
+        """カート内の商品の数量（カートになければNone）"""
+        return (
+            CartItem.objects.filter(cart__user_id=user_id, product_id=product_id)
+            .values_list("quantity", flat=True)
+            .first()
+        )
+
+    def add(self, user_id, product_id, quantity):
+        """商品を追加し (明細の数量, カート内の商品点数) を返す（追加できなければNone）"""
+        return CartItem.add_quantity(user_id, product_id, quantity)
+
+    def set_quantity(self, user_id, product_id, quantity):
+        """数量を変更する（在庫不足ならFalse、カートになければNone）"""
+        if CartItem.set_quantity(user_id, product_id, quantity):
+            return True
+        if self.get_quantity(user_id, product_id) is None:
+            return None
+        return False
+
+    def remove(self, user_id, product_id):
+        """商品をカートから削除する（カートになければFalse）"""
+        deleted, _ = CartItem.objects.filter(
+            cart__user_id=user_id, product_id=product_id
+        ).delete()
+        return bool(deleted)
+
+    def update_many(self, user_id, changes):
+        """数量をまとめて変更する（0は削除）
+
+        在庫とあわせて1回で読み込んで検証し、問題がなければ1つのトランザクションで
+        bulk_update と delete を行う。エラーがあれば何も変更せず {商品ID: エラー} を返す。
+        """
+        with transaction.atomic():
+            items = {
+                item.product_id: item
+                for item in CartItem.objects.select_for_update()
+                .select_related("product")
+                .filter(cart__user_id=user_id, product_id__in=list(changes))
+            }
+            errors = validate_changes(
+                changes,
+                {pid: item.quantity for pid, item in items.items()},
+                {pid: item.product.stock for pid, item in items.items()},
+            )
+            if errors:
+                return errors
+
+            updated = []
+            deleted = []
+            for product_id, quantity in changes.items():
+                item = items[product_id]
+                if quantity:
+                    item.quantity = quantity
+                    updated.append(item)
+                else:
+                    deleted.append(item.pk)
+            CartItem.objects.bulk_update(updated, ["quantity"])
+            CartItem.objects.filter(pk__in=deleted).delete()
+        return {}
+
+    def clear(self, user_id):
+        """カートを空にする"""
+        CartItem.objects.filter(cart__user_id=user_id).delete()
+
+    def merge(self, user_id, lines):
+        """{商品ID: 数量} をカートに加える（在庫を超える分は切り捨てる）"""
+        with transaction.atomic():
+            cart, _ = Cart.objects.get_or_create(user_id=user_id)
+            CartItem.merge_quantities(cart.pk, lines)
+
+    def flush(self, user_id=None):
+        """テーブルに直接書き込んでいるので何もしない"""
+
+
+class CachedCartRepository(DatabaseCartRepository):
+    """操作中のカートをキャッシュに置き、テーブルへはまとめて書き出す"""
+
+    # 同じカートを同時に変更しないためのロックの保持期間（秒）
+    LOCK_TIMEOUT = 5
+    # ロックを待つ時間（秒）。ロックを持ったまま落ちたプロセスのロックが
+    # 期限切れになるまでは待つ
+    LOCK_WAIT = LOCK_TIMEOUT + 1
+    # 一度にテーブルに書き出すカートの数
+    FLUSH_BATCH_SIZE = 500
+
+    def __init__(self):
+        self.cache = caches["carts"]
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+
+    def _key(self, user_id):
+        return f"cart:{user_id}"
+
+    def _dirty_key(self, user_id):
+        return f"cart_dirty:{user_id}"
+
+    @contextmanager
+    def _lock(self, user_id):
+        """カートのロック（期限までに取れなければ CartLockTimeoutError）
+
+        ロックには取得ごとの値を入れ、自分の値のときだけ削除する。保持期間を過ぎて
+        ほかのリクエストが取り直したロックを消さないようにするため。
+        """
+        key = f"cart_lock:{user_id}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.LOCK_WAIT
+        while not self.cache.add(key, token, self.LOCK_TIMEOUT):
+            if time.monotonic() > deadline:
+                raise CartLockTimeoutError(
+                    f"カート(user_id={user_id})のロックを取れません"
+                )
+            time.sleep(0.01)
+        try:
+            yield
+        finally:
+            if self.cache.get(key) == token:
+                self.cache.delete(key)
+
+    def _load(self, user_id):
+        """カートを {商品ID: 数量} で取得（キャッシュになければテーブルから読み込む）"""
+        lines = self.cache.get(self._key(user_id))
+        if lines is None:
+            lines = dict(
+                CartItem.objects.filter(cart__user_id=user_id)
+                .order_by("pk")
+                .values_list("product_id", "quantity")
+            )
+            # 同時に書き込まれたカートを上書きしないよう add で置く
+            if not self.cache.add(self._key(user_id), lines):
+                lines = self.cache.get(self._key(user_id), lines)
+        return lines
+
+    def _save(self, user_id, lines):
+        self.cache.set(self._key(user_id), lines)
+        # 書き出し待ちの印がなければテーブルにも記録する（書き出すまでは1回だけ）
+        if self.cache.add(self._dirty_key(user_id), 1):
+            DirtyCart.objects.bulk_create(
+                [DirtyCart(user_id=user_id)], ignore_conflicts=True
+            )
+        self._start_flusher()
+
+    def get_totals(self, user_id):
+        lines = self._load(user_id)
+        products = TeaProduct.objects.select_related("tea").in_bulk(list(lines))
+        items = [
+            CartItem(product=products[product_id], quantity=quantity)
+            for product_id, quantity in lines.items()
+            if product_id in products
+        ]
+        return CartTotals.from_items(items)
+
+    def get_quantity(self, user_id, product_id):
+        return self._load(user_id).get(product_id)
+
+    def add(self, user_id, product_id, quantity):
+        stock = (
+            TeaProduct.objects.filter(pk=product_id, is_available=True)
+            .values_list("stock", flat=True)
+            .first()
+        )
+        if stock is None:
+            return None
+
+        with self._lock(user_id):
+            lines = self._load(user_id)
+            item_quantity = lines.get(product_id, 0) + quantity
+            if item_quantity > stock:
+                return None
+            lines[product_id] = item_quantity
+            self._save(user_id, lines)
+        return item_quantity, sum(lines.values())
+
+    def set_quantity(self, user_id, product_id, quantity):
+        with self._lock(user_id):
+            lines = self._load(user_id)
+            if product_id not in lines:
+                return None
+            stock = (
+                TeaProduct.objects.filter(pk=product_id)
+                .values_list("stock", flat=True)
+                .first()
+            )
+            if stock is None or quantity > stock:
+                return False
+            lines[product_id] = quantity
+            self._save(user_id, lines)
+        return True
+
+    def remove(self, user_id, product_id):
+        with self._lock(user_id):
+            lines = self._load(user_id)
+            if lines.pop(product_id, None) is None:
+                return False
+            self._save(user_id, lines)
+        return True
+
+    def update_many(self, user_id, changes):
+        stocks = dict(
+            TeaProduct.objects.filter(pk__in=list(changes)).values_list("pk", "stock")
+        )
+        with self._lock(user_id):
+            lines = self._load(user_id)
+            errors = validate_changes(changes, lines, stocks)
+            if errors:
+                return errors
+            apply_changes(lines, changes)
+            self._save(user_id, lines)
+        return {}
+
+    def clear(self, user_id):
+        with self._lock(user_id):
+            self.cache.set(self._key(user_id), {})
+            with transaction.atomic():
+                DirtyCart.objects.filter(user_id=user_id).delete()
+                self.cache.delete(self._dirty_key(user_id))
+                super().clear(user_id)
+
+    def merge(self, user_id, lines):
+        stocks = dict(
+            TeaProduct.objects.filter(
+                pk__in=list(lines), is_available=True
+            ).values_list("pk", "stock")
+        )
+        with self._lock(user_id):
+            cart_lines = self._load(user_id)
+            for product_id, quantity in lines.items():
+                if stocks.get(product_id, 0) > 0:
+                    cart_lines[product_id] = min(
+                        cart_lines.get(product_id, 0) + quantity, stocks[product_id]
+                    )
+            self._save(user_id, cart_lines)
+
+    def flush(self, user_id=None):
+        """キャッシュのカートをテーブルに書き出す（省略時は書き出し待ちのカートすべて）"""
+        if user_id is not None:
+            # チェックアウト前などは、書き出し待ちの記録がなくても必ず書き出す
+            with self._lock(user_id), transaction.atomic():
+                self.cache.delete(self._dirty_key(user_id))
+                missing = self._write([user_id])
+                dirty = DirtyCart.objects.filter(user_id=user_id)
+                if missing and dirty.exists():
+                    log_missing_carts(missing)
+                else:
+                    dirty.delete()
+            return
+
+        last_user_id = 0
+        while True:
+            user_ids = list(
+                DirtyCart.objects.filter(user_id__gt=last_user_id)
+                .order_by("user_id")
+                .values_list("user_id", flat=True)[: self.FLUSH_BATCH_SIZE]
+            )
+            if not user_ids:
+                break
+            self._flush_batch(user_ids)
+            last_user_id = user_ids[-1]
+
+    def _flush_batch(self, user_ids):
+        """カートを書き出して、書き出し待ちの記録を消す
+
+        記録の削除と書き出しは1つのトランザクションで行うので、途中で落ちても
+        記録が残り次回に書き出される。ほかのプロセスが書き出し中の記録は飛ばす。
+        キャッシュから消えていたカートはエラーとして記録し、書き出し待ちのまま残す。
+        """
+        with transaction.atomic():
+            user_ids = list(
+                DirtyCart.objects.select_for_update(skip_locked=True)
+                .filter(user_id__in=user_ids)
+                .values_list("user_id", flat=True)
+            )
+            if not user_ids:
+                return
+            # 印を先に消してからカートを読むので、この後の変更は新しく記録される
+            self.cache.delete_many([self._dirty_key(user_id) for user_id in user_ids])
+            missing = self._write(user_ids)
+            if missing:
+                log_missing_carts(missing)
+            DirtyCart.objects.filter(user_id__in=user_ids).exclude(
+                user_id__in=missing
+            ).delete()
+
+    def _write(self, user_ids):
+        """キャッシュのカートをテーブルに書き出し、キャッシュになかったユーザーIDを返す"""
+        carts = self.cache.get_many([self._key(user_id) for user_id in user_ids])
+        lines_by_user = {
+            user_id: carts[self._key(user_id)]
+            for user_id in user_ids
+            if self._key(user_id) in carts
+        }
+        missing = [user_id for user_id in user_ids if user_id not in lines_by_user]
+        if not lines_by_user:
+            return missing
+
+        product_ids = {
+            product_id for lines in lines_by_user.values() for product_id in lines
+        }
+        # 書き出すまでの間に削除された商品は除く
+        product_ids = set(
+            TeaProduct.objects.filter(pk__in=product_ids).values_list("pk", flat=True)
+        )
+
+        with transaction.atomic():
+            Cart.objects.bulk_create(
+                [Cart(user_id=user_id) for user_id in lines_by_user],
+                ignore_conflicts=True,
+            )
+            cart_ids = dict(
+                Cart.objects.filter(user_id__in=lines_by_user).values_list(
+                    "user_id", "pk"
+                )
+            )
+
+            items = []
+            for user_id, lines in lines_by_user.items():
+                cart_id = cart_ids[user_id]
+                kept = [pid for pid in lines if pid in product_ids]
+                CartItem.objects.filter(cart_id=cart_id).exclude(
+                    product_id__in=kept
+                ).delete()
+                items.extend(
+                    CartItem(cart_id=cart_id, product_id=pid, quantity=lines[pid])
+                    for pid in kept
+                )
+
+            CartItem.objects.bulk_create(
+                items,
+                update_conflicts=True,
+                unique_fields=["cart", "product"],
+                update_fields=["quantity"],
+                batch_size=1000,
+            )
+        return missing
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._flusher_lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self._run_flusher, name="cart-flusher", daemon=True
+            )
+            self._flusher.start()
+        atexit.register(self.flush)
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(settings.CART_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("カートをテーブルに書き出せませんでした")
+            finally:
+                # このスレッドのデータベース接続は使い回さない
+                connections.close_all()
+
+
+def log_missing_carts(user_ids):
+    """書き出す前にキャッシュから消えたカート（変更が失われている）を記録する"""
+    logger.error(
+        "書き出し待ちのカートがキャッシュにありません (user_id=%s)。"
+        "キャッシュの保持件数や保持期間を確認してください",
+        user_ids,
+    )
+
+
+class UserCart:
+    """ログインユーザーのカート（リポジトリに読み書きする）"""
+
+    def __init__(self, repository, user_id):
+        self.repository = repository
+        self.user_id = user_id
+
+    def get_totals(self):
+        return self.repository.get_totals(self.user_id)
+
+    def get_quantity(self, product_id):
+        return self.repository.get_quantity(self.user_id, product_id)
+
+    def add(self, product_id, quantity):
+        return self.repository.add(self.user_id, product_id, quantity)
+
+    def set_quantity(self, product_id, quantity):
+        return self.repository.set_quantity(self.user_id, product_id, quantity)
+
+    def remove(self, product_id):
+        return self.repository.remove(self.user_id, product_id)
+
+    def update_many(self, changes):
+        return self.repository.update_many(self.user_id, changes)
+
+    def update_response(self, response):
+        return response
+
+
+class GuestCart:
+    """未ログインのカート
+
+    {商品ID: 数量} を "商品ID:数量,..." の形で署名付きCookieに保持する。
+    期限切れや改ざんされたCookieは読み込み時に捨て、レスポンスで削除する。
+    """
+
+    COOKIE_NAME = "guest_cart"
+    SALT = "shop.guest_cart"
+    # 最後にカートを変更してからの保持期間（秒）
+    MAX_AGE = 60 * 60 * 24 * 14
+    # Cookieの大きさを抑えるための商品の種類の上限
+    MAX_LINES = 50
+
+    def __init__(self, lines=None, invalid=False):
+        self.lines = lines or {}
+        self.invalid = invalid
+        self.changed = False
+
+    @classmethod
+    def from_request(cls, request):
+        if cls.COOKIE_NAME not in request.COOKIES:
+            return cls()
+        try:
+            value = request.get_signed_cookie(
+                cls.COOKIE_NAME, salt=cls.SALT, max_age=cls.MAX_AGE
+            )
+            lines = {}
+            for line in filter(None, value.split(",")):
+                product_id, quantity = line.split(":")
+                if int(quantity) > 0:
+                    lines[int(product_id)] = int(quantity)
+        except (signing.BadSignature, ValueError):
+            return cls(invalid=True)
+        return cls(lines)
+
+    def get_totals(self):
+        products = TeaProduct.objects.select_related("tea").in_bulk(list(self.lines))
+        items = [
+            CartItem(product=products[product_id], quantity=quantity)
+            for product_id, quantity in self.lines.items()
+            if product_id in products
+        ]
+        return CartTotals.from_items(items)
+
+    def get_quantity(self, product_id):
+        return self.lines.get(product_id)
+
+    def add(self, product_id, quantity):
+        stock = (
+            TeaProduct.objects.filter(pk=product_id, is_available=True)
+            .values_list("stock", flat=True)
+            .first()
+        )
+        item_quantity = self.lines.get(product_id, 0) + quantity
+        if stock is None or item_quantity > stock:
+            return None
+        if product_id not in self.lines and len(self.lines) >= self.MAX_LINES:
+            return None
+        self.lines[product_id] = item_quantity
+        self.changed = True
+        return item_quantity, sum(self.lines.values())
+
+    def set_quantity(self, product_id, quantity):
+        if product_id not in self.lines:
+            return None
+        stock = (
+            TeaProduct.objects.filter(pk=product_id)
+            .values_list("stock", flat=True)
+            .first()
+        )
+        if stock is None or quantity > stock:
+            return False
+        self.lines[product_id] = quantity
+        self.changed = True
+        return True
+
+    def remove(self, product_id):
+        if self.lines.pop(product_id, None) is None:
+            return False
+        self.changed = True
+        return True
+
+    def update_many(self, changes):
+        stocks = dict(
+            TeaProduct.objects.filter(pk__in=list(changes)).values_list("pk", "stock")
+        )
+        errors = validate_changes(changes, self.lines, stocks)
+        if errors:
+            return errors
+        apply_changes(self.lines, changes)
+        self.changed = True
+        return {}
+
+    def update_response(self, response):
+        """変更したカートをCookieに書き込む"""
+        if self.changed and self.lines:
+            response.set_signed_cookie(
+                self.COOKIE_NAME,
+                ",".join(f"{pid}:{quantity}" for pid, quantity in self.lines.items()),
+                salt=self.SALT,
+                max_age=self.MAX_AGE,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite="Lax",
+            )
+        elif self.changed or self.invalid:
+            response.delete_cookie(self.COOKIE_NAME, samesite="Lax")
+        return response
+
+
+def get_request_cart(request):
+    """リクエストのユーザーのカート（未ログインならCookieのカート）"""
+    if request.user.is_authenticated:
+        return UserCart(get_cart_repository(), request.user.pk)
+    return GuestCart.from_request(request)
+
+
+def merge_guest_cart(request, response):
+    """ログインしたユーザーのカートに未ログインのカートの商品を移す"""
+    guest_cart = GuestCart.from_request(request)
+    if guest_cart.lines:
+        get_cart_repository().merge(request.user.pk, guest_cart.lines)
+    if guest_cart.lines or guest_cart.invalid:
+        response.delete_cookie(GuestCart.COOKIE_NAME, samesite="Lax")
+    return response
+
+
+REPOSITORIES = {
+    "database": DatabaseCartRepository,
+    "cache": CachedCartRepository,
+}
+
+_repository = None
+_repository_lock = threading.Lock()
+
+
+def get_cart_repository():
+    """設定に応じたカートのリポジトリを取得"""
+    global _repository
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                _repository = REPOSITORIES[settings.CART_REPOSITORY]()
+    return _repository
@@ -0,0 +1,127 @@
+"""注文データの書き出し（発送・経理用）
+
+注文と注文明細を結合して明細1件につき1行にし、CSVかJSON Linesで少しずつ書き出す。
+行はサーバーサイドカーソル（iterator）で一定件数ずつ読み込むので、
+1年分の注文を書き出してもメモリの使用量は増えない。
+"""
+
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+
+from model.models import Order
+
+# 一度にデータベースから読み込む行数
+EXPORT_CHUNK_SIZE = 2000
+
+# まとめて送る行数（1行ずつ送ると書き込みの回数が多くなる）
+EXPORT_WRITE_BATCH_SIZE = 200
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "jsonl": ("application/x-ndjson; charset=utf-8", "jsonl"),
+}
+
+# (列名, 注文から辿るフィールド)
+COLUMNS = [
+    ("order_number", "order_number"),
+    ("ordered_at", "created_at"),
+    ("status", "status"),
+    ("email", "user__email"),
+    ("shipping_name", "shipping_name"),
+    ("shipping_postal_code", "shipping_postal_code"),
+    ("shipping_address", "shipping_address"),
+    ("shipping_phone", "shipping_phone"),
+    ("subtotal", "subtotal"),
+    ("tax_rate", "tax_rate"),
+    ("tax_amount", "tax_amount"),
+    ("shipping_fee", "shipping_fee"),
+    ("total_amount", "total_amount"),
+    ("stripe_payment_intent_id", "stripe_payment_intent_id"),
+    ("tea_name", "items__tea_name"),
+    ("weight", "items__weight"),
+    ("quantity", "items__quantity"),
+    ("price", "items__price"),
+    ("price_with_tax", "items__price_with_tax"),
+]
+
+
+def get_export_rows(date_from=None, date_to=None, statuses=None):
+    """条件に合う注文を明細ごとの行（タプル）で、注文日時の順に少しずつ返す
+
+    date_from / date_to は注文日（両端を含む）。明細のない注文も1行出す。
+    """
+    orders = Order.objects.all()
+    if date_from:
+        orders = orders.filter(created_at__gte=start_of_day(date_from))
+    if date_to:
+        orders = orders.filter(created_at__lt=start_of_day(date_to + timedelta(days=1)))
+    if statuses:
+        orders = orders.filter(status__in=statuses)
+    rows = orders.order_by("created_at", "pk", "items__pk").values_list(
+        *(field for _, field in COLUMNS)
+    )
+    for row in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield tuple(format_value(value) for value in row)
+
+
+def start_of_day(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def format_value(value):
+    if value is None:
+        return None
+    if hasattr(value, "isoformat"):
+        return timezone.localtime(value).isoformat()
+    if not isinstance(value, (int, str)):
+        # 税率（Decimal）
+        return str(value)
+    return value
+
+
+class Echo:
+    """書き込まれた値をそのまま返す（csv.writer の1行分の出力を受け取る）"""
+
+    def write(self, value):
+        return value
+
+
+# 表計算ソフトで数式として扱われる先頭の文字
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def escape_formula(value):
+    """数式として実行されないよう、数式に見える文字列の先頭に ' を付ける"""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    # Excelで開いても文字化けしないよう、BOMを付ける
+    yield "\ufeff" + writer.writerow([name for name, _ in COLUMNS])
+    for row in rows:
+        yield writer.writerow([escape_formula(value) for value in row])
+
+
+def stream_jsonl(rows):
+    names = [name for name, _ in COLUMNS]
+    for row in rows:
+        yield json.dumps(dict(zip(names, row)), ensure_ascii=False) + "\n"
+
+
+def stream(rows, export_format):
+    """行を指定の形式の文字列にして、一定行数ずつまとめて返す"""
+    lines = stream_jsonl(rows) if export_format == "jsonl" else stream_csv(rows)
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= EXPORT_WRITE_BATCH_SIZE:
+            yield "".join(batch)
+            batch = []
+    if batch:
+        yield "".join(batch)
@@ -1,6 +1,10 @@
 from django import forms
 from django.core.validators import MaxValueValidator
 
+from model.models import Order
+
+from .exports import FORMATS
+
 
 class AddToCartForm(forms.Form):
     """カートに追加フォーム"""
@@ -139,3 +143,24 @@ class CheckoutForm(forms.Form):
         if len(phone_digits) not in [10, 11]:
             raise forms.ValidationError("電話番号は10桁または11桁で入力してください")
         return phone
+
+
+class OrderExportForm(forms.Form):
+    """注文の書き出しの条件"""
+
+    format = forms.ChoiceField(
+        choices=[(key, key) for key in FORMATS], required=False, label="形式"
+    )
+    date_from = forms.DateField(required=False, label="注文日（から）")
+    date_to = forms.DateField(required=False, label="注文日（まで）")
+    status = forms.MultipleChoiceField(
+        choices=Order.STATUS_CHOICES, required=False, label="ステータス"
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get("date_from")
+        date_to = cleaned_data.get("date_to")
+        if date_from and date_to and date_from > date_to:
+            raise forms.ValidationError("注文日の範囲が正しくありません")
+        return cleaned_data
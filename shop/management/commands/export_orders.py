@@ -0,0 +1,51 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from model.models import Order
+from shop import exports
+
+
+class Command(BaseCommand):
+    help = "注文を明細ごとにCSVかJSON Linesで書き出す（発送・経理用）"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format", choices=list(exports.FORMATS), default="csv", help="形式"
+        )
+        parser.add_argument(
+            "--date-from", type=date.fromisoformat, help="注文日（から） YYYY-MM-DD"
+        )
+        parser.add_argument(
+            "--date-to", type=date.fromisoformat, help="注文日（まで） YYYY-MM-DD"
+        )
+        parser.add_argument(
+            "--status",
+            action="append",
+            choices=[value for value, _ in Order.STATUS_CHOICES],
+            help="ステータス（複数指定できる）",
+        )
+        parser.add_argument(
+            "--output", "-o", help="書き出すファイル（省略すると標準出力）"
+        )
+
+    def handle(self, *args, **options):
+        if (
+            options["date_from"]
+            and options["date_to"]
+            and options["date_from"] > options["date_to"]
+        ):
+            raise CommandError("注文日の範囲が正しくありません")
+
+        rows = exports.get_export_rows(
+            options["date_from"], options["date_to"], options["status"]
+        )
+        chunks = exports.stream(rows, options["format"])
+        if not options["output"]:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
+            return
+        with open(options["output"], "w", encoding="utf-8", newline="") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        self.stderr.write(self.style.SUCCESS(f"{options['output']} に書き出しました"))
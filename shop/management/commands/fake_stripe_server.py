@@ -0,0 +1,180 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Checkout Sessionの作成・取得・期限切れと、Product・Priceの作成に応答する"
+        "偽のStripe APIサーバーを起動する"
+        "（STRIPE_API_BASE をこのサーバーのURLにして、オフラインで負荷試験をする）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=12111, help="待ち受けるポート")
+        parser.add_argument(
+            "--latency", type=float, default=0.1, help="応答までの待ち時間（秒）"
+        )
+        parser.add_argument(
+            "--jitter", type=float, default=0.05, help="待ち時間のばらつき（秒）"
+        )
+        parser.add_argument(
+            "--error-rate", type=float, default=0.0, help="500エラーを返す割合（0〜1）"
+        )
+        parser.add_argument(
+            "--stall-rate",
+            type=float,
+            default=0.0,
+            help="応答せずに --stall 秒待たせる割合（0〜1）",
+        )
+        parser.add_argument(
+            "--stall",
+            type=float,
+            default=30.0,
+            help="応答しない場合に待たせる時間（秒）",
+        )
+        parser.add_argument(
+            "--unpaid",
+            action="store_true",
+            help="取得したセッションを支払い済みにしない",
+        )
+
+    def handle(self, *args, **options):
+        sessions = {}
+        lock = threading.Lock()
+        stdout = self.stdout
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path in ("/v1/products", "/v1/prices"):
+                    return self.create_object(self.path[len("/v1/") : -1])
+                if self.path.startswith("/v1/checkout/sessions/") and (
+                    self.path.endswith("/expire")
+                ):
+                    return self.expire_session(self.path.split("/")[-2])
+                if self.path != "/v1/checkout/sessions":
+                    return self.send_json(404, error("リソースが見つかりません"))
+                if not self.simulate():
+                    return
+                form = self.read_form()
+                key = self.headers.get("Idempotency-Key")
+                with lock:
+                    # 同じ冪等キーには同じセッションを返す
+                    session = sessions.get(key) if key else None
+                    if session is None:
+                        session_id = f"cs_test_{uuid.uuid4().hex}"
+                        session = {
+                            "id": session_id,
+                            "object": "checkout.session",
+                            "url": f"http://localhost:{options['port']}/pay/{session_id}",
+                            "status": "open",
+                            "payment_status": "unpaid",
+                            "payment_intent": None,
+                            "metadata": {
+                                name[len("metadata[") : -1]: values[0]
+                                for name, values in form.items()
+                                if name.startswith("metadata[")
+                            },
+                        }
+                        sessions[session_id] = session
+                        if key:
+                            sessions[key] = session
+                self.send_json(200, session)
+
+            def do_GET(self):
+                prefix = "/v1/checkout/sessions/"
+                path = self.path.split("?")[0]
+                session_id = path[len(prefix) :]
+                with lock:
+                    session = sessions.get(session_id)
+                    if not path.startswith(prefix) or session is None:
+                        return self.send_json(404, error("セッションが見つかりません"))
+                    if session["status"] == "open" and not options["unpaid"]:
+                        session["status"] = "complete"
+                        session["payment_status"] = "paid"
+                        session["payment_intent"] = f"pi_test_{session_id[8:]}"
+                if self.simulate():
+                    self.send_json(200, session)
+
+            def expire_session(self, session_id):
+                """Checkout Sessionの期限切れ（reap_pending_orders 用）"""
+                if not self.simulate():
+                    return
+                with lock:
+                    session = sessions.get(session_id)
+                    if session is None:
+                        return self.send_json(404, error("セッションが見つかりません"))
+                    if session["status"] != "open":
+                        return self.send_json(
+                            400, error("期限切れにできるのは未完了のセッションだけです")
+                        )
+                    session["status"] = "expired"
+                self.send_json(200, session)
+
+            def create_object(self, object_type):
+                """Product・Priceの作成（sync_stripe_prices 用）"""
+                form = self.read_form()
+                prefix = "prod" if object_type == "product" else "price"
+                body = {
+                    "id": f"{prefix}_test_{uuid.uuid4().hex}",
+                    "object": object_type,
+                }
+                body.update({name: values[0] for name, values in form.items()})
+                self.send_json(200, body)
+
+            def read_form(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return parse_qs(self.rfile.read(length).decode())
+
+            def simulate(self):
+                """遅延・エラー・無応答を再現する（応答を続けるならTrue）"""
+                roll = random.random()
+                if roll < options["stall_rate"]:
+                    time.sleep(options["stall"])
+                    return False
+                time.sleep(
+                    max(
+                        0,
+                        options["latency"] + random.uniform(-1, 1) * options["jitter"],
+                    )
+                )
+                if roll < options["stall_rate"] + options["error_rate"]:
+                    self.send_json(500, error("偽のサーバーエラー", "api_error"))
+                    return False
+                return True
+
+            def send_json(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                stdout.write(f"{self.address_string()} {format % args}")
+
+        server = ThreadingHTTPServer(("127.0.0.1", options["port"]), Handler)
+        server.daemon_threads = True
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"偽のStripe APIサーバーを起動しました: "
+                f"STRIPE_API_BASE=http://localhost:{options['port']}"
+            )
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def error(message, error_type="invalid_request_error"):
+    return {"error": {"type": error_type, "message": message}}
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop import payments
+
+
+class Command(BaseCommand):
+    help = "台帳に保存したStripeのイベントをワーカーでまとめて注文に反映する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=4, help="同時に反映するワーカーの数"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=100, help="1回に読み込むイベントの数"
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="終了せずに、一定間隔で未処理のイベントを反映し続ける",
+        )
+        parser.add_argument(
+            "--interval", type=float, default=1.0, help="--loop のときの間隔（秒）"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = payments.drain(options["batch_size"], options["workers"])
+            if processed or not options["loop"]:
+                self.stdout.write(
+                    self.style.SUCCESS(f"{processed}件のイベントを反映しました")
+                )
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,138 @@
+import time
+from datetime import datetime, timedelta
+
+import stripe
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from model.models import JobCheckpoint, Order, StockReservation
+
+CHECKPOINT_NAME = "reap_pending_orders"
+
+
+class Command(BaseCommand):
+    help = (
+        "支払い待ちのまま放置された注文のCheckout Sessionを期限切れにして、"
+        "注文をキャンセルする（前回の続きから一定件数ずつ処理する）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=float,
+            default=24,
+            help="作成からこの時間（時間）が過ぎた支払い待ちの注文を対象にする",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=100, help="1回に処理する注文の数"
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="終了せずに、最後まで処理したら --interval 秒待って最初から繰り返す",
+        )
+        parser.add_argument(
+            "--interval", type=float, default=60, help="--loop のときの間隔（秒）"
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            cancelled, finished = self.run_batch(options)
+            total += cancelled
+            if not finished:
+                continue
+            self.stdout.write(
+                self.style.SUCCESS(f"{total}件の注文をキャンセルしました")
+            )
+            if not options["loop"]:
+                return
+            total = 0
+            time.sleep(options["interval"])
+
+    def run_batch(self, options):
+        """前回の続きから1バッチ分処理し、(キャンセルした件数, 最後まで処理したか) を返す"""
+        cutoff = timezone.now() - timedelta(hours=options["older_than"])
+        # (status, created_at) のインデックスで範囲を絞り、前回の位置から続きを読む
+        orders = Order.objects.filter(status="pending", created_at__lt=cutoff)
+        position = JobCheckpoint.get_position(CHECKPOINT_NAME)
+        if position:
+            created_at = datetime.fromisoformat(position["created_at"])
+            orders = orders.filter(
+                Q(created_at__gt=created_at)
+                | Q(created_at=created_at, pk__gt=position["id"])
+            )
+        batch = list(
+            orders.order_by("created_at", "pk").values_list(
+                "pk", "created_at", "stripe_checkout_session_id"
+            )[: options["batch_size"]]
+        )
+
+        reapable = []
+        last = None
+        interrupted = False
+        for order_id, created_at, session_id in batch:
+            try:
+                if self.expire_session(session_id):
+                    reapable.append(order_id)
+                else:
+                    self.stdout.write(
+                        f"order_id={order_id}: 支払いが完了しているためスキップします"
+                    )
+            except stripe.StripeError as e:
+                # 続きは次回に回す
+                self.stderr.write(f"Stripeに接続できないため中断します: {e}")
+                interrupted = True
+                break
+            last = (order_id, created_at)
+
+        cancelled = self.cancel(reapable)
+        if last is not None:
+            JobCheckpoint.set_position(
+                CHECKPOINT_NAME,
+                {"created_at": last[1].isoformat(), "id": last[0]},
+            )
+        if len(batch) < options["batch_size"] and not interrupted:
+            # 最後まで処理したので、次回は最初から
+            JobCheckpoint.set_position(CHECKPOINT_NAME, {})
+        return cancelled, interrupted or len(batch) < options["batch_size"]
+
+    def expire_session(self, session_id):
+        """Checkout Sessionを期限切れにする（支払いが完了していればFalse）"""
+        if not session_id:
+            return True
+        try:
+            stripe.checkout.Session.expire(session_id)
+        except stripe.InvalidRequestError:
+            # すでに期限切れか、支払いが完了しているか、セッションが存在しない
+            try:
+                session = stripe.checkout.Session.retrieve(session_id)
+            except stripe.InvalidRequestError:
+                return True
+            return session.status != "complete"
+        return True
+
+    def cancel(self, order_ids):
+        """注文をまとめてキャンセルし、取り置いていた在庫を戻す
+
+        Order.cancel_unpaid と同じく注文の行ロックを取ってから変更する。
+        支払いの反映中（ロック中）の注文は飛ばし、次の周回で確認し直す。
+        """
+        if not order_ids:
+            return 0
+        with transaction.atomic():
+            locked_ids = list(
+                Order.objects.select_for_update(skip_locked=True)
+                .filter(pk__in=order_ids, status="pending")
+                .values_list("pk", flat=True)
+            )
+            if not locked_ids:
+                return 0
+            StockReservation.release(
+                StockReservation.objects.filter(order_id__in=locked_ids, status="held")
+            )
+            return Order.objects.filter(pk__in=locked_ids).update(
+                status="cancelled", updated_at=timezone.now()
+            )
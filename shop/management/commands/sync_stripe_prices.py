@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop import stripe_prices
+
+
+class Command(BaseCommand):
+    help = (
+        "お茶の商品と送料の、現在と今後の税込価格に対応するStripeのPriceを作成する"
+        "（--loop では、価格・税率・送料が保存されたときだけ作成する）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="終了せずに、一定間隔で同期の依頼を確認して同期し続ける",
+        )
+        parser.add_argument(
+            "--interval", type=float, default=10.0, help="--loop のときの間隔（秒）"
+        )
+
+    def handle(self, *args, **options):
+        if not options["loop"]:
+            created = stripe_prices.sync_prices()
+            self.stdout.write(self.style.SUCCESS(f"{created}件のPriceを作成しました"))
+            return
+        while True:
+            created = stripe_prices.sync_if_requested()
+            if created is not None:
+                self.stdout.write(
+                    self.style.SUCCESS(f"{created}件のPriceを作成しました")
+                )
+            time.sleep(options["interval"])
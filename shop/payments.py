@@ -0,0 +1,174 @@
+"""Stripeのイベントの反映
+
+webhookで受け取ったイベントは record_event() で台帳（StripeEvent）に保存するだけにして
+すぐに200を返し、process_stripe_events コマンドのワーカーがまとめて注文に反映する。
+決済完了画面から戻ってきた支払いも同じ台帳に記録して、その場で反映する。
+
+同じイベントの再送は台帳のイベントIDの一意制約で1件にまとめ、
+決済完了画面とwebhookの両方から届いた同じ支払いは注文の行ロックで1回だけ反映する。
+反映に失敗したイベントは、間隔を空けてから再実行する。
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from model.models import Order, StripeEvent
+
+logger = logging.getLogger(__name__)
+
+# この回数だけ反映に失敗したイベントは失敗として残し、自動では再実行しない
+MAX_ATTEMPTS = 5
+
+# 反映に失敗したイベントを再実行するまでの間隔（失敗するたびに倍にし、上限で止める）
+RETRY_DELAY = timedelta(seconds=30)
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+PAID_EVENT_TYPES = (
+    "checkout.session.completed",
+    "checkout.session.async_payment_succeeded",
+)
+CANCEL_EVENT_TYPES = (
+    "checkout.session.expired",
+    "checkout.session.async_payment_failed",
+)
+
+
+def record_event(payload):
+    """イベントを台帳に保存する（保存済みのイベントならFalse）"""
+    session = {}
+    if payload["type"].startswith("checkout.session."):
+        session = payload["data"]["object"]
+    try:
+        with transaction.atomic():
+            StripeEvent.objects.create(
+                event_id=payload["id"],
+                event_type=payload["type"],
+                checkout_session_id=session.get("id", ""),
+                payload=payload,
+            )
+    except IntegrityError:
+        return False
+    return True
+
+
+def record_checkout_session(session, order):
+    """決済完了画面で取得したセッションを台帳に記録し、すぐに注文に反映する
+
+    イベントIDに支払い状況を含めるので、未入金で戻ってきた後に入金済みで
+    戻ってきた場合も別のイベントとして記録して反映する。
+    webhookで同じ支払いを反映済みなら、注文の行ロックの中で何もしない。
+    """
+    event_id = f"redirect:{session.id}:{session.payment_status}"
+    record_event(
+        {
+            "id": event_id,
+            "type": "checkout.session.completed",
+            "data": {
+                "object": {
+                    "id": session.id,
+                    "payment_status": session.payment_status,
+                    "payment_intent": session.payment_intent,
+                    "metadata": {"order_id": str(order.pk)},
+                }
+            },
+        }
+    )
+    process_event(StripeEvent.objects.get(event_id=event_id).pk)
+
+
+def apply_event(event):
+    """イベントの内容を注文に反映する"""
+    session = event.payload["data"]["object"]
+    order_id = session.get("metadata", {}).get("order_id")
+    if not order_id:
+        return
+
+    if event.event_type in PAID_EVENT_TYPES:
+        # コンビニ払いなどは完了時点では未入金なので、入金済みのときだけ反映する
+        if session.get("payment_status") != "paid":
+            return
+        shortages = Order.mark_paid(order_id, session.get("payment_intent"))
+        if shortages:
+            logger.warning(
+                "order_id=%s: 在庫を確保できなかった商品があります (product_id=%s)",
+                order_id,
+                shortages,
+            )
+    elif event.event_type in CANCEL_EVENT_TYPES:
+        Order.cancel_unpaid(order_id)
+
+
+def process_event(pk):
+    """台帳のイベントを1件反映する（反映できたらTrue）"""
+    try:
+        with transaction.atomic():
+            # 未処理のものだけを処理済みにし、同じイベントを二重に反映しないようにする
+            claimed = StripeEvent.objects.filter(pk=pk, status="pending").update(
+                status="processed", processed_at=timezone.now()
+            )
+            if not claimed:
+                return False
+            apply_event(StripeEvent.objects.get(pk=pk))
+    except Exception as e:
+        logger.exception("Stripeイベント(id=%s)を反映できませんでした", pk)
+        record_failure(pk, e)
+        return False
+    return True
+
+
+def get_retry_delay(attempts):
+    """失敗回数に応じた再実行までの間隔"""
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def record_failure(pk, error):
+    """反映の失敗を記録し、次に反映する日時を遅らせる（上限の回数で失敗にする）"""
+    with transaction.atomic():
+        event = StripeEvent.objects.select_for_update().get(pk=pk)
+        if event.status != "pending":
+            return
+        event.attempts += 1
+        event.last_error = str(error)
+        if event.attempts >= MAX_ATTEMPTS:
+            event.status = "failed"
+        else:
+            event.next_attempt_at = timezone.now() + get_retry_delay(event.attempts)
+        event.save(
+            update_fields=["attempts", "last_error", "status", "next_attempt_at"]
+        )
+
+
+def process_events(pks):
+    """ワーカーのスレッドで複数のイベントを順に反映する"""
+    try:
+        return sum(process_event(pk) for pk in pks)
+    finally:
+        connection.close()
+
+
+def drain(batch_size=100, workers=4):
+    """反映する時刻になった未処理のイベントがなくなるまでまとめて反映し、
+    反映した件数を返す
+
+    失敗したイベントは次に反映する日時が先になるので、同じ呼び出しの中では再実行しない。
+    """
+    processed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            pks = list(
+                StripeEvent.objects.filter(
+                    status="pending", next_attempt_at__lte=timezone.now()
+                )
+                .order_by("received_at", "pk")
+                .values_list("pk", flat=True)[:batch_size]
+            )
+            if not pks:
+                return processed
+            # 同じ注文のイベントが別のワーカーに分かれても、注文の行ロックで順に反映される
+            size = -(-len(pks) // workers)
+            chunks = [pks[i : i + size] for i in range(0, len(pks), size)]
+            processed += sum(executor.map(process_events, chunks))
@@ -0,0 +1,17 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from model.models import ShippingFee, TaxRate, TeaProduct
+from shop import stripe_prices
+
+
+@receiver(post_save, sender=TeaProduct)
+@receiver(post_save, sender=TaxRate)
+@receiver(post_delete, sender=TaxRate)
+@receiver(post_save, sender=ShippingFee)
+@receiver(post_delete, sender=ShippingFee)
+def request_stripe_price_sync(sender, raw=False, **kwargs):
+    """価格・税率・送料の変更で、StripeのPriceの同期を依頼する"""
+    if raw:
+        return
+    stripe_prices.request_sync()
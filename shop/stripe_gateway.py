@@ -0,0 +1,152 @@
+"""Stripe APIの呼び出し
+
+Stripeへのリクエストは上限つきの専用スレッドプールで実行し、非同期ビューから await する。
+1回ごとにタイムアウトを設け、通信エラーやStripe側のエラーはジッター付きの
+指数バックオフで再試行する。失敗が続いたらサーキットブレーカーを開き、しばらくは
+Stripeを呼ばずにすぐエラーにして、遅いStripeを待つリクエストが溜まらないようにする。
+
+ブレーカーの状態はプロセスごとに持つ。
+"""
+
+import asyncio
+import functools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from django.conf import settings
+
+# 再試行の最初の待ち時間（秒）。2回目以降は倍にしていく
+RETRY_BASE_DELAY = 0.2
+
+
+def configure():
+    """Stripeクライアントの設定（アプリの起動時に呼ぶ）"""
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    stripe.api_base = settings.STRIPE_API_BASE
+    # 再試行はこのモジュールで行う
+    stripe.max_network_retries = 0
+    # タイムアウトしたあとも通信を続けてプールのスレッドをふさがないよう、HTTPにも同じ上限を設ける
+    stripe.default_http_client = stripe.RequestsClient(timeout=settings.STRIPE_TIMEOUT)
+
+
+class StripeUnavailableError(Exception):
+    """Stripeに接続できない（再試行しても失敗した、またはブレーカーが開いている）"""
+
+
+class CircuitBreaker:
+    """失敗が続いたら一定時間呼び出しを止める
+
+    閉: 通常どおり呼ぶ。failure_threshold 回続けて失敗すると開く。
+    開: reset_timeout 秒のあいだは呼ばずに失敗させる。過ぎたら1件だけ試す（半開）。
+    半開: 試した1件が成功すれば閉じ、失敗すればまた開く。
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """呼び出してよいか"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+breaker = CircuitBreaker(
+    settings.STRIPE_CIRCUIT_THRESHOLD, settings.STRIPE_CIRCUIT_RESET_TIMEOUT
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Stripeの呼び出し専用のスレッドプール"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.STRIPE_POOL_SIZE, thread_name_prefix="stripe"
+            )
+        return _executor
+
+
+def is_retryable(error):
+    """再試行すれば成功する見込みのあるエラーか"""
+    if isinstance(
+        error, (TimeoutError, stripe.APIConnectionError, stripe.RateLimitError)
+    ):
+        return True
+    return isinstance(error, stripe.APIError) and (
+        error.http_status is None or error.http_status >= 500
+    )
+
+
+async def call(func, *args, **kwargs):
+    """Stripe APIをスレッドプールで呼び出して結果を待つ
+
+    リクエストの内容に誤りがある場合などはStripeのエラーをそのまま送出し、
+    接続できない場合は StripeUnavailableError を送出する。
+    """
+    if not breaker.allow():
+        raise StripeUnavailableError("Stripeへの接続を一時的に停止しています")
+
+    loop = asyncio.get_running_loop()
+    for attempt in range(settings.STRIPE_MAX_RETRIES + 1):
+        try:
+            # プールの空き待ちも含めてタイムアウトにする
+            result = await asyncio.wait_for(
+                loop.run_in_executor(
+                    get_executor(), functools.partial(func, *args, **kwargs)
+                ),
+                settings.STRIPE_TIMEOUT,
+            )
+        except Exception as e:
+            if not is_retryable(e):
+                # Stripeからは応答があったので、接続の失敗としては数えない
+                breaker.record_success()
+                raise
+            if attempt == settings.STRIPE_MAX_RETRIES:
+                breaker.record_failure()
+                raise StripeUnavailableError("Stripeに接続できませんでした") from e
+            # 再試行が同じタイミングに集中しないよう、待ち時間をばらつかせる
+            await asyncio.sleep(
+                RETRY_BASE_DELAY * 2**attempt * random.uniform(0.5, 1.5)
+            )
+        else:
+            breaker.record_success()
+            return result
+
+
+async def create_checkout_session(**params):
+    """Checkout Sessionを作成（再試行しても二重に作られないよう冪等キーを渡すこと）"""
+    return await call(stripe.checkout.Session.create, **params)
+
+
+async def retrieve_checkout_session(session_id):
+    """Checkout Sessionを取得"""
+    return await call(stripe.checkout.Session.retrieve, session_id)
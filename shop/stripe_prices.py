@@ -0,0 +1,181 @@
+"""StripeのPrice（価格）の同期
+
+お茶の商品ごと・税込価格ごとにStripeのProduct/Priceを作って StripePrice に保存しておき、
+チェックアウトでは price_data の代わりにPrice IDだけを送る。
+sync_stripe_prices コマンドで、現在と今後の税率・送料に必要なPriceをまとめて作成する。
+商品の価格・税率・送料が保存されると request_sync() で同期を依頼し、
+sync_stripe_prices --loop のワーカーが依頼のあったときだけ同期する。
+まだPriceのない明細（同期が終わるまでの間など）は price_data で送る。
+"""
+
+import stripe
+from django.utils import timezone
+
+from model.models import (
+    CacheGeneration,
+    JobCheckpoint,
+    ShippingFee,
+    StripePrice,
+    TaxRate,
+    TeaProduct,
+)
+
+# 税率・送料の設定がない場合の値（TaxRate.get_current_rate / ShippingFee.get_current_fee と同じ）
+DEFAULT_TAX_RATE = 10.00
+DEFAULT_SHIPPING_FEE = 800
+
+# 同期の依頼の番号（価格・税率・送料が保存されるたびに進める）
+SYNC_GENERATION_NAME = "stripe_prices_sync"
+# 最後に同期した依頼の番号
+CHECKPOINT_NAME = "sync_stripe_prices"
+
+
+def get_upcoming_values(periods, default, day=None):
+    """今日の値と、今後適用される値のリスト
+
+    periods は [(適用開始日, 値), ...] を適用開始日の昇順で並べたもの。
+    """
+    day = day or timezone.localdate()
+    current = default
+    upcoming = []
+    for start_date, value in periods:
+        if start_date <= day:
+            current = value
+        else:
+            upcoming.append(value)
+    return list(dict.fromkeys([current, *upcoming]))
+
+
+def sync_prices():
+    """現在と今後の税率・送料で必要なPriceを作成し、作成した件数を返す"""
+    tax_rates = get_upcoming_values(TaxRate.get_active_periods(), DEFAULT_TAX_RATE)
+    shipping_fees = get_upcoming_values(
+        [
+            (start_date, shipping.fee)
+            for start_date, shipping in ShippingFee.get_active_periods()
+        ],
+        DEFAULT_SHIPPING_FEE,
+    )
+
+    existing = set(StripePrice.objects.values_list("lookup_key", flat=True))
+    # 商品ごとのStripe Product ID（送料は product_id が None）
+    stripe_product_ids = dict(
+        StripePrice.objects.values_list("product_id", "stripe_product_id").distinct()
+    )
+
+    created = 0
+    for product in TeaProduct.objects.select_related("tea").order_by("pk"):
+        for tax_rate in tax_rates:
+            unit_amount = product.get_price_with_tax(tax_rate)
+            lookup_key = StripePrice.product_key(product.pk, unit_amount)
+            if lookup_key in existing:
+                continue
+            if product.pk not in stripe_product_ids:
+                stripe_product_ids[product.pk] = stripe.Product.create(
+                    name=f"{product.tea.name} ({product.weight}g)",
+                    metadata={"tea_product_id": product.pk},
+                ).id
+            create_price(
+                lookup_key, product, unit_amount, stripe_product_ids[product.pk]
+            )
+            existing.add(lookup_key)
+            created += 1
+
+    for fee in shipping_fees:
+        lookup_key = StripePrice.shipping_key(fee)
+        if fee <= 0 or lookup_key in existing:
+            continue
+        if None not in stripe_product_ids:
+            stripe_product_ids[None] = stripe.Product.create(name="送料").id
+        create_price(lookup_key, None, fee, stripe_product_ids[None])
+        existing.add(lookup_key)
+        created += 1
+
+    if created:
+        StripePrice.invalidate_cache()
+    return created
+
+
+def request_sync():
+    """Priceの同期を依頼する（ワーカーが次に確認したときに同期する）"""
+    CacheGeneration.bump(SYNC_GENERATION_NAME)
+
+
+def sync_if_requested():
+    """前回の同期より後に依頼があれば同期し、作成した件数を返す（依頼がなければNone）"""
+    requested = CacheGeneration.get_value(SYNC_GENERATION_NAME)
+    synced = JobCheckpoint.get_position(CHECKPOINT_NAME).get("generation", 0)
+    if requested <= synced:
+        return None
+    # 同期中に届いた依頼は番号が進むので、次の確認で同期し直す
+    created = sync_prices()
+    JobCheckpoint.set_position(CHECKPOINT_NAME, {"generation": requested})
+    return created
+
+
+def create_price(lookup_key, product, unit_amount, stripe_product_id):
+    price = stripe.Price.create(
+        product=stripe_product_id,
+        unit_amount=unit_amount,
+        currency="jpy",
+        lookup_key=lookup_key,
+        # 手元の記録を消して作り直した場合も、同じキーを新しいPriceに付け替える
+        transfer_lookup_key=True,
+    )
+    StripePrice.objects.create(
+        lookup_key=lookup_key,
+        product=product,
+        unit_amount=unit_amount,
+        stripe_product_id=stripe_product_id,
+        stripe_price_id=price.id,
+    )
+
+
+def get_line_items(totals):
+    """カートの明細と送料からCheckout Sessionの line_items を作る
+
+    同期済みのPriceはIDだけを送り、まだないものは price_data で送る。
+    """
+    price_ids = StripePrice.get_price_ids()
+    line_items = []
+
+    # 商品
+    for item in totals.items:
+        unit_amount = item.product.get_price_with_tax(totals.tax_rate)
+        price_id = price_ids.get(StripePrice.product_key(item.product_id, unit_amount))
+        if price_id:
+            line_items.append({"price": price_id, "quantity": item.quantity})
+            continue
+        line_items.append(
+            {
+                "price_data": {
+                    "currency": "jpy",
+                    "product_data": {
+                        "name": f"{item.product.tea.name} ({item.product.weight}g)",
+                    },
+                    "unit_amount": unit_amount,  # 税込価格
+                },
+                "quantity": item.quantity,
+            }
+        )
+
+    # 送料
+    if totals.shipping_fee > 0:
+        price_id = price_ids.get(StripePrice.shipping_key(totals.shipping_fee))
+        if price_id:
+            line_items.append({"price": price_id, "quantity": 1})
+        else:
+            line_items.append(
+                {
+                    "price_data": {
+                        "currency": "jpy",
+                        "product_data": {
+                            "name": "送料",
+                        },
+                        "unit_amount": totals.shipping_fee,
+                    },
+                    "quantity": 1,
+                }
+            )
+
+    return line_items
@@ -0,0 +1,296 @@
+import csv
+import io
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.messages import get_messages
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from model.models import (
+    Cart,
+    CartItem,
+    CartTotals,
+    DirtyCart,
+    Order,
+    StripeEvent,
+    TaxRate,
+    Tea,
+    TeaProduct,
+    User,
+)
+from shop import exports, payments, stripe_prices
+from shop.carts import CachedCartRepository
+
+SHIPPING = {
+    "shipping_name": "山田",
+    "shipping_postal_code": "100-0001",
+    "shipping_address": "東京都",
+    "shipping_phone": "0312345678",
+}
+
+
+class StreamCsvTests(SimpleTestCase):
+    def read_rows(self, rows):
+        text = "".join(exports.stream_csv(rows)).removeprefix("\ufeff")
+        return list(csv.reader(io.StringIO(text)))[1:]
+
+    def test_escapes_cells_that_look_like_formulas(self):
+        rows = self.read_rows(
+            [
+                (
+                    '=HYPERLINK("http://example.com")',
+                    "+81312345678",
+                    "-1+1",
+                    "@SUM(A1)",
+                    "\t=1+1",
+                )
+            ]
+        )
+        self.assertEqual(
+            rows,
+            [
+                [
+                    '\'=HYPERLINK("http://example.com")',
+                    "'+81312345678",
+                    "'-1+1",
+                    "'@SUM(A1)",
+                    "'\t=1+1",
+                ]
+            ],
+        )
+
+    def test_keeps_other_values(self):
+        rows = self.read_rows([("山田", "東京都千代田区1-1", 1200, None)])
+        self.assertEqual(rows, [["山田", "東京都千代田区1-1", "1200", ""]])
+
+    def test_jsonl_keeps_values_as_is(self):
+        row = ("=1+1",) + (None,) * (len(exports.COLUMNS) - 1)
+        lines = list(exports.stream_jsonl([row]))
+        self.assertIn('"order_number": "=1+1"', lines[0])
+
+
+class CachedCartRepositoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="user@example.com", password="password", is_active=True
+        )
+        tea = Tea.objects.create(name="煎茶", steam_type="deep")
+        cls.product = TeaProduct.objects.create(
+            tea=tea, weight=100, price=1000, stock=10
+        )
+
+    def setUp(self):
+        self.repository = CachedCartRepository()
+        self.repository.cache.clear()
+        # テスト中に書き出し用のスレッドを動かさない
+        self.repository._flusher = object()
+
+    def get_lines(self):
+        return list(
+            CartItem.objects.filter(cart__user=self.user).values_list(
+                "product_id", "quantity"
+            )
+        )
+
+    def test_flush_writes_dirty_carts(self):
+        self.repository.add(self.user.pk, self.product.pk, 2)
+        self.assertEqual(self.get_lines(), [])
+        self.assertTrue(DirtyCart.objects.filter(user=self.user).exists())
+
+        # 別のプロセスのリポジトリでも、記録から書き出せる
+        CachedCartRepository().flush()
+        self.assertEqual(self.get_lines(), [(self.product.pk, 2)])
+        self.assertFalse(DirtyCart.objects.exists())
+
+    def test_cart_missing_from_cache_stays_dirty(self):
+        self.repository.add(self.user.pk, self.product.pk, 2)
+        self.repository.cache.delete(self.repository._key(self.user.pk))
+
+        with self.assertLogs("shop.carts", "ERROR"):
+            self.repository.flush()
+        self.assertTrue(DirtyCart.objects.filter(user=self.user).exists())
+
+        with self.assertLogs("shop.carts", "ERROR"):
+            self.repository.flush(self.user.pk)
+        self.assertTrue(DirtyCart.objects.filter(user=self.user).exists())
+
+
+class StripePriceSyncTests(TestCase):
+    @mock.patch("shop.stripe_prices.sync_prices", return_value=2)
+    def test_syncs_only_after_prices_change(self, sync_prices):
+        tea = Tea.objects.create(name="煎茶", steam_type="deep")
+        product = TeaProduct.objects.create(tea=tea, weight=100, price=1000, stock=10)
+        self.assertEqual(stripe_prices.sync_if_requested(), 2)
+        self.assertIsNone(stripe_prices.sync_if_requested())
+
+        product.price = 1200
+        product.save()
+        self.assertEqual(stripe_prices.sync_if_requested(), 2)
+
+        TaxRate.objects.create(rate=8, start_date="2030-01-01")
+        self.assertEqual(stripe_prices.sync_if_requested(), 2)
+        self.assertIsNone(stripe_prices.sync_if_requested())
+        self.assertEqual(sync_prices.call_count, 3)
+
+
+class PaymentSuccessTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="user@example.com", password="password", is_active=True
+        )
+        tea = Tea.objects.create(name="煎茶", steam_type="deep")
+        product = TeaProduct.objects.create(tea=tea, weight=100, price=1000, stock=10)
+        cart = Cart.objects.create(user=cls.user)
+        CartItem.objects.create(cart=cart, product=product, quantity=1)
+        cls.order = Order.create_from_cart(
+            cls.user, CartTotals.from_items(cart.totals.items), SHIPPING
+        )
+        cls.order.stripe_checkout_session_id = "cs_test"
+        cls.order.save()
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        session = SimpleNamespace(
+            id="cs_test", payment_status="paid", payment_intent="pi_test"
+        )
+        patcher = mock.patch(
+            "shop.stripe_gateway.retrieve_checkout_session",
+            mock.AsyncMock(return_value=session),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_success(self):
+        response = self.client.get(
+            reverse("shop:payment_success"),
+            {"session_id": "cs_test", "order_id": self.order.pk},
+        )
+        return [str(message) for message in get_messages(response.wsgi_request)]
+
+    def test_paid(self):
+        self.assertEqual(self.get_success(), ["お支払いが完了しました"])
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, "paid")
+        self.assertFalse(CartItem.objects.filter(cart__user=self.user).exists())
+
+    def test_processing_failure_keeps_cart(self):
+        with (
+            mock.patch.object(Order, "mark_paid", side_effect=RuntimeError),
+            self.assertLogs("shop.payments", "ERROR"),
+        ):
+            messages = self.get_success()
+        self.assertEqual(
+            messages, ["お支払いを処理中です。反映までしばらくお待ちください"]
+        )
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, "pending")
+        self.assertTrue(CartItem.objects.filter(cart__user=self.user).exists())
+
+
+class StripeEventTests(TransactionTestCase):
+    """台帳のイベントが1回だけ注文に反映されること（drain はスレッドで動くので実際にコミットする）"""
+
+    def setUp(self):
+        user = User.objects.create_user(
+            email="user@example.com", password="password", is_active=True
+        )
+        tea = Tea.objects.create(name="煎茶", steam_type="deep")
+        product = TeaProduct.objects.create(tea=tea, weight=100, price=1000, stock=10)
+        self.order = Order.create_from_cart(
+            user,
+            CartTotals.from_items([CartItem(product=product, quantity=2)]),
+            SHIPPING,
+        )
+        self.order.stripe_checkout_session_id = "cs_test"
+        self.order.save()
+        self.product = product
+
+    def event(self, event_id, event_type="checkout.session.completed"):
+        return {
+            "id": event_id,
+            "type": event_type,
+            "data": {
+                "object": {
+                    "id": "cs_test",
+                    "payment_status": "paid",
+                    "payment_intent": "pi_test",
+                    "metadata": {"order_id": str(self.order.pk)},
+                }
+            },
+        }
+
+    def test_duplicate_event_id_is_recorded_once(self):
+        self.assertTrue(payments.record_event(self.event("evt_1")))
+        self.assertFalse(payments.record_event(self.event("evt_1")))
+        self.assertEqual(StripeEvent.objects.count(), 1)
+
+        with mock.patch.object(Order, "mark_paid", wraps=Order.mark_paid) as mark_paid:
+            self.assertEqual(payments.drain(workers=2), 1)
+            self.assertEqual(payments.drain(workers=2), 0)
+        self.assertEqual(mark_paid.call_count, 1)
+
+    def test_redirect_then_webhook_applies_payment_once(self):
+        session = SimpleNamespace(
+            id="cs_test", payment_status="paid", payment_intent="pi_test"
+        )
+        payments.record_checkout_session(session, self.order)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, "paid")
+        paid_at = self.order.paid_at
+
+        payments.record_event(self.event("evt_1"))
+        self.assertEqual(payments.drain(), 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.paid_at, paid_at)
+        self.assertEqual(
+            list(StripeEvent.objects.values_list("status", flat=True)),
+            ["processed", "processed"],
+        )
+        # 取り置きのない注文なので支払いの反映で在庫を取るが、二重には減らさない
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 8)
+
+    def test_failed_event_backs_off_then_succeeds(self):
+        payments.record_event(self.event("evt_1"))
+        event = StripeEvent.objects.get()
+
+        with (
+            mock.patch.object(Order, "mark_paid", side_effect=RuntimeError("down")),
+            self.assertLogs("shop.payments", "ERROR"),
+        ):
+            for attempts, delay in [(1, 30), (2, 60), (3, 120)]:
+                StripeEvent.objects.filter(pk=event.pk).update(
+                    next_attempt_at=timezone.now()
+                )
+                before = timezone.now()
+                self.assertEqual(payments.drain(), 0)
+                event.refresh_from_db()
+                self.assertEqual(event.status, "pending")
+                self.assertEqual(event.attempts, attempts)
+                self.assertEqual(event.last_error, "down")
+                self.assertGreaterEqual(
+                    event.next_attempt_at, before + timedelta(seconds=delay)
+                )
+
+        # 次に反映する日時までは再実行しない
+        self.assertEqual(payments.drain(), 0)
+        event.refresh_from_db()
+        self.assertEqual(event.attempts, 3)
+
+        StripeEvent.objects.filter(pk=event.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(payments.drain(), 1)
+        event.refresh_from_db()
+        self.assertEqual(event.status, "processed")
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, "paid")
+
+    def test_retry_delay_is_capped(self):
+        self.assertEqual(payments.get_retry_delay(1), timedelta(seconds=30))
+        self.assertEqual(payments.get_retry_delay(4), timedelta(minutes=4))
+        self.assertEqual(payments.get_retry_delay(8), timedelta(hours=1))
+        self.assertEqual(payments.get_retry_delay(20), timedelta(hours=1))
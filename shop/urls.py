@@ -7,12 +7,18 @@ app_name = "shop"
 urlpatterns = [
     path("cart/", views.cart_view, name="cart"),
     path("cart/add/<int:product_id>/", views.add_to_cart, name="add_to_cart"),
-    path("cart/update/<int:item_id>/", views.update_cart_item, name="update_cart_item"),
-    path("cart/remove/<int:item_id>/", views.remove_cart_item, name="remove_cart_item"),
+    path(
+        "cart/update/<int:product_id>/", views.update_cart_item, name="update_cart_item"
+    ),
+    path(
+        "cart/remove/<int:product_id>/", views.remove_cart_item, name="remove_cart_item"
+    ),
+    path("cart/bulk-update/", views.bulk_update_cart, name="bulk_update_cart"),
     path("checkout/", views.checkout, name="checkout"),
     path("payment/success/", views.payment_success, name="payment_success"),
     path("payment/cancel/", views.payment_cancel, name="payment_cancel"),
     path("webhook/stripe/", views.stripe_webhook, name="stripe_webhook"),
     path("orders/", views.order_list, name="order_list"),
     path("orders/<int:order_id>/", views.order_detail, name="order_detail"),
+    path("orders/export/", views.export_orders, name="export_orders"),
 ]
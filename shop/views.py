@@ -1,90 +1,111 @@
-import uuid
+import json
 
 import stripe
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, JsonResponse
-from django.shortcuts import get_object_or_404, redirect, render
+from django.db import transaction
+from django.db.models import Count, Max
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, get_object_or_404, redirect, render
 from django.urls import reverse
+from django.utils import timezone
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_GET, require_http_methods, require_POST
+from django.views.decorators.http import (
+    condition,
+    require_GET,
+    require_http_methods,
+    require_POST,
+)
 
-from model.models import Cart, CartItem, Order, OrderItem, TeaProduct
+from model.conditional import last_modified, make_etag
+from model.models import Cart, Order, OutOfStockError, StockReservation, TeaProduct
+from model.pagination import keyset_page
 
-from .forms import AddToCartForm, CheckoutForm, UpdateCartItemForm
+from . import exports, payments, stripe_gateway, stripe_prices
+from .carts import get_cart_repository, get_request_cart
+from .forms import AddToCartForm, CheckoutForm, OrderExportForm, UpdateCartItemForm
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
+# 一度にまとめて変更できる商品の数
+CART_BULK_UPDATE_MAX_ITEMS = 100
+
+# 注文履歴の1ページの件数
+ORDER_PAGE_SIZE = 20
+
+
+def is_ajax(request):
+    return request.headers.get("X-Requested-With") == "XMLHttpRequest"
+
+
+def add_to_cart_error(request, product, error_messages):
+    """カートに追加できなかったときのレスポンス"""
+    if is_ajax(request):
+        return JsonResponse(
+            {"success": False, "error": "、".join(error_messages)}, status=400
+        )
+
+    for error in error_messages:
+        messages.error(request, error)
+    return redirect("published_tea_detail", tea_id=product.tea_id)
 
 
-@login_required
 @require_POST
 def add_to_cart(request, product_id):
-    """カートに追加"""
-    product = get_object_or_404(TeaProduct, id=product_id, is_available=True)
-    form = AddToCartForm(request.POST, product=product)
+    """カートに追加（未ログインの場合はCookieのカートに追加）"""
+    cart = get_request_cart(request)
+    form = AddToCartForm(request.POST)
 
     if form.is_valid():
         quantity = form.cleaned_data["quantity"]
 
-        # カートを取得または作成
-        cart, created = Cart.objects.get_or_create(user=request.user)
+        # 在庫を確認しながら数量を加算し、カート内の商品点数も受け取る
+        result = cart.add(product_id, quantity)
 
-        # カートアイテムを取得または作成
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart, product=product, defaults={"quantity": quantity}
-        )
+        if result is None:
+            # 追加できなかった理由を調べる（失敗時のみ）
+            product = get_object_or_404(TeaProduct, id=product_id, is_available=True)
+            in_cart = cart.get_quantity(product.pk)
+            if in_cart:
+                error_message = f"在庫が不足しています（在庫: {product.stock}個、カート内: {in_cart}個）"
+            else:
+                error_message = f"在庫が不足しています（在庫: {product.stock}個）"
+            return add_to_cart_error(request, product, [error_message])
 
-        if not created:
-            # 既存のアイテムの場合は数量を追加
-            new_quantity = cart_item.quantity + quantity
-            if product.stock < new_quantity:
-                error_message = f"在庫が不足しています（在庫: {product.stock}個、カート内: {cart_item.quantity}個）"
-                if request.headers.get("X-Requested-With") == "XMLHttpRequest":
-                    return JsonResponse(
-                        {"success": False, "error": error_message}, status=400
-                    )
-                messages.error(request, error_message)
-                return redirect("published_tea_detail", tea_id=product.tea.id)
-
-            cart_item.quantity = new_quantity
-            cart_item.save()
+        _, cart_count = result
 
         # AJAX リクエストの場合はJSON を返す
-        if request.headers.get("X-Requested-With") == "XMLHttpRequest":
-            return JsonResponse(
-                {
-                    "success": True,
-                    "cart_count": cart.item_count,
-                    "message": "カートに追加しました",
-                }
+        if is_ajax(request):
+            return cart.update_response(
+                JsonResponse(
+                    {
+                        "success": True,
+                        "cart_count": cart_count,
+                        "message": "カートに追加しました",
+                    }
+                )
             )
 
         messages.success(request, "カートに追加しました")
-        return redirect("shop:cart")
+        return cart.update_response(redirect("shop:cart"))
     else:
         # バリデーションエラー
+        product = get_object_or_404(TeaProduct, id=product_id, is_available=True)
         error_messages = []
         for field, errors in form.errors.items():
             for error in errors:
                 error_messages.append(error)
+        return add_to_cart_error(request, product, error_messages)
 
-        if request.headers.get("X-Requested-With") == "XMLHttpRequest":
-            return JsonResponse(
-                {"success": False, "error": "、".join(error_messages)}, status=400
-            )
-
-        for error in error_messages:
-            messages.error(request, error)
-        return redirect("published_tea_detail", tea_id=product.tea.id)
 
-
-@login_required
 @require_GET
 def cart_view(request):
     """カート表示"""
-    cart, created = Cart.objects.get_or_create(user=request.user)
-    cart_items = cart.items.select_related("product__tea").all()
+    request_cart = get_request_cart(request)
+    cart = request_cart.get_totals()
+    cart_items = cart.items
 
     # 各カートアイテムに更新フォームを追加
     for item in cart_items:
@@ -94,49 +115,123 @@ def cart_view(request):
         "cart": cart,
         "cart_items": cart_items,
     }
-    return render(request, "shop/cart.html", context)
+    return request_cart.update_response(render(request, "shop/cart.html", context))
 
 
-@login_required
 @require_POST
-def update_cart_item(request, item_id):
+def update_cart_item(request, product_id):
     """カートアイテムの数量更新"""
-    cart_item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
-
-    form = UpdateCartItemForm(request.POST, cart_item=cart_item)
+    cart = get_request_cart(request)
+    form = UpdateCartItemForm(request.POST)
 
     if form.is_valid():
         quantity = form.cleaned_data["quantity"]
-        cart_item.quantity = quantity
-        cart_item.save()
-        messages.success(request, "数量を更新しました")
+        # 在庫の確認と数量の変更を1文で行う
+        updated = cart.set_quantity(product_id, quantity)
+        if updated is None:
+            raise Http404("カートにない商品です")
+        if updated:
+            messages.success(request, "数量を更新しました")
+        else:
+            product = get_object_or_404(TeaProduct, id=product_id)
+            messages.error(request, f"在庫が不足しています（在庫: {product.stock}個）")
     else:
+        if cart.get_quantity(product_id) is None:
+            raise Http404("カートにない商品です")
         for error in form.errors.get("quantity", []):
             messages.error(request, error)
 
-    return redirect("shop:cart")
+    return cart.update_response(redirect("shop:cart"))
 
 
-@login_required
 @require_POST
-def remove_cart_item(request, item_id):
+def remove_cart_item(request, product_id):
     """カートから削除"""
-    cart_item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
-    cart_item.delete()
+    cart = get_request_cart(request)
+    if not cart.remove(product_id):
+        raise Http404("カートにない商品です")
     messages.success(request, "カートから削除しました")
-    return redirect("shop:cart")
+    return cart.update_response(redirect("shop:cart"))
 
 
-@login_required
-@require_http_methods(["GET", "POST"])
-def checkout(request):
-    """チェックアウト画面"""
+def parse_cart_changes(request):
+    """リクエストボディのJSON {"items": {商品ID: 数量}} を取得（不正ならNone）"""
+    try:
+        items = json.loads(request.body)["items"]
+        changes = {
+            int(product_id): int(quantity) for product_id, quantity in items.items()
+        }
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    if not changes or len(changes) > CART_BULK_UPDATE_MAX_ITEMS:
+        return None
+    if any(quantity < 0 for quantity in changes.values()):
+        return None
+    return changes
+
+
+def cart_totals_json(cart):
+    """カートの明細と金額をJSON用の辞書にする"""
+    return {
+        "item_count": cart.item_count,
+        "subtotal": cart.subtotal,
+        "tax_rate": float(cart.tax_rate),
+        "tax_amount": cart.tax_amount,
+        "shipping_fee": cart.shipping_fee,
+        "total_amount": cart.total_amount,
+        "items": [
+            {
+                "product_id": item.product_id,
+                "quantity": item.quantity,
+                "subtotal": item.subtotal,
+            }
+            for item in cart.items
+        ],
+    }
+
+
+@require_POST
+def bulk_update_cart(request):
+    """カートの数量をまとめて変更（0は削除）し、計算し直した金額をJSONで返す"""
+    changes = parse_cart_changes(request)
+    if changes is None:
+        return JsonResponse(
+            {"success": False, "error": "変更内容が正しくありません"}, status=400
+        )
+
+    cart = get_request_cart(request)
+    errors = cart.update_many(changes)
+    if errors:
+        return JsonResponse(
+            {
+                "success": False,
+                "errors": {
+                    str(product_id): error for product_id, error in errors.items()
+                },
+            },
+            status=400,
+        )
+
+    return cart.update_response(
+        JsonResponse({"success": True, **cart_totals_json(cart.get_totals())})
+    )
+
+
+def prepare_checkout(request):
+    """チェックアウト画面の表示、または注文の作成
+
+    注文を作成した場合は (注文, Checkout Sessionの作成パラメーター) を、
+    それ以外は返すレスポンスを返す。
+    """
+    # 保存先がキャッシュの場合に備えて、カートをテーブルに書き出してから読む
+    get_cart_repository().flush(request.user.pk)
     cart = get_object_or_404(Cart, user=request.user)
-    cart_items = cart.items.select_related("product__tea").all()
+    totals = cart.totals
+    cart_items = totals.items
 
     if not cart_items:
         messages.warning(request, "カートが空です")
-        return redirect("shop:product_list")
+        return redirect("shop:cart")
 
     # 在庫チェック
     for item in cart_items:
@@ -147,10 +242,7 @@ def checkout(request):
     if request.method == "POST":
         form = CheckoutForm(request.POST)
         if form.is_valid():
-            # Stripe Checkout Sessionを作成する処理を直接ここで実行
-            return create_checkout_session_internal(
-                request, cart, cart_items, form.cleaned_data
-            )
+            return create_order(request, totals, form.cleaned_data)
     else:
         # セッションにデータがあれば初期値として設定
         initial_data = request.session.get("checkout_data", {})
@@ -165,137 +257,121 @@ def checkout(request):
     return render(request, "shop/checkout.html", context)
 
 
-def create_checkout_session_internal(request, cart, cart_items, checkout_data):
-    """Stripe Checkout Sessionを作成（内部関数）"""
-    # 注文を作成（金額フィールドは後で設定）
-    order = Order.objects.create(
-        user=request.user,
-        order_number=f"ORD-{uuid.uuid4().hex[:12].upper()}",
-        shipping_name=checkout_data["shipping_name"],
-        shipping_postal_code=checkout_data["shipping_postal_code"],
-        shipping_address=checkout_data["shipping_address"],
-        shipping_phone=checkout_data["shipping_phone"],
-        # 一時的にデフォルト値を設定
-        subtotal=0,
-        tax_amount=0,
-        shipping_fee=0,
-        total_amount=0,
-        tax_rate=0,
-    )
-
-    # 注文明細を作成
-    for cart_item in cart_items:
-        OrderItem.objects.create(
-            order=order,
-            product=cart_item.product,
-            quantity=cart_item.quantity,
-            price=cart_item.product.price,  # 税抜価格を保存
+def create_order(request, totals, checkout_data):
+    """注文を作成して在庫を取り置き、(注文, Checkout Sessionの作成パラメーター) を返す"""
+    try:
+        # 計算済みの金額で注文と注文明細を作成し、在庫を取り置く
+        with transaction.atomic():
+            order = Order.create_from_cart(request.user, totals, checkout_data)
+            expires_at = StockReservation.reserve(
+                order, {item.product_id: item.quantity for item in totals.items}
+            )
+    except OutOfStockError as e:
+        product = next(
+            item.product for item in totals.items if item.product_id == e.product_id
         )
+        messages.error(request, f"{product}の在庫が不足しています")
+        return redirect("shop:cart")
 
-    # 金額を計算（注文明細作成後に実行）
-    order.calculate_amounts()
-    order.save()
+    # Stripe line_itemsを作成（同期済みの商品はPrice IDで送る）
+    line_items = stripe_prices.get_line_items(totals)
+
+    params = {
+        "payment_method_types": ["card"],
+        "line_items": line_items,
+        "mode": "payment",
+        "success_url": request.build_absolute_uri(reverse("shop:payment_success"))
+        + f"?session_id={{CHECKOUT_SESSION_ID}}&order_id={order.id}",
+        "cancel_url": request.build_absolute_uri(reverse("shop:payment_cancel"))
+        + f"?order_id={order.id}",
+        "customer_email": request.user.email,
+        # 取り置きの期限が切れたら決済ページも使えなくする
+        "expires_at": int(expires_at.timestamp()),
+        "metadata": {
+            "order_id": order.id,
+        },
+        # 再試行しても決済ページが二重に作られないようにする
+        "idempotency_key": f"checkout-{order.order_number}",
+    }
+    return order, params
 
-    # Stripe line_itemsを作成
-    line_items = []
 
-    # 商品
-    for cart_item in cart_items:
-        line_items.append(
-            {
-                "price_data": {
-                    "currency": "jpy",
-                    "product_data": {
-                        "name": f"{cart_item.product.tea.name} ({cart_item.product.weight}g)",
-                        "description": cart_item.product.tea.description[:100]
-                        if cart_item.product.tea.description
-                        else "",
-                    },
-                    "unit_amount": cart_item.product.get_price_with_tax(),  # 税込価格
-                },
-                "quantity": cart_item.quantity,
-            }
-        )
+def start_payment(request, order, checkout_session):
+    """作成したCheckout Sessionを注文に保存し、Stripeの支払いページへ移動"""
+    order.stripe_checkout_session_id = checkout_session.id
+    order.save(update_fields=["stripe_checkout_session_id", "updated_at"])
 
-    # 送料
-    if order.shipping_fee > 0:
-        line_items.append(
-            {
-                "price_data": {
-                    "currency": "jpy",
-                    "product_data": {
-                        "name": "送料",
-                    },
-                    "unit_amount": order.shipping_fee,
-                },
-                "quantity": 1,
-            }
-        )
+    # セッションデータをクリア
+    if "checkout_data" in request.session:
+        del request.session["checkout_data"]
+
+    return redirect(checkout_session.url)
 
-    try:
-        # Checkout Sessionを作成
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=["card"],
-            line_items=line_items,
-            mode="payment",
-            success_url=request.build_absolute_uri(reverse("shop:payment_success"))
-            + f"?session_id={{CHECKOUT_SESSION_ID}}&order_id={order.id}",
-            cancel_url=request.build_absolute_uri(reverse("shop:payment_cancel"))
-            + f"?order_id={order.id}",
-            customer_email=request.user.email,
-            metadata={
-                "order_id": order.id,
-            },
-        )
 
-        # Checkout Session IDを保存
-        order.stripe_checkout_session_id = checkout_session.id
-        order.save()
+def abandon_order(request, order, error):
+    """Checkout Sessionを作れなかった注文を取り消す"""
+    StockReservation.release_order(order)
+    order.delete()
+    messages.error(request, f"エラーが発生しました: {str(error)}")
+    return redirect("shop:checkout")
 
-        # セッションデータをクリア
-        if "checkout_data" in request.session:
-            del request.session["checkout_data"]
 
-        # Stripeの支払いページにリダイレクト
-        return redirect(checkout_session.url)
+@login_required
+@require_http_methods(["GET", "POST"])
+async def checkout(request):
+    """チェックアウト画面
+
+    Stripeの呼び出しは専用のスレッドプールで待つので、ASGIで動かすと
+    Stripeの応答を待つあいだもワーカーをふさがない。
+    """
+    result = await sync_to_async(prepare_checkout)(request)
+    if isinstance(result, HttpResponse):
+        return result
 
+    order, params = result
+    try:
+        checkout_session = await stripe_gateway.create_checkout_session(**params)
     except Exception as e:
-        order.delete()
-        messages.error(request, f"エラーが発生しました: {str(e)}")
-        return redirect("shop:checkout")
+        return await sync_to_async(abandon_order)(request, order, e)
+    return await sync_to_async(start_payment)(request, order, checkout_session)
+
+
+def confirm_payment(request, order, session):
+    """決済完了画面から戻ってきた支払いを注文に反映"""
+    # 支払いを記録して注文に反映（webhookで反映済みなら何もしない）
+    payments.record_checkout_session(session, order)
+
+    # 反映に失敗して再実行待ちの場合もあるので、注文の状態を読み直して確かめる
+    order.refresh_from_db(fields=["status"])
+    if order.status not in Order.SALES_STATUSES:
+        messages.info(request, "お支払いを処理中です。反映までしばらくお待ちください")
+        return
+
+    # カートを空にする
+    get_cart_repository().clear(request.user.pk)
+
+    messages.success(request, "お支払いが完了しました")
 
 
 @login_required
 @require_GET
-def payment_success(request):
+async def payment_success(request):
     """支払い成功"""
     session_id = request.GET.get("session_id")
     order_id = request.GET.get("order_id")
 
-    order = get_object_or_404(Order, id=order_id, user=request.user)
+    user = await request.auser()
+    order = await aget_object_or_404(Order, id=order_id, user=user)
 
     try:
         # Stripeのセッション情報を取得
-        session = stripe.checkout.Session.retrieve(session_id)
-
-        if session.payment_status == "paid":
-            # 注文ステータスを更新
-            order.status = "paid"
-            order.stripe_payment_intent_id = session.payment_intent
-            order.save()
-
-            # 在庫を減らす
-            for item in order.items.all():
-                product = item.product
-                product.stock -= item.quantity
-                product.save()
+        session = await stripe_gateway.retrieve_checkout_session(session_id)
 
-            # カートを空にする
-            cart = Cart.objects.filter(user=request.user).first()
-            if cart:
-                cart.items.all().delete()
+        if session.id != order.stripe_checkout_session_id:
+            raise ValueError("決済情報が注文と一致しません")
 
-            messages.success(request, "お支払いが完了しました")
+        if session.payment_status == "paid":
+            await sync_to_async(confirm_payment)(request, order, session)
 
     except Exception as e:
         messages.error(request, f"エラーが発生しました: {str(e)}")
@@ -310,9 +386,8 @@ def payment_cancel(request):
     order_id = request.GET.get("order_id")
     order = get_object_or_404(Order, id=order_id, user=request.user)
 
-    # 注文をキャンセル
-    order.status = "cancelled"
-    order.save()
+    # 支払い待ちなら注文をキャンセルし、取り置いていた在庫を戻す
+    Order.cancel_unpaid(order.pk)
 
     messages.warning(request, "お支払いがキャンセルされました")
     return redirect("shop:cart")
@@ -325,7 +400,8 @@ def stripe_webhook(request):
     sig_header = request.META.get("HTTP_STRIPE_SIGNATURE")
 
     try:
-        event = stripe.Webhook.construct_event(
+        # 署名を検証
+        stripe.Webhook.construct_event(
             payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
         )
     except ValueError:
@@ -333,45 +409,83 @@ def stripe_webhook(request):
     except stripe.error.SignatureVerificationError:
         return HttpResponse(status=400)
 
-    # イベント処理
-    if event["type"] == "checkout.session.completed":
-        session = event["data"]["object"]
-        order_id = session["metadata"].get("order_id")
-
-        if order_id:
-            try:
-                order = Order.objects.get(id=order_id)
-                order.status = "paid"
-                order.stripe_payment_intent_id = session.get("payment_intent")
-                order.save()
-
-                # 在庫を減らす
-                for item in order.items.all():
-                    product = item.product
-                    product.stock -= item.quantity
-                    product.save()
-            except Order.DoesNotExist:
-                pass
+    # 台帳に保存だけして、注文への反映は process_stripe_events コマンドで行う
+    payments.record_event(json.loads(payload))
 
     return HttpResponse(status=200)
 
 
+def get_order_list_summary(request):
+    """注文履歴の件数と最終更新日時"""
+    return Order.objects.filter(user=request.user).aggregate(
+        count=Count("pk"), updated_at=Max("updated_at")
+    )
+
+
+def order_list_etag(request):
+    summary = get_order_list_summary(request)
+    return make_etag(
+        request, summary["count"], summary["updated_at"], request.GET.get("cursor")
+    )
+
+
+def order_list_last_modified(request):
+    return last_modified(request, get_order_list_summary(request)["updated_at"])
+
+
 @login_required
 @require_GET
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=order_list_etag, last_modified_func=order_list_last_modified)
 def order_list(request):
     """注文履歴"""
-    orders = Order.objects.filter(user=request.user).prefetch_related(
-        "items__product__tea"
-    )
+    cursor = request.GET.get("cursor")
+    orders, next_cursor = get_order_page(request.user, cursor)
 
     context = {
         "orders": orders,
+        "next_cursor": next_cursor,
+        "is_first_page": not cursor,
     }
     return render(request, "shop/order_list.html", context)
 
 
+def get_order_page(user, cursor=None):
+    """注文履歴を新しい順に1ページ分取得（明細は読まずに注文に保存した要約を使う）"""
+    orders = Order.objects.filter(user=user).only(
+        "order_number",
+        "status",
+        "total_amount",
+        "item_count",
+        "item_summary",
+        "created_at",
+    )
+    return keyset_page(orders, "created_at", cursor, ORDER_PAGE_SIZE)
+
+
+def get_order_updated_at(request, order_id):
+    return (
+        Order.objects.filter(id=order_id, user=request.user)
+        .values_list("updated_at", flat=True)
+        .first()
+    )
+
+
+def order_detail_etag(request, order_id):
+    updated_at = get_order_updated_at(request, order_id)
+    if updated_at is None:
+        return None
+    return make_etag(request, order_id, updated_at)
+
+
+def order_detail_last_modified(request, order_id):
+    return last_modified(request, get_order_updated_at(request, order_id))
+
+
 @login_required
 @require_GET
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=order_detail_etag, last_modified_func=order_detail_last_modified)
 def order_detail(request, order_id):
     """注文詳細"""
     order = get_object_or_404(Order, id=order_id, user=request.user)
@@ -380,3 +494,29 @@ def order_detail(request, order_id):
         "order": order,
     }
     return render(request, "shop/order_detail.html", context)
+
+
+@staff_member_required
+@require_GET
+def export_orders(request):
+    """注文を明細ごとにCSVかJSON Linesで書き出す（スタッフ用）
+
+    ?format=csv|jsonl&date_from=YYYY-MM-DD&date_to=YYYY-MM-DD&status=paid&status=...
+    """
+    form = OrderExportForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+
+    export_format = form.cleaned_data["format"] or "csv"
+    rows = exports.get_export_rows(
+        form.cleaned_data["date_from"],
+        form.cleaned_data["date_to"],
+        form.cleaned_data["status"],
+    )
+    content_type, extension = exports.FORMATS[export_format]
+    response = StreamingHttpResponse(
+        exports.stream(rows, export_format), content_type=content_type
+    )
+    filename = f"orders-{timezone.localtime():%Y%m%d%H%M%S}.{extension}"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class TeaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tea'
+
+    def ready(self):
+        from tea import signals  # noqa: F401
@@ -0,0 +1,285 @@
+"""お茶一覧の絞り込み（ファセット）用インデックス
+
+一覧用の行（CatalogEntry）から、ファセットの値ごとにお茶IDのビットセット
+（Pythonの整数、tea_id番目のビットが立つ）を作ってプロセス内に保持する。
+絞り込みはビットセットの論理積、件数はビット数で求めるので、
+リクエストごとにGROUP BYを発行しなくてよい。
+
+一覧用の行が変わると世代番号（CacheGeneration）を進め、変わったお茶IDを
+その世代番号で変更履歴（CatalogChange）に記録する。各プロセスは世代番号の変化を見て、
+変更履歴にあるお茶の分だけを反映したインデックスを作る（全件の作り直しや、
+履歴が残っていない場合だけ作り直す）。
+
+インデックスは作ったあとは変更せず、差分を反映したコピーと差し替えるので、
+読み取り側はロックなしで使える。
+"""
+
+import bisect
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+from django.db import transaction
+
+from model.models import (
+    CacheGeneration,
+    CatalogChange,
+    CatalogEntry,
+    Tea,
+    TeaProduct,
+)
+from model.pagination import decode_cursor, encode_cursor
+
+GENERATION_NAME = "catalog_facets"
+
+# 変更履歴を残す世代の数（これより遅れたプロセスは作り直す）
+CHANGE_LOG_SIZE = 1000
+
+# 価格帯（税抜）: (値, 表示名, 下限, 上限)
+PRICE_RANGES = [
+    ("0-999", "〜¥999", 0, 1000),
+    ("1000-1999", "¥1,000〜¥1,999", 1000, 2000),
+    ("2000-2999", "¥2,000〜¥2,999", 2000, 3000),
+    ("3000-", "¥3,000〜", 3000, None),
+]
+
+# ファセット名と表示名（この順で表示する）
+FACETS = [
+    ("steam_type", "蒸し度"),
+    ("caffeine_free", "カフェイン"),
+    ("weight", "重量"),
+    ("price", "価格帯"),
+    ("origin", "産地"),
+]
+
+FACET_LABELS = {
+    "steam_type": dict(Tea.STEAM_TYPE_CHOICES),
+    "caffeine_free": {"1": "カフェインレス", "0": "カフェインあり"},
+    "weight": {str(weight): label for weight, label in TeaProduct.WEIGHT_CHOICES},
+    "price": {value: label for value, label, _, _ in PRICE_RANGES},
+}
+
+ENTRY_FIELDS = [
+    "tea_id",
+    "steam_type",
+    "caffeine_free",
+    "origin",
+    "products",
+    "published_at",
+]
+
+
+def get_price_range(price):
+    for value, _, lower, upper in PRICE_RANGES:
+        if price >= lower and (upper is None or price < upper):
+            return value
+    return None
+
+
+def get_facet_values(entry):
+    """一覧用の行が持つ (ファセット名, 値) を列挙"""
+    yield "steam_type", entry["steam_type"]
+    yield "caffeine_free", "1" if entry["caffeine_free"] else "0"
+    if entry["origin"]:
+        yield "origin", entry["origin"]
+    for product in entry["products"]:
+        yield "weight", str(product["weight"])
+        yield "price", get_price_range(product["price"])
+
+
+def get_selected_facets(query_dict):
+    """クエリパラメータから選択中のファセットを {ファセット名: 値の集合} で取得"""
+    selected = {}
+    for facet, _ in FACETS:
+        values = {value for value in query_dict.getlist(facet) if value}
+        if values:
+            selected[facet] = values
+    return selected
+
+
+class FacetIndex:
+    """ファセットの値ごとのお茶IDビットセット"""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.bitmaps = defaultdict(int)
+        # tea_id -> (公開日時, (ファセット名, 値)のタプル)
+        self.entries = {}
+        # (公開日時, tea_id) の昇順
+        self.order = []
+        # (公開済みのビットセット, 次に公開されるお茶の公開日時)
+        self._published_mask = None
+
+    @classmethod
+    def build(cls, generation):
+        index = cls(generation)
+        entries = CatalogEntry.objects.values(*ENTRY_FIELDS).order_by()
+        for entry in entries.iterator(chunk_size=2000):
+            index.add(entry, sort=False)
+        index.order.sort()
+        return index
+
+    def apply_changes(self, generation):
+        """変更履歴を反映したコピーを返す（反映できない場合はNone）"""
+        changes = list(
+            CatalogChange.objects.filter(
+                generation__gt=self.generation, generation__lte=generation
+            ).values_list("tea_id", flat=True)
+        )
+        if len(changes) != generation - self.generation or None in changes:
+            # 履歴が消えている、または全件の作り直し
+            return None
+        tea_ids = set(changes)
+        entries = CatalogEntry.objects.filter(pk__in=tea_ids).values(*ENTRY_FIELDS)
+
+        index = FacetIndex(generation)
+        index.bitmaps = defaultdict(int, self.bitmaps)
+        index.entries = dict(self.entries)
+        index.order = list(self.order)
+        for tea_id in tea_ids:
+            index.remove(tea_id)
+        for entry in entries:
+            index.add(entry)
+        return index
+
+    def add(self, entry, sort=True):
+        tea_id = entry["tea_id"]
+        keys = tuple(set(get_facet_values(entry)))
+        for key in keys:
+            self.bitmaps[key] |= 1 << tea_id
+        self.entries[tea_id] = (entry["published_at"], keys)
+        if sort:
+            bisect.insort(self.order, (entry["published_at"], tea_id))
+        else:
+            self.order.append((entry["published_at"], tea_id))
+        self._published_mask = None
+
+    def remove(self, tea_id):
+        if tea_id not in self.entries:
+            return
+        published_at, keys = self.entries.pop(tea_id)
+        for key in keys:
+            self.bitmaps[key] &= ~(1 << tea_id)
+            if not self.bitmaps[key]:
+                del self.bitmaps[key]
+        position = bisect.bisect_left(self.order, (published_at, tea_id))
+        del self.order[position]
+        self._published_mask = None
+
+    def published_mask(self, now):
+        """公開日時を過ぎたお茶のビットセット（次の公開予定まで使い回す）"""
+        cached = self._published_mask
+        if cached is None or (cached[1] and now >= cached[1]):
+            position = bisect.bisect_left(self.order, (now,))
+            mask = 0
+            for _, tea_id in self.order[:position]:
+                mask |= 1 << tea_id
+            expires_at = self.order[position][0] if position < len(self.order) else None
+            # 複数のスレッドから呼ばれるので、1回の代入で置き換える
+            cached = (mask, expires_at)
+            self._published_mask = cached
+        return cached[0]
+
+    def match(self, selected, now, exclude=None):
+        """選択中のファセットに一致するお茶のビットセット
+
+        ファセット内は OR、ファセット間は AND で絞り込む。
+        """
+        bitmap = self.published_mask(now)
+        for facet, values in selected.items():
+            if facet == exclude:
+                continue
+            facet_bitmap = 0
+            for value in values:
+                facet_bitmap |= self.bitmaps.get((facet, value), 0)
+            bitmap &= facet_bitmap
+        return bitmap
+
+    def get_facets(self, selected, now):
+        """表示用のファセット一覧（値ごとの件数つき）
+
+        各ファセットの件数は、そのファセット以外の選択条件で絞り込んだ件数。
+        """
+        values_by_facet = defaultdict(list)
+        for facet, value in self.bitmaps:
+            values_by_facet[facet].append(value)
+
+        facets = []
+        for facet, label in FACETS:
+            bitmap = self.match(selected, now, exclude=facet)
+            labels = FACET_LABELS.get(facet, {})
+            options = []
+            for value in values_by_facet[facet]:
+                count = (self.bitmaps[(facet, value)] & bitmap).bit_count()
+                selected_values = selected.get(facet, ())
+                if count or value in selected_values:
+                    options.append(
+                        {
+                            "value": value,
+                            "label": labels.get(value, value),
+                            "count": count,
+                            "selected": value in selected_values,
+                        }
+                    )
+            if facet == "origin":
+                options.sort(key=lambda option: (-option["count"], option["value"]))
+            else:
+                order = {value: i for i, value in enumerate(labels)}
+                options.sort(key=lambda option: order.get(option["value"], len(order)))
+            if options:
+                facets.append({"name": facet, "label": label, "options": options})
+        return facets
+
+    def page(self, bitmap, cursor=None, page_size=20):
+        """ビットセットのお茶を (公開日時, ID) の降順でカーソルページネーション"""
+        position = len(self.order)
+        values = decode_cursor(cursor)
+        if values:
+            published_at, tea_id = values
+            position = bisect.bisect_left(
+                self.order, (datetime.fromisoformat(published_at), tea_id)
+            )
+
+        tea_ids = []
+        for i in range(position - 1, -1, -1):
+            tea_id = self.order[i][1]
+            if bitmap >> tea_id & 1:
+                if len(tea_ids) == page_size:
+                    last_published_at = self.entries[tea_ids[-1]][0]
+                    return tea_ids, encode_cursor(last_published_at, tea_ids[-1])
+                tea_ids.append(tea_id)
+        return tea_ids, None
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_facet_index():
+    """最新の世代のファセットインデックスを取得"""
+    global _index
+    generation = CacheGeneration.get_value(GENERATION_NAME)
+    index = _index
+    if index is not None and index.generation == generation:
+        return index
+    with _lock:
+        index = _index
+        if index is None or index.generation != generation:
+            if index is not None and index.generation < generation:
+                index = index.apply_changes(generation)
+            else:
+                index = None
+            # 差し替えるだけで、読み取り中のインデックスは変更しない
+            _index = index or FacetIndex.build(generation)
+        return _index
+
+
+def catalog_entry_changed(tea_id):
+    """一覧用の行の変更を記録する（tea_id が None なら全件の作り直し）"""
+    with transaction.atomic():
+        # 世代番号の行ロックで、変更履歴は世代番号の順にコミットされる
+        generation = CacheGeneration.bump(GENERATION_NAME)
+        CatalogChange.objects.create(generation=generation, tea_id=tea_id)
+        CatalogChange.objects.filter(
+            generation__lte=generation - CHANGE_LOG_SIZE
+        ).delete()
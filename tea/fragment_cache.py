@@ -0,0 +1,108 @@
+"""テンプレートの断片キャッシュ
+
+お茶カードや詳細ページの説明部分など、閲覧者によらない部分の描画結果を
+キャッシュする。キーには断片名と、お茶の更新日時などのバージョンを含めるので、
+内容が変わると新しいキーで描画し直し、古い断片は期限切れで消える。
+
+ヒット数・ミス数はプロセス内で数えておき、一定間隔でキャッシュに加算する。
+"""
+
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
+
+# ヒット数・ミス数をキャッシュに書き出す間隔（秒）
+STATS_FLUSH_INTERVAL = 10
+STATS_KEY_PREFIX = "fragment_stats"
+STATS_NAMES_KEY = f"{STATS_KEY_PREFIX}:names"
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+_stats_flushed_at = time.monotonic()
+
+
+def get_cache():
+    return caches["fragments"]
+
+
+def get_fragment(name, vary_on, render):
+    """断片をキャッシュから取得（なければ描画してキャッシュ）"""
+    fragment_cache = get_cache()
+    key = make_template_fragment_key(name, vary_on)
+    content = fragment_cache.get(key)
+    if content is not None:
+        record(name, hit=True)
+        return content
+
+    record(name, hit=False)
+    content = render()
+    fragment_cache.set(key, content, settings.FRAGMENT_CACHE_TIMEOUT)
+    return content
+
+
+def get_stats_key(name, kind):
+    return f"{STATS_KEY_PREFIX}:{name}:{kind}"
+
+
+def record(name, hit):
+    """ヒット・ミスを数える"""
+    global _stats_flushed_at
+    with _stats_lock:
+        _stats[(name, "hits" if hit else "misses")] += 1
+        if time.monotonic() - _stats_flushed_at < STATS_FLUSH_INTERVAL:
+            return
+        pending = dict(_stats)
+        _stats.clear()
+        _stats_flushed_at = time.monotonic()
+    flush(pending)
+
+
+def flush(pending=None):
+    """数えたヒット数・ミス数をキャッシュに加算"""
+    if pending is None:
+        with _stats_lock:
+            pending = dict(_stats)
+            _stats.clear()
+    if not pending:
+        return
+
+    fragment_cache = get_cache()
+    names = set(fragment_cache.get(STATS_NAMES_KEY, ()))
+    for (name, kind), count in pending.items():
+        names.add(name)
+        key = get_stats_key(name, kind)
+        # 加算は add -> incr の順で、同時に作られても数え漏れがないようにする
+        if not fragment_cache.add(key, count, timeout=None):
+            try:
+                fragment_cache.incr(key, count)
+            except ValueError:
+                fragment_cache.set(key, count, timeout=None)
+    fragment_cache.set(STATS_NAMES_KEY, sorted(names), timeout=None)
+
+
+def get_stats():
+    """断片ごとのヒット数・ミス数を取得"""
+    flush()
+    fragment_cache = get_cache()
+    stats = {}
+    for name in fragment_cache.get(STATS_NAMES_KEY, ()):
+        hits = fragment_cache.get(get_stats_key(name, "hits"), 0)
+        misses = fragment_cache.get(get_stats_key(name, "misses"), 0)
+        stats[name] = {"hits": hits, "misses": misses}
+    return stats
+
+
+def reset_stats():
+    """ヒット数・ミス数を0に戻す"""
+    with _stats_lock:
+        _stats.clear()
+    fragment_cache = get_cache()
+    names = fragment_cache.get(STATS_NAMES_KEY, ())
+    fragment_cache.delete_many(
+        [get_stats_key(name, kind) for name in names for kind in ("hits", "misses")]
+        + [STATS_NAMES_KEY]
+    )
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from tea import fragment_cache
+
+
+class Command(BaseCommand):
+    help = "テンプレート断片キャッシュのヒット数・ミス数を表示する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            help="表示したあとヒット数・ミス数を0に戻す",
+        )
+
+    def handle(self, *args, **options):
+        if settings.FRAGMENT_CACHE_BACKEND == "locmem":
+            self.stdout.write(
+                self.style.WARNING(
+                    "locmemバックエンドではこのコマンドのプロセス内の値しか表示されません"
+                )
+            )
+
+        stats = fragment_cache.get_stats()
+        if not stats:
+            self.stdout.write("まだ記録がありません")
+        for name, counts in sorted(stats.items()):
+            total = counts["hits"] + counts["misses"]
+            ratio = counts["hits"] / total * 100 if total else 0
+            self.stdout.write(
+                f"{name}: ヒット {counts['hits']} / ミス {counts['misses']}"
+                f" (ヒット率 {ratio:.1f}%)"
+            )
+
+        if options["reset"]:
+            fragment_cache.reset_stats()
+            self.stdout.write(self.style.SUCCESS("ヒット数・ミス数を0に戻しました"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from model.models import Tea
+from tea import search
+
+
+class Command(BaseCommand):
+    help = "お茶の検索インデックスを全件作り直す"
+
+    def handle(self, *args, **options):
+        count = 0
+        with transaction.atomic():
+            search.clear_index()
+            for tea in Tea.objects.order_by("pk").iterator():
+                search.index_tea(tea)
+                count += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(f"{count}件のお茶を検索インデックスに登録しました")
+        )
@@ -0,0 +1,94 @@
+import re
+import unicodedata
+
+from django.db import migrations
+
+# ここから下のトークン化と登録は、マイグレーションの実行時点の tea.search を写したもの。
+# tea.search を変えても、このマイグレーションで作るインデックスは変わらない
+
+# 英数字の連続と、それ以外の文字（漢字・かななど）の連続に分ける
+TOKEN_RUN_PATTERN = re.compile(r'[0-9a-z]+|[^\W0-9a-z_]+')
+
+# 検索対象の項目と重み（PostgreSQLのtsvectorの重み）
+SEARCH_FIELDS = (('name', 'A'), ('origin', 'B'), ('description', 'C'))
+
+
+def tokenize(text):
+    """テキストを検索用のトークンに分割"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    tokens = []
+    for run in TOKEN_RUN_PATTERN.findall(text):
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def index_tea(schema_editor, tea):
+    """お茶を検索インデックスに登録"""
+    with schema_editor.connection.cursor() as cursor:
+        if schema_editor.connection.vendor == 'postgresql':
+            document = []
+            position = 1
+            for field, weight in SEARCH_FIELDS:
+                for token in tokenize(getattr(tea, field)):
+                    # tsvectorの位置は16383まで
+                    document.append(f"'{token}':{min(position, 16383)}{weight}")
+                    position += 1
+            cursor.execute(
+                'INSERT INTO tea_search_index (tea_id, document) '
+                'VALUES (%s, %s::tsvector)',
+                [tea.pk, ' '.join(document)],
+            )
+        else:
+            cursor.execute(
+                'INSERT INTO tea_search_index (rowid, name, origin, description) '
+                'VALUES (%s, %s, %s, %s)',
+                [tea.pk]
+                + [' '.join(tokenize(getattr(tea, field))) for field, _ in SEARCH_FIELDS],
+            )
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE TABLE tea_search_index ('
+            'tea_id bigint PRIMARY KEY REFERENCES teas (id) '
+            'ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+            'document tsvector NOT NULL)'
+        )
+        schema_editor.execute(
+            'CREATE INDEX tea_search_index_document_idx '
+            'ON tea_search_index USING GIN (document)'
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE tea_search_index '
+            "USING fts5(name, origin, description, tokenize='unicode61')"
+        )
+    else:
+        return
+
+    Tea = apps.get_model('model', 'Tea')
+    for tea in Tea.objects.order_by('pk').iterator():
+        index_tea(schema_editor, tea)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute('DROP TABLE IF EXISTS tea_search_index')
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('model', '0005_teafavoritecounter'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
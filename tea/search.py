@@ -0,0 +1,148 @@
+"""お茶の全文検索
+
+お茶名・産地・説明を、日本語は2文字ずつ（bigram）、英数字は単語ごとに
+トークン化して転置インデックスに登録する。
+本番（PostgreSQL）では tsvector + GIN インデックス、
+ローカル（SQLite）では FTS5 の仮想テーブルを使う。
+"""
+
+import re
+import unicodedata
+
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from model.models import CatalogEntry
+
+SEARCH_TABLE = "tea_search_index"
+
+# 英数字の連続と、それ以外の文字（漢字・かななど）の連続に分ける
+TOKEN_RUN_PATTERN = re.compile(r"[0-9a-z]+|[^\W0-9a-z_]+")
+
+# 検索対象の項目と重み（PostgreSQLのtsvectorの重み）
+SEARCH_FIELDS = (("name", "A"), ("origin", "B"), ("description", "C"))
+
+
+def tokenize(text):
+    """テキストを検索用のトークンに分割"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = []
+    for run in TOKEN_RUN_PATTERN.findall(text):
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def index_tea(tea):
+    """お茶を検索インデックスに登録（登録済みなら置き換え）"""
+    if connection.vendor == "postgresql":
+        document = []
+        position = 1
+        for field, weight in SEARCH_FIELDS:
+            for token in tokenize(getattr(tea, field)):
+                # tsvectorの位置は16383まで
+                document.append(f"'{token}':{min(position, 16383)}{weight}")
+                position += 1
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE} (tea_id, document) "
+                "VALUES (%s, %s::tsvector) "
+                "ON CONFLICT (tea_id) DO UPDATE SET document = EXCLUDED.document",
+                [tea.pk, " ".join(document)],
+            )
+    elif connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [tea.pk])
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE} (rowid, name, origin, description) "
+                "VALUES (%s, %s, %s, %s)",
+                [tea.pk]
+                + [
+                    " ".join(tokenize(getattr(tea, field)))
+                    for field, _ in SEARCH_FIELDS
+                ],
+            )
+
+
+def remove_tea(tea_id):
+    """お茶を検索インデックスから削除"""
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE tea_id = %s", [tea_id])
+    elif connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [tea_id])
+
+
+def clear_index():
+    """検索インデックスを空にする"""
+    if connection.vendor in ("postgresql", "sqlite"):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+
+
+def search_tea_ids(query, offset=0, limit=20):
+    """公開中のお茶を検索し、関連度の高い順にお茶IDを返す"""
+    tokens = list(dict.fromkeys(tokenize(query)))
+    # 漢字・かなの1文字はbigramのどちらの位置にも入りうるので（「茶」は「煎茶」の2文字目）、
+    # インデックスではなく部分一致で探す。英数字の1文字は前方一致で探す
+    chars = [token for token in tokens if len(token) == 1 and not token.isascii()]
+    tokens = [token for token in tokens if token not in chars]
+    if not tokens and not chars:
+        return []
+    if connection.vendor not in ("postgresql", "sqlite"):
+        # 全文検索に対応していないDBでは部分一致で代用
+        return search_by_substring([query], offset, limit)
+    if not tokens:
+        return search_by_substring(chars, offset, limit)
+
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    char_conditions = "".join(
+        " AND (c.name LIKE %s OR c.origin LIKE %s OR c.description LIKE %s)"
+        for _ in chars
+    )
+    char_params = [f"%{char}%" for char in chars for _ in range(3)]
+    if connection.vendor == "postgresql":
+        tsquery = " & ".join(
+            f"'{token}':*" if len(token) == 1 else f"'{token}'" for token in tokens
+        )
+        sql = (
+            f"SELECT s.tea_id FROM {SEARCH_TABLE} s "
+            "JOIN catalog_entries c ON c.tea_id = s.tea_id "
+            f"WHERE s.document @@ %s::tsquery AND c.published_at < %s{char_conditions} "
+            "ORDER BY ts_rank(s.document, %s::tsquery) DESC, s.tea_id DESC "
+            "LIMIT %s OFFSET %s"
+        )
+        params = [tsquery, now, *char_params, tsquery, limit, offset]
+    else:
+        match = " ".join(
+            f'"{token}"*' if len(token) == 1 else f'"{token}"' for token in tokens
+        )
+        sql = (
+            f"SELECT s.rowid FROM {SEARCH_TABLE} s "
+            "JOIN catalog_entries c ON c.tea_id = s.rowid "
+            f"WHERE {SEARCH_TABLE} MATCH %s AND c.published_at < %s{char_conditions} "
+            f"ORDER BY bm25({SEARCH_TABLE}, 10.0, 5.0, 1.0), s.rowid DESC "
+            "LIMIT %s OFFSET %s"
+        )
+        params = [match, now, *char_params, limit, offset]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_by_substring(terms, offset=0, limit=20):
+    """すべての語を名前・産地・説明のいずれかに含むお茶を、新しい順に返す"""
+    entries = CatalogEntry.objects.filter(published_at__lt=timezone.now())
+    for term in terms:
+        entries = entries.filter(
+            Q(name__icontains=term)
+            | Q(origin__icontains=term)
+            | Q(description__icontains=term)
+        )
+    entries = entries.order_by("-published_at", "-pk")
+    return list(entries.values_list("pk", flat=True)[offset : offset + limit])
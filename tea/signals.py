@@ -0,0 +1,26 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from model.models import Tea
+from model.signals import catalog_entry_changed
+from tea import facets, search
+
+
+@receiver(post_save, sender=Tea)
+def index_tea_on_save(sender, instance, raw=False, **kwargs):
+    """お茶の保存時に検索インデックスを更新"""
+    if raw:
+        return
+    search.index_tea(instance)
+
+
+@receiver(post_delete, sender=Tea)
+def remove_tea_on_delete(sender, instance, **kwargs):
+    """お茶の削除時に検索インデックスから削除"""
+    search.remove_tea(instance.pk)
+
+
+@receiver(catalog_entry_changed)
+def update_facet_index(sender, tea_id, **kwargs):
+    """一覧用の行の変更をファセットインデックスに反映"""
+    facets.catalog_entry_changed(tea_id)
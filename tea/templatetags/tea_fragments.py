@@ -0,0 +1,41 @@
+from django import template
+
+from tea import fragment_cache
+
+register = template.Library()
+
+
+class FragmentCacheNode(template.Node):
+    def __init__(self, nodelist, name, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        vary_on = [var.resolve(context) for var in self.vary_on]
+        return fragment_cache.get_fragment(
+            self.name, vary_on, lambda: self.nodelist.render(context)
+        )
+
+
+@register.tag("fragment_cache")
+def do_fragment_cache(parser, token):
+    """閲覧者によらない部分の描画結果をキャッシュする
+
+    使い方: {% fragment_cache "tea_card" tea.pk tea.updated_at %}...{% endfragment_cache %}
+    断片名のあとに並べた値（バージョン）が変わると描画し直す。
+    ユーザーごとに変わる内容（お気に入りボタンやCSRFトークン）は含めないこと。
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' タグには断片名が必要です")
+    name = bits[1]
+    if not (name[0] == name[-1] and name[0] in "\"'"):
+        raise template.TemplateSyntaxError(
+            f"'{bits[0]}' タグの断片名は文字列で指定してください"
+        )
+    nodelist = parser.parse(("endfragment_cache",))
+    parser.delete_first_token()
+    return FragmentCacheNode(
+        nodelist, name[1:-1], [parser.compile_filter(bit) for bit in bits[2:]]
+    )
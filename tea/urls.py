@@ -4,6 +4,8 @@ from tea import views
 
 urlpatterns = [
     path("", views.published_tea_list, name="published_tea_list"),
+    path("teas/more/", views.published_tea_list_more, name="published_tea_list_more"),
+    path("teas/search/", views.search_teas, name="search_teas"),
     path("teas/<int:tea_id>/", views.published_tea_detail, name="published_tea_detail"),
     path(
         "teas/<int:tea_id>/favorite/", views.add_favorite_tea, name="add_favorite_tea"
@@ -13,5 +15,10 @@ urlpatterns = [
         views.cancel_favorite_tea,
         name="cancel_favorite_tea",
     ),
+    path(
+        "teas/<int:tea_id>/reviews/",
+        views.published_tea_reviews,
+        name="published_tea_reviews",
+    ),
     path("teas/<int:tea_id>/review/", views.add_review, name="add_review"),
 ]
@@ -1,65 +1,308 @@
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import BooleanField, Count, Exists, OuterRef, Value
-from django.http import JsonResponse
+from django.db import transaction
+from django.db.models import Max
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
-from django.views.decorators.http import require_GET, require_POST
+from django.utils.http import urlencode
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_GET, require_POST
 
-from model.models import FavoriteTea, Tea, TeaReview
+from model.conditional import make_etag
+from model.models import (
+    CacheGeneration,
+    CatalogEntry,
+    FavoriteTea,
+    TaxRate,
+    Tea,
+    TeaFavoriteCounter,
+    TeaProduct,
+    TeaRatingSummary,
+    TeaReview,
+)
+from model.pagination import keyset_next_cursor, keyset_page, keyset_queryset
+from tea import facets, search
 from tea.forms import ReviewForm
 
+# お茶一覧の1ページあたりの件数
+CATALOG_PAGE_SIZE = 24
+CATALOG_MAX_PAGE_SIZE = 1000
+# この件数を超えるページはストリーミングで返す
+CATALOG_STREAM_THRESHOLD = 100
+CATALOG_STREAM_CHUNK_SIZE = 100
+CATALOG_STREAM_MARKER = "<!-- tea-cards -->"
+# 検索結果の1ページあたりの件数
+SEARCH_PAGE_SIZE = 20
+# お茶詳細で一度に表示するレビューの件数
+REVIEW_PAGE_SIZE = 10
+
+
+def get_favorite_tea_ids(request):
+    """ログインユーザーのお気に入りのお茶IDの集合を取得"""
+    if not request.user.is_authenticated:
+        return frozenset()
+    return FavoriteTea.get_tea_ids(request.user.pk)
+
+
+def annotate_catalog_entries(request, teas):
+    """一覧用の行にお気に入り状態を付与（お気に入り数は一覧用の行が持つ）"""
+    favorite_tea_ids = get_favorite_tea_ids(request)
+    for tea in teas:
+        tea.is_favorited = tea.pk in favorite_tea_ids
+    return teas
+
+
+def get_catalog_page_size(request):
+    """1ページの件数をクエリパラメータから取得"""
+    try:
+        page_size = int(request.GET.get("limit", CATALOG_PAGE_SIZE))
+    except ValueError:
+        page_size = CATALOG_PAGE_SIZE
+    return max(1, min(page_size, CATALOG_MAX_PAGE_SIZE))
+
+
+def published_catalog():
+    # 一覧用の読み取りモデルから公開日時のインデックスで取得
+    return CatalogEntry.objects.filter(published_at__lt=timezone.now())
+
+
+def get_catalog_page(cursor, page_size, selected_facets, index=None):
+    """お茶一覧の1ページ分の行と次ページのカーソルを取得"""
+    if not selected_facets:
+        return keyset_page(published_catalog(), "published_at", cursor, page_size)
+
+    # 絞り込み時はファセットインデックスで対象のお茶IDを求める
+    index = index or facets.get_facet_index()
+    bitmap = index.match(selected_facets, timezone.now())
+    tea_ids, next_cursor = index.page(bitmap, cursor, page_size)
+    entries = CatalogEntry.objects.in_bulk(tea_ids)
+    return [entries[tea_id] for tea_id in tea_ids if tea_id in entries], next_cursor
+
+
+def get_facet_context(selected_facets, index=None):
+    """ファセット（件数つき）と絞り込み条件のクエリ文字列"""
+    index = index or facets.get_facet_index()
+    return {
+        "facets": index.get_facets(selected_facets, timezone.now()),
+        "filter_query": urlencode(
+            [
+                (facet, value)
+                for facet, values in selected_facets.items()
+                for value in sorted(values)
+            ]
+        ),
+    }
+
+
+def get_favorites_version(request):
+    """ログインユーザーのお気に入りのバージョン（ETag用）"""
+    if not request.user.is_authenticated:
+        return None
+    return FavoriteTea.get_tea_ids_version(request.user.pk)
+
+
+def get_catalog_page_favorites_counts(request):
+    """表示するページのお茶IDとお気に入り数だけを取得（ETag用。行全体は読み込まない）"""
+    cursor = request.GET.get("cursor")
+    page_size = get_catalog_page_size(request)
+    selected_facets = facets.get_selected_facets(request.GET)
+    if not selected_facets:
+        return list(
+            keyset_queryset(published_catalog(), "published_at", cursor).values_list(
+                "pk", "favorites_count"
+            )[:page_size]
+        )
+    index = facets.get_facet_index()
+    bitmap = index.match(selected_facets, timezone.now())
+    tea_ids = index.page(bitmap, cursor, page_size)[0]
+    favorites_counts = dict(
+        CatalogEntry.objects.filter(pk__in=tea_ids).values_list("pk", "favorites_count")
+    )
+    return [(tea_id, favorites_counts.get(tea_id, 0)) for tea_id in tea_ids]
+
+
+def published_tea_list_etag(request):
+    """お茶一覧のETag
+
+    一覧用の行の世代番号・公開済みの最新の公開日時と、
+    表示するページのお茶のお気に入り数から計算する。
+    """
+    latest_published_at = published_catalog().aggregate(latest=Max("published_at"))[
+        "latest"
+    ]
+    return make_etag(
+        request,
+        CacheGeneration.get_value(facets.GENERATION_NAME),
+        latest_published_at,
+        get_catalog_page_favorites_counts(request),
+        get_favorites_version(request),
+    )
+
 
 @require_GET
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=published_tea_list_etag)
 def published_tea_list(request):
-    now = timezone.now()
-    teas = (
-        Tea.objects.filter(
-            published_at__isnull=False,
-            published_at__lt=now,
-            products__is_available=True,
+    cursor = request.GET.get("cursor")
+    page_size = get_catalog_page_size(request)
+    selected_facets = facets.get_selected_facets(request.GET)
+
+    if page_size > CATALOG_STREAM_THRESHOLD and not selected_facets:
+        return stream_published_tea_list(request, cursor, page_size)
+
+    index = facets.get_facet_index()
+    teas, next_cursor = get_catalog_page(cursor, page_size, selected_facets, index)
+    annotate_catalog_entries(request, teas)
+
+    return render(
+        request,
+        "tea/published_tea_list.html",
+        {
+            "teas": teas,
+            "next_cursor": next_cursor,
+            "page_size": page_size,
+            **get_facet_context(selected_facets, index),
+        },
+    )
+
+
+def stream_published_tea_list(request, cursor, page_size):
+    """件数の多いページをチャンクごとに描画しながら返す"""
+    queryset = keyset_queryset(published_catalog(), "published_at", cursor)
+    next_cursor = keyset_next_cursor(
+        published_catalog(), "published_at", cursor, page_size
+    )
+    page = render_to_string(
+        "tea/published_tea_list.html",
+        {
+            "teas": [],
+            "streaming": True,
+            "next_cursor": next_cursor,
+            "page_size": CATALOG_PAGE_SIZE,
+            **get_facet_context({}),
+        },
+        request=request,
+    )
+    head, tail = page.split(CATALOG_STREAM_MARKER, 1)
+
+    def render_chunks():
+        yield head
+        chunk = []
+        for tea in queryset[:page_size].iterator(chunk_size=CATALOG_STREAM_CHUNK_SIZE):
+            chunk.append(tea)
+            if len(chunk) == CATALOG_STREAM_CHUNK_SIZE:
+                yield render_tea_cards(request, chunk)
+                chunk = []
+        if chunk:
+            yield render_tea_cards(request, chunk)
+        yield tail
+
+    return StreamingHttpResponse(render_chunks(), content_type="text/html")
+
+
+def render_tea_cards(request, teas):
+    annotate_catalog_entries(request, teas)
+    return render_to_string("tea/tea_cards.html", {"teas": teas}, request=request)
+
+
+@require_GET
+def published_tea_list_more(request):
+    """お茶一覧の続きをJSONで返す（もっと見る）"""
+    teas, next_cursor = get_catalog_page(
+        request.GET.get("cursor"),
+        get_catalog_page_size(request),
+        facets.get_selected_facets(request.GET),
+    )
+    return JsonResponse(
+        {"html": render_tea_cards(request, teas), "next_cursor": next_cursor}
+    )
+
+
+@require_GET
+def search_teas(request):
+    """お茶の検索"""
+    query = request.GET.get("q", "").strip()
+    try:
+        page = max(1, int(request.GET.get("page", 1)))
+    except ValueError:
+        page = 1
+
+    teas = []
+    has_next = False
+    if query:
+        tea_ids = search.search_tea_ids(
+            query, offset=(page - 1) * SEARCH_PAGE_SIZE, limit=SEARCH_PAGE_SIZE + 1
         )
-        .distinct()
-        .prefetch_related("products")
-        .annotate(favorites_count=Count("favorited_by", distinct=True))
+        has_next = len(tea_ids) > SEARCH_PAGE_SIZE
+        tea_ids = tea_ids[:SEARCH_PAGE_SIZE]
+        # 検索結果の順位を保ったまま一覧用の行を取得
+        entries = CatalogEntry.objects.in_bulk(tea_ids)
+        teas = annotate_catalog_entries(
+            request, [entries[tea_id] for tea_id in tea_ids if tea_id in entries]
+        )
+
+    return render(
+        request,
+        "tea/search_results.html",
+        {"teas": teas, "query": query, "page": page, "has_next": has_next},
     )
 
-    if request.user.is_authenticated:
-        user_favorite = FavoriteTea.objects.filter(
-            user=request.user, tea=OuterRef("pk")
+
+def published_tea_detail_etag(request, tea_id: int):
+    """お茶詳細のETag
+
+    お茶・商品（価格と在庫）・レビュー集計の更新とお気に入り数、税率から計算する。
+    """
+    tea_updated_at = (
+        Tea.objects.filter(
+            pk=tea_id, published_at__isnull=False, published_at__lt=timezone.now()
         )
-        teas = teas.annotate(is_favorited=Exists(user_favorite))
-    else:
-        teas = teas.annotate(is_favorited=Value(False, output_field=BooleanField()))
+        .values_list("updated_at", flat=True)
+        .first()
+    )
+    if tea_updated_at is None:
+        return None
 
-    return render(request, "tea/published_tea_list.html", {"teas": teas})
+    products = list(
+        TeaProduct.objects.filter(tea_id=tea_id).values_list(
+            "pk", "price", "stock", "is_available"
+        )
+    )
+    rating_updated_at = (
+        TeaRatingSummary.objects.filter(tea_id=tea_id)
+        .values_list("updated_at", flat=True)
+        .first()
+    )
+    return make_etag(
+        request,
+        tea_updated_at,
+        products,
+        rating_updated_at,
+        TeaFavoriteCounter.get_count(tea_id),
+        get_favorites_version(request),
+        TaxRate.get_current_rate(),
+    )
 
 
 @require_GET
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=published_tea_detail_etag)
 def published_tea_detail(request, tea_id: int):
     """お茶詳細ページ"""
     now = timezone.now()
 
-    # 1つのお茶だけにアノテーションを適用
-    queryset = Tea.objects.filter(
-        pk=tea_id, published_at__isnull=False, published_at__lt=now
-    ).annotate(favorites_count=Count("favorited_by"))
-
-    if request.user.is_authenticated:
-        user_favorite = FavoriteTea.objects.filter(
-            user=request.user, tea=OuterRef("pk")
-        )
-        queryset = queryset.annotate(is_favorited=Exists(user_favorite))
-    else:
-        queryset = queryset.annotate(
-            is_favorited=Value(False, output_field=BooleanField())
-        )
-
-    tea = get_object_or_404(queryset)
+    tea = get_object_or_404(
+        Tea, pk=tea_id, published_at__isnull=False, published_at__lt=now
+    )
+    tea.is_favorited = tea.pk in get_favorite_tea_ids(request)
+    tea.favorites_count = TeaFavoriteCounter.get_count(tea.pk)
 
     products = tea.products.filter(is_available=True)
-    reviews = tea.reviews.select_related("user").all()
+    rating_summary = TeaRatingSummary.get_for_tea(tea.pk)
+    reviews, next_cursor = get_review_page(tea.pk)
 
     # ユーザーが既にレビュー済みかチェック
     user_has_reviewed = False
@@ -78,7 +321,9 @@ def published_tea_detail(request, tea_id: int):
         "tea/published_tea_detail.html",
         {
             "tea": tea,
+            "rating_summary": rating_summary,
             "reviews": reviews,
+            "next_cursor": next_cursor,
             "user_has_reviewed": user_has_reviewed,
             "review_form": review_form,
             "products": products,
@@ -86,6 +331,25 @@ def published_tea_detail(request, tea_id: int):
     )
 
 
+def get_review_page(tea_id, cursor=None):
+    """お茶のレビューを新しい順に1ページ分取得"""
+    reviews = TeaReview.objects.filter(tea_id=tea_id).select_related("user")
+    return keyset_page(reviews, "created_at", cursor, REVIEW_PAGE_SIZE)
+
+
+@require_GET
+def published_tea_reviews(request, tea_id: int):
+    """お茶のレビューの続き（JSON）"""
+    tea = get_object_or_404(
+        Tea, pk=tea_id, published_at__isnull=False, published_at__lt=timezone.now()
+    )
+    reviews, next_cursor = get_review_page(tea.pk, request.GET.get("cursor"))
+    html = render_to_string(
+        "tea/review_cards.html", {"reviews": reviews}, request=request
+    )
+    return JsonResponse({"html": html, "next_cursor": next_cursor})
+
+
 @login_required
 @require_POST
 def add_favorite_tea(request, tea_id):
@@ -94,10 +358,12 @@ def add_favorite_tea(request, tea_id):
         tea = get_object_or_404(Tea, pk=tea_id)
 
         # お気に入りを追加（既に存在する場合は何もしない）
-        FavoriteTea.objects.get_or_create(user=request.user, tea=tea)
+        # カウンターの加算も同じトランザクションで行われる
+        with transaction.atomic():
+            FavoriteTea.objects.get_or_create(user=request.user, tea=tea)
 
         # 更新後のいいね数を取得
-        favorites_count = tea.favorited_by.count()
+        favorites_count = TeaFavoriteCounter.get_count(tea.pk)
 
         return JsonResponse(
             {
@@ -119,11 +385,12 @@ def cancel_favorite_tea(request, tea_id):
     if request.method == "POST":
         tea = get_object_or_404(Tea, pk=tea_id)
 
-        # お気に入りを削除
-        FavoriteTea.objects.filter(user=request.user, tea=tea).delete()
+        # お気に入りを削除（カウンターの減算も同じトランザクションで行われる）
+        with transaction.atomic():
+            FavoriteTea.objects.filter(user=request.user, tea=tea).delete()
 
         # 更新後のいいね数を取得
-        favorites_count = tea.favorited_by.count()
+        favorites_count = TeaFavoriteCounter.get_count(tea.pk)
 
         return JsonResponse(
             {